@@ -1,4 +1,10 @@
 from builtins import range
+import os
+import sys
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
+import packed_spectra
+
 def setup(options):
     return {}
 
@@ -7,6 +13,8 @@ def execute(block, config):
     bias_section = "bin_bias"
 
     section = "galaxy_cl"
+    # Otherwise the has_value check below would silently skip every bin pair
+    packed_spectra.require_legacy(block, section)
     nbin = block[section, "nbin"]
     for i in range(nbin):
         b1 = block[bias_section, "b_{}".format(i + 1)]
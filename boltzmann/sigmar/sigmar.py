@@ -26,6 +26,11 @@ def setup(options):
         dr = options[option_section, "dr"]
         R = np.arange(rmin, rmax, dr)
     crop_klim = options.get_bool(option_section, "crop_klim", True)
+    method = options.get_string(option_section, "method", "quad")
+    if method not in ["quad", "grid"]:
+        raise ValueError("method in sigma_r should be 'quad' or 'grid'")
+    nk = options.get_int(option_section, "nk", 2000)
+    check_quad = options.get_bool(option_section, "check_quad", False)
     R = np.atleast_1d(R)
     z = np.atleast_1d(z)
     blockname = options[option_section, "matter_power"]
@@ -33,7 +38,8 @@ def setup(options):
     print("z = ", z)
     print("R = ", R)
     print("crop_klim = ", crop_klim)
-    return (z, R, blockname, crop_klim)
+    print("method = ", method)
+    return (z, R, blockname, crop_klim, method, nk, check_quad)
 
 
 def sigint(lnk, r, z, rbs):
@@ -45,8 +51,70 @@ def sigint(lnk, r, z, rbs):
     return tmp
 
 
+def tophat_window_squared(x):
+    w = 3 * (-x * np.cos(x) + np.sin(x)) / x**3
+    return w**2
+
+
+def trapezoid_weights(x, a, b):
+    """
+    Weights w such that (w * f).sum(axis=-1) is the integral from a to b
+    of the linear interpolation of f(x), for arrays of limits a and b that
+    need not lie on the grid x. Returns an array of shape (len(a), len(x)).
+    """
+    a = np.atleast_1d(a)[:, np.newaxis]
+    b = np.atleast_1d(b)[:, np.newaxis]
+    h = np.diff(x)
+    # The part of each interval inside [a, b], as a fraction of its width
+    t_lo = np.clip((a - x[:-1]) / h, 0, 1)
+    t_hi = np.clip((b - x[:-1]) / h, 0, 1)
+    t_hi = np.maximum(t_hi, t_lo)
+    upper = 0.5 * h * (t_hi**2 - t_lo**2)
+    lower = h * (t_hi - t_lo) - upper
+    weights = np.zeros((a.shape[0], x.size))
+    weights[:, :-1] += lower
+    weights[:, 1:] += upper
+    return weights
+
+
+def klimits(R, kmin_overall, kmax_overall, crop_klim):
+    "The limits in log(k) of the sigma integral for each R"
+    kmin = np.repeat(kmin_overall, np.size(R))
+    kmax = np.repeat(kmax_overall, np.size(R))
+    if crop_klim:
+        kmin = np.maximum(np.log(.01 / R), kmin_overall)
+        kmax = np.minimum(np.log(100. / R), kmax_overall)
+    return kmin, kmax
+
+
+def sigma2_quad(R, z, rbs, kmin, kmax):
+    "sigma^2(R,z) from an adaptive integral for each R and z"
+    sigma2r = np.zeros((np.size(R), np.size(z)))
+    for i, rloop in enumerate(R):
+        for j, zloop in enumerate(z):
+            sigma2r[i, j] = scipy.integrate.quad(
+                sigint, kmin[i], kmax[i], args=(rloop, zloop, rbs), epsrel=1e-6)[0]
+    return sigma2r
+
+
+def sigma2_grid(R, z, rbs, kmin, kmax, kmin_overall, kmax_overall, nk):
+    """
+    sigma^2(R,z) for all R and z at once. P(k,z) is evaluated once on a
+    fixed log(k) grid, and the integral for every R is a row of a matrix of
+    window function and quadrature weights, so the whole grid is one matrix product.
+    """
+    lnk = np.linspace(kmin_overall, kmax_overall, nk)
+    k = np.exp(lnk)
+    # Grid evaluation needs sorted, unique z; map back to the order requested
+    z_unique, z_index = np.unique(z, return_inverse=True)
+    p = rbs(k, z_unique)[:, z_index]
+    weights = trapezoid_weights(lnk, kmin, kmax)
+    weights *= tophat_window_squared(np.outer(R, k)) * k**3 / (2 * np.pi**2)
+    return weights @ p
+
+
 def execute(block, config):
-    z, R, blockname, crop_klim = config
+    z, R, blockname, crop_klim, method, nk, check_quad = config
 
     karray, zarray, powerarray = block.get_grid(blockname, "k_h", "z", "p_k")
 
@@ -54,22 +122,16 @@ def execute(block, config):
     kmin_overall = np.log(karray.min())
     kmax_overall = np.log(karray.max())
 
-    kmin = kmin_overall
-    kmax = kmax_overall
+    kmin, kmax = klimits(R, kmin_overall, kmax_overall, crop_klim)
 
-    sigma2r = np.zeros((np.size(R), np.size(z)))
-    for i, rloop in enumerate(R):
-
-        if crop_klim:
-
-            kmin = max(np.log(.01 / rloop), kmin_overall)
-            kmax = min(np.log(100. / rloop), kmax_overall)
-
-        for j, zloop in enumerate(z):
-
-            sigma2r[i, j] = scipy.integrate.quad(
-                sigint, kmin, kmax, args=(rloop, zloop, rbs), epsrel=1e-6)[0]
-    section = "sigmar"
+    if method == "grid":
+        sigma2r = sigma2_grid(R, z, rbs, kmin, kmax, kmin_overall, kmax_overall, nk)
+        if check_quad:
+            sigma2r_quad = sigma2_quad(R, z, rbs, kmin, kmax)
+            print("sigma_r: maximum fractional difference between grid and quad sigma^2 = {:.2e}".format(
+                np.abs(sigma2r / sigma2r_quad - 1).max()))
+    else:
+        sigma2r = sigma2_quad(R, z, rbs, kmin, kmax)
 
     block.put_grid("sigma_r", "R", R, "z", z, "sigma2", sigma2r)
     return 0
@@ -1,13 +1,19 @@
-from cosmosis.gaussian_likelihood import GaussianLikelihood
 from cosmosis.datablock import names
 from twopoint_cosmosis import theory_names, type_table
 from astropy.io import fits
 from scipy.interpolate import interp1d
+import scipy.linalg
 import numpy as np
 import twopoint
 import gaussian_covariance
 import os
+import sys
 from spec_tools import TheorySpectrum
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "fixed_covariance"))
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
+from fixed_covariance import FixedCovarianceGaussianLikelihood
+import packed_spectra
 default_array = np.repeat(-1.0, 99)
 
 
@@ -19,9 +25,11 @@ def convert_nz_steradian(n):
     return n * (41253.0 * 60. * 60.) / (4 * np.pi)
 
 
-class TwoPointLikelihood(GaussianLikelihood):
+class TwoPointLikelihood(FixedCovarianceGaussianLikelihood):
     # This is a sub-class of the class GaussianLikelihood
     # which can be found in the file ${COSMOSIS_SRC_DIR}/cosmosis/gaussian_likelihood.py
+    # (via FixedCovarianceGaussianLikelihood in ../fixed_covariance, which
+    # uses a Cholesky factor for the chi^2 when the covariance is fixed).
     # That super-class implements the generic behaviour that all Gaussian likelihoods
     # follow - the basic form of the likelihoods, inverting covariance matrices, saving
     # results, etc.  This sub-clas does the parts that are specific to this 2-pt
@@ -172,6 +180,10 @@ class TwoPointLikelihood(GaussianLikelihood):
                 #	chi_peak =
                 #	for ang in spectrum.angle:
 
+        # Record where the points for each bin pair sit in each spectrum,
+        # so that we can extract the theory for them all at once.
+        self.build_bin_pair_indices()
+
         # build up the data vector from all the separate vectors.
         # Just concatenation
         data_vector = np.concatenate(
@@ -195,6 +207,18 @@ class TwoPointLikelihood(GaussianLikelihood):
         # determine ell/theta values
         return None, data_vector
 
+    def build_bin_pair_indices(self):
+        # For each spectrum, map each bin pair to the array of indices
+        # of its data points within that spectrum
+        self.bin_pair_indices = {}
+        for spectrum in self.two_point_data.spectra:
+            bin1 = np.asarray(spectrum.bin1)
+            bin2 = np.asarray(spectrum.bin2)
+            self.bin_pair_indices[spectrum.name] = [
+                (b1, b2, np.flatnonzero((bin1 == b1) & (bin2 == b2)))
+                for (b1, b2) in spectrum.get_bin_pairs()
+            ]
+
     def build_covariance(self):
 
         
@@ -372,56 +396,45 @@ class TwoPointLikelihood(GaussianLikelihood):
 
         # If the theory spectrum has been bin-averaged then we expect the
         # data to be so also.  We check this by ensuring that angle_min is specified
-        # Based on this, we also generate the angle argument passed to the spectrum
-        # differently.  The bin-averaged version expects a tuple angle_min and angle_max,
-        # whereas the interpolated version just wants a single angle.
-        if theory_spec.is_bin_averaged:
-            if spectrum.angle_min is None:
-                raise ValueError("Your theory pipeline produced angle-binnned values, but your data it not binned.")
-            angles = list(zip(spectrum.angle_min, spectrum.angle_max))
-        else:
-            angles = spectrum.angle
-        
-        # We store the nominal mid-points for plotting later on, etc.
-        angle_mids = spectrum.angle
+        if theory_spec.is_bin_averaged and spectrum.angle_min is None:
+            raise ValueError("Your theory pipeline produced angle-binnned values, but your data it not binned.")
 
         # This is a bit of a hack, but later on if we are making a covariance
         # we need all the splines, so pull them out here.
         bin_splines = {}
 
-        # We build up these vectors from all the data points.
         # Only the theory vector is needed for the likelihood - the others
         # are for convenience, debugging, etc.
-        theory_vector = []
-        angle_vector = []
-        bin1_vector = []
-        bin2_vector = []
+        theory_vector = np.zeros(len(spectrum.value))
+
+        # Fill in the theory vector one bin pair at a time, evaluating
+        # all the angles for that pair together.
+        for (b1, b2, index) in self.bin_pair_indices[spectrum.name]:
+            # Generate the angle argument passed to the spectrum.
+            # The bin-averaged version expects a tuple of angle_min and angle_max
+            # arrays, whereas the interpolated version just wants the angles.
+            if theory_spec.is_bin_averaged:
+                angles = (spectrum.angle_min[index], spectrum.angle_max[index])
+            else:
+                angles = spectrum.angle[index]
 
-        for (b1, b2, angle, angle_mid) in zip(spectrum.bin1, spectrum.bin2, angles, angle_mids):
             # The extra object will either be a spline (for interpolated spectra)
             # or theta mid-point values (for bin-averaged ones, e.g. for plotting)
-            theory, extra = theory_spec.get_spectrum_value(b1, b2, angle)
+            theory, extra = theory_spec.get_spectrum_values(b1, b2, angles)
 
             # We can only record the splines for non-bin-averaged values
             if not theory_spec.is_bin_averaged:
                 bin_splines[y_name.format(b1, b2)] = extra
 
-            # Build up the vector - we make this into an array later
-            theory_vector.append(theory)
-            angle_vector.append(angle_mid)
-            bin1_vector.append(b1)
-            bin2_vector.append(b2)
+            theory_vector[index] = theory
 
         self.theory_splines[section] = bin_splines
 
-        # Return the whole collection as an array
-        theory_vector = np.array(theory_vector)
-
         # For convenience we also save the angle vector (ell or theta)
-        # and bin indices
-        angle_vector = np.array(angle_vector)
-        bin1_vector = np.array(bin1_vector, dtype=int)
-        bin2_vector = np.array(bin2_vector, dtype=int)
+        # and bin indices. We store the nominal mid-points for plotting later on, etc.
+        angle_vector = np.array(spectrum.angle)
+        bin1_vector = np.array(spectrum.bin1, dtype=int)
+        bin2_vector = np.array(spectrum.bin2, dtype=int)
 
         return theory_vector, angle_vector, bin1_vector, bin2_vector
 
@@ -429,31 +442,61 @@ class TwoPointLikelihood(GaussianLikelihood):
     def extract_covariance(self, block):
         assert self.gaussian_covariance, "Set constant_covariance=F but somehow not with Gaussian covariance.  Internal error - please open an issue on the cosmosis site."
 
-        C = []
+        # Where each spectrum starts and ends in the full data vector
+        lengths = [len(spectrum) for spectrum in self.two_point_data.spectra]
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        n = ends[-1]
+
+        # We fill the matrix in place rather than stacking blocks
+        C = np.zeros((n, n))
+
         # s and t index the spectra that we have. e.g. s or t=1 might be the full set of
         # shear-shear measuremnts
         for s, AB in enumerate(self.two_point_data.spectra[:]):
-            M = []
             for t, CD in enumerate(self.two_point_data.spectra[:]):
-                print("Looking at covariance between {} and {} (s={}, t={})".format(AB.name, CD.name, s, t))
                 # We only calculate the upper triangular.
-                # Get the lower triangular here. We have to
-                # transpose it compared to the upper one.
+                # Get the lower triangular by transposing it.
                 if s > t:
-                    MI = C[t][s].T
-                else:
-                    MI = gaussian_covariance.compute_gaussian_covariance(self.sky_area,
-                                                                         self._lookup_theory_cl, block, AB, CD)
-                M.append(MI)
-            C.append(M)
-
-        # C is now a list of lists of 2D arrays.
-        # Now turn C into a big 2D array by stacking
-        # the arrays
-        C = np.vstack([np.hstack(CI) for CI in C])
+                    continue
+                print("Looking at covariance between {} and {} (s={}, t={})".format(AB.name, CD.name, s, t))
+                MI = gaussian_covariance.compute_gaussian_covariance(self.sky_area,
+                                                                     self._lookup_theory_cl, block, AB, CD)
+                C[starts[s]:ends[s], starts[t]:ends[t]] = MI
+                C[starts[t]:ends[t], starts[s]:ends[s]] = MI.T
 
         return C
 
+    def _factorize_gaussian_covariance(self):
+        # Cholesky-factorize the covariance for this sample, in a re-used
+        # workspace. This gives both the inverse and the log-determinant,
+        # so we only do it once per covariance matrix.
+        if getattr(self, "_cholesky_cov", None) is self.cov:
+            return self._cholesky_factor
+        # LAPACK works in place on Fortran-ordered arrays
+        n = len(self.cov)
+        if getattr(self, "_cholesky_workspace", None) is None or self._cholesky_workspace.shape != (n, n):
+            self._cholesky_workspace = np.zeros((n, n), order='F')
+        L = self._cholesky_workspace
+        L[:] = self.cov
+        L, lower = scipy.linalg.cho_factor(L, lower=True, overwrite_a=True, check_finite=False)
+        self._cholesky_factor = (L, lower)
+        self._cholesky_log_det = 2 * np.log(np.diag(L)).sum()
+        self._cholesky_cov = self.cov
+        return self._cholesky_factor
+
+    def extract_inverse_covariance(self, block):
+        if not self.gaussian_covariance:
+            return super(TwoPointLikelihood, self).extract_inverse_covariance(block)
+        cho = self._factorize_gaussian_covariance()
+        return scipy.linalg.cho_solve(cho, np.identity(len(self.cov)), check_finite=False)
+
+    def extract_covariance_log_determinant(self, block):
+        if not self.gaussian_covariance:
+            return super(TwoPointLikelihood, self).extract_covariance_log_determinant(block)
+        self._factorize_gaussian_covariance()
+        return self._cholesky_log_det
+
     def _lookup_theory_cl(self, block, A, B, i, j, ell):
         """
         This is a helper function for the compute_gaussian_covariance code.
@@ -484,11 +527,11 @@ class TwoPointLikelihood(GaussianLikelihood):
             # data vector - for example to got the covariance between C^EE and C^NN we need C^NE even
             # if we don't have any actual measurements of NE. In that case we have to g
             angle_theory = block[section, ell_name]
-            if block.has_value(section, name_ij):
-                theory = block[section, name_ij]
+            if packed_spectra.has_bin_pair(block, section, name_ij):
+                theory = packed_spectra.get_bin_pair(block, section, name_ij)
             # The same symmetry argument as above applies
-            elif block.has_value(section, name_ji) and A == B:
-                theory = block[section, name_ji]
+            elif packed_spectra.has_bin_pair(block, section, name_ji) and A == B:
+                theory = packed_spectra.get_bin_pair(block, section, name_ji)
             else:
                 raise ValueError("Could not find theory prediction {} in section {}".format(
                     value_name.format(i, j), section))
@@ -170,6 +170,9 @@ class TwoPointGammatMargLikelihood(twopt_like.TwoPointLikelihood):
             if spectrum.is_real_space():
                 spectrum.convert_angular_units("rad")
 
+        # Record where the points for each bin pair sit in each spectrum
+        self.build_bin_pair_indices()
+
         # build up the data vector from all the separate vectors.
         # Just concatenation
         datavector = np.concatenate(
@@ -64,56 +64,95 @@ def compute_gaussian_covariance(sky_area, get_theory_cl, block, AB, CD):
     delta_ell_AB = compute_delta_ells(AB)
     delta_ell_CD = compute_delta_ells(CD)
 
-    # Now loop through all the places where we are non-zero.
-    # The find_equal_ell thing checks if they are the same and returns
-    # the indices.
-    for x, y, ell in find_equal_ell(ell_AB, ell_CD):
-
-        i = bin1_AB[x]
-        j = bin2_AB[x]
-        k = bin1_CD[y]
-        l = bin2_CD[y]
-
-        # Now we can look the various C_ell values we want using our
-        # lookup function. This is where things will fail if, for example,
-        # we did not predict NE but want the covariance between NN and EE.
-        # This function (which is passed in as an argument) could just do
-        # a simple lookup in the block but might also use cached values
-        # as in the case we have in 2pt_like where the values have already
-        # been loaded
-        C_AC_ik = get_theory_cl(block, A, C, i, k, ell)
-        C_BD_jl = get_theory_cl(block, B, D, j, l, ell)
-        C_AD_il = get_theory_cl(block, A, D, i, l, ell)
-        C_BC_jk = get_theory_cl(block, B, C, j, k, ell)
-
-        # This is a reasonable hack. Get the delta_ell for each of the values
-        # independently and take their geometric mean. They should really
-        # just be equal for all this to make any sense.
-        #delta_ell = np.sqrt(delta_ell_AB[(i,j)](ell)*delta_ell_CD[(i,j)](ell))
-        # If this bin is not here just get any of them.
-        delta_AB = delta_ell_AB.get((i, j))
-        delta_CD = delta_ell_CD.get((i, j))
-        if delta_AB is None:
+    # Find all the places where we are non-zero, i.e. where the ell values
+    # of the two spectra are the same.
+    x, y = find_equal_ell_indices(ell_AB, ell_CD)
+    if len(x) == 0:
+        return covmat
+    ell = ell_AB[x]
+
+    # These are the tomographic bin indices of each non-zero element
+    i = bin1_AB[x]
+    j = bin2_AB[x]
+    k = bin1_CD[y]
+    l = bin2_CD[y]
+
+    # Now we can look the various C_ell values we want using our
+    # lookup function. This is where things will fail if, for example,
+    # we did not predict NE but want the covariance between NN and EE.
+    # This function (which is passed in as an argument) could just do
+    # a simple lookup in the block but might also use cached values
+    # as in the case we have in 2pt_like where the values have already
+    # been loaded.  We call it once for each distinct bin pair, on all
+    # the ell values needed for that pair.
+    C_AC_ik = _theory_cl_for_pairs(get_theory_cl, block, A, C, i, k, ell)
+    C_BD_jl = _theory_cl_for_pairs(get_theory_cl, block, B, D, j, l, ell)
+    C_AD_il = _theory_cl_for_pairs(get_theory_cl, block, A, D, i, l, ell)
+    C_BC_jk = _theory_cl_for_pairs(get_theory_cl, block, B, C, j, k, ell)
+
+    # This is a reasonable hack. Get the delta_ell for each of the values
+    # independently and take their geometric mean. They should really
+    # just be equal for all this to make any sense.
+    # If this bin is not here just get any of them.
+    delta_AB = np.zeros(len(ell))
+    delta_CD = np.zeros(len(ell))
+    pairs, index = _unique_pairs(i, j)
+    for p, (bi, bj) in enumerate(pairs):
+        w = index == p
+        delta_AB_ij = delta_ell_AB.get((bi, bj))
+        delta_CD_ij = delta_ell_CD.get((bi, bj))
+        if delta_AB_ij is None:
             warnings.warn(
                 "There are no delta-ell values for some combinations of ({},{}).".format(A, B))
-            delta_AB = list(delta_ell_AB.values())[0]
-        if delta_CD is None:
+            delta_AB_ij = list(delta_ell_AB.values())[0]
+        if delta_CD_ij is None:
             warnings.warn(
                 "There are no delta-ell values for some combinations ({},{}).".format(C, D))
-            delta_CD = list(delta_ell_CD.values())[0]
-
-        delta_AB = delta_AB(ell)
-        delta_CD = delta_CD(ell)
+            delta_CD_ij = list(delta_ell_CD.values())[0]
+        delta_AB[w] = delta_AB_ij(ell[w])
+        delta_CD[w] = delta_CD_ij(ell[w])
 
-        delta_ell = np.sqrt(delta_AB * delta_CD)
+    delta_ell = np.sqrt(delta_AB * delta_CD)
 
-        # The pre-factor.
-        p = 2. * np.pi / (ell * delta_ell * sky_area)
-        covmat[x, y] = p * (C_AC_ik * C_BD_jl + C_AD_il * C_BC_jk)
+    # The pre-factor.
+    p = 2. * np.pi / (ell * delta_ell * sky_area)
+    covmat[x, y] = p * (C_AC_ik * C_BD_jl + C_AD_il * C_BC_jk)
 
     return covmat
 
 
+def _unique_pairs(b1, b2):
+    """
+    Find the distinct (b1, b2) pairs among two arrays of bin indices.
+    Returns the list of pairs and, for each element, the index of its pair.
+    """
+    pairs, index = np.unique(np.column_stack([b1, b2]), axis=0, return_inverse=True)
+    return [tuple(pair) for pair in pairs], index.ravel()
+
+
+def _theory_cl_for_pairs(get_theory_cl, block, X, Y, b1, b2, ell):
+    """
+    Evaluate get_theory_cl for arrays of bin indices b1, b2 and ell values,
+    calling it once per distinct bin pair.
+    """
+    output = np.zeros(len(ell))
+    pairs, index = _unique_pairs(b1, b2)
+    for p, (bi, bj) in enumerate(pairs):
+        w = index == p
+        output[w] = get_theory_cl(block, X, Y, bi, bj, ell[w])
+    return output
+
+
+def find_equal_ell_indices(ell_1, ell_2):
+    """
+    Vectorized version of find_equal_ell. Returns index arrays x, y
+    of all the places where ell_1[x] == ell_2[y], in the same order.
+    """
+    ell_1 = np.asarray(ell_1)
+    ell_2 = np.asarray(ell_2)
+    return np.nonzero(ell_1[:, np.newaxis] == ell_2[np.newaxis, :])
+
+
 def find_equal_ell(ell_1, ell_2):
     n_1 = len(ell_1)
     n_2 = len(ell_2)
@@ -133,12 +172,11 @@ def extrap1d(interpolator):
     ys = interpolator.y
 
     def pointwise(x):
-        if x < xs[0]:
-            return ys[0] + (x - xs[0]) * (ys[1] - ys[0]) / (xs[1] - xs[0])
-        elif x > xs[-1]:
-            return ys[-1] + (x - xs[-1]) * (ys[-1] - ys[-2]) / (xs[-1] - xs[-2])
-        else:
-            return interpolator(x)
+        x = np.asarray(x)
+        below = ys[0] + (x - xs[0]) * (ys[1] - ys[0]) / (xs[1] - xs[0])
+        above = ys[-1] + (x - xs[-1]) * (ys[-1] - ys[-2]) / (xs[-1] - xs[-2])
+        inside = interpolator(np.clip(x, xs[0], xs[-1]))
+        return np.where(x < xs[0], below, np.where(x > xs[-1], above, inside))
 
     return pointwise
 
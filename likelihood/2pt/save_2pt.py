@@ -202,6 +202,7 @@ def setup(options):
             config['upsample_cov'] = None
         config['ell_max'] = options.get_int(option_section, "ell_max")
         config['high_l_filter'] = options.get_double(option_section, "high_l_filter", 0.75)
+        config['n_processes'] = options.get_int(option_section, "n_processes", 1)
 
     # name of the output file and whether to overwrite it.
     config['filename'] = options.get_string(option_section, "filename")
@@ -401,7 +402,8 @@ def execute(block, config):
                 cl_theory_spec_list, config['cl_to_xi_types'], 
                 config['ell_max'], config['angle_lims'], 
                 upsample=config['upsample_cov'], 
-                high_l_filter = config['high_l_filter'] )
+                high_l_filter = config['high_l_filter'],
+                n_processes = config['n_processes'] )
             covmat_info = twopoint.CovarianceMatrixInfo( 'COVMAT', [s.name for s in spec_meas_list], 
                                                          xi_lengths, covmat )
 
@@ -11,11 +11,22 @@ import os
 dirname = os.path.split(__file__)[0]
 fullsky_path = os.path.join(dirname,"..","..","shear","cl_to_xi_fullsky")
 sys.path.append(fullsky_path)
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
 import legendre
+import packed_spectra
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 CL2XI_TYPES=["00","02+","22+","22-"]
 
+#Module-level rather than lambdas, so that SpectrumInterp objects can be
+#pickled and sent to other processes
+def _minus_exp(y):
+    return -np.exp(y)
+
+def _identity(y):
+    return y
+
 """
 Class for interpolating spectra
 """
@@ -48,13 +59,13 @@ class SpectrumInterp(object):
                 np.log(angle), np.log(-spec), bounds_error=bounds_error, fill_value=-np.inf)
             self.interp_type = 'minus_loglog'
             self.x_func = np.log
-            self.y_func = lambda y: -np.exp(y)
+            self.y_func = _minus_exp
         else:
             self.interp_func = interp1d(
                 np.log(angle), spec, bounds_error=bounds_error, fill_value=0.)
             self.interp_type = "log_ang"
             self.x_func = np.log
-            self.y_func = lambda y: y
+            self.y_func = _identity
 
     def __call__(self, angle):
         non_zero = angle>1.e-12
@@ -176,9 +187,23 @@ class TheorySpectrum(object):
                         bin_pairs.append((i,j))
 
 
+        # If the section has all the bin pairs in one array
+        # we can read them in one go.
+        packed = packed_spectra.has_packed(block, section_name)
+        if packed:
+            values, mask = packed_spectra.get_packed(block, section_name)
+
         # now load from the block.
         spectra = OrderedDict()
         for (i,j) in bin_pairs:
+            if packed:
+                a, b = packed_spectra.bin_indices(bin_format.format(i, j))
+                if is_auto and not mask[a, b]:
+                    a, b = b, a
+                if mask[a, b]:
+                    spectra[(i, j)] = values[a, b]
+                    continue
+
             bin_name = bin_format.format(i, j)
             if is_auto and not block.has_value(section_name, bin_name):
                 bin_name = bin_format.format(j, i)
@@ -328,6 +353,31 @@ class BinAveragedTheorySpectrum(TheorySpectrum):
         # Also return the angle valuues
         return spectrum_value, mid_angle
 
+    def get_spectrum_values(self, bin1, bin2, angles):
+        """
+        Vectorized version of get_spectrum_value, for many angular bins
+        of the same bin pair at once.
+        angles: tuple of arrays (angle_min, angle_max) in radians.
+        """
+        angle_min, angle_max = angles
+        angle_min = np.atleast_1d(angle_min)
+        angle_max = np.atleast_1d(angle_max)
+
+        i, j = self.bin_pair_from_bin1_bin2(bin1, bin2)
+
+        # Find correct indices
+        bin_index = np.argmin(abs(angle_min[:, np.newaxis] - self.angle_mins), axis=1)
+        ok = (np.isclose(self.angle_mins[bin_index], angle_min, rtol=1e-9, atol=0)
+            & np.isclose(self.angle_maxs[bin_index], angle_max, rtol=1e-9, atol=0))
+        if not ok.all():
+            bad = np.flatnonzero(~ok)[0]
+            raise ValueError("Desired angle bin {} - {} not computed".format(angle_min[bad], angle_max[bad]))
+
+        spectrum_values = self.spectra[(i,j)][bin_index]
+        mid_angles = self.angles[bin_index]
+
+        return spectrum_values, mid_angles
+
 
 class InterpolatedTheorySpectrum(TheorySpectrum):
     is_bin_averaged = False
@@ -372,7 +422,23 @@ class InterpolatedTheorySpectrum(TheorySpectrum):
 
         return spec_sample, spline
 
+    def get_spectrum_values(self, bin1, bin2, angles):
+        """
+        Vectorized version of get_spectrum_value, evaluating the spline
+        for a bin pair at an array of angles in one go.
+        """
+        i, j = self.bin_pair_from_bin1_bin2(bin1, bin2)
+        spline = self.get_spline(i, j)
+
+        try:
+            spec_sample = spline(np.array(angles, dtype=float))
+        except ValueError:
+            raise ValueError("""
+                Tried to get theory prediction for {} {}, but ell or theta values ({} - {}) were out of range.
+                "Maybe increase the range when computing/projecting or check units?""".format(
+                    self.name, (bin1, bin2), np.min(angles), np.max(angles)))
 
+        return spec_sample, spline
 
 
     def get_noise_spec_values( self, bin1, bin2, angle ):
@@ -384,7 +450,7 @@ class InterpolatedTheorySpectrum(TheorySpectrum):
         return noise
 
     def get_obs_spec_values( self, bin1, bin2, angle ):
-        spec_vals = np.array([self.get_spectrum_value(bin1, bin2, a)[0] for a in angle])
+        spec_vals, _ = self.get_spectrum_values(bin1, bin2, angle)
         noise = self.get_noise_spec_values( bin1, bin2, angle )
         return spec_vals + noise
 
@@ -449,6 +515,9 @@ class ClCov( object ):
         self.types = [ t.types for t in self.theory_spectra ]
         self.names = [t.name for t in self.theory_spectra ]
         self.fsky = fsky
+        #Observed and noise C(l)s we have already evaluated, since
+        #each one is needed for many covariance blocks
+        self.c_ell_cache = {}
 
     def get_cov_diag_ijkl( self, name1, name2, ij, kl, ell_max, ell_min=0, noise_only=False):
         # From Joachimi & Bridle 2010 0911.2454
@@ -492,12 +561,14 @@ class ClCov( object ):
                 #we are accessing e.g. C^{ik}_{13} via C^{ki}_{31}.
                 types = (types[1], types[0])
                 bin1, bin2 = bin2, bin1
-            s = self.theory_spectra[ self.types.index( types ) ]
-            if noise_only:
-                c_ells.append(s.get_noise_spec_values( bin1, bin2, ells ))
-            else:
-                c_ells.append(s.get_obs_spec_values( bin1, bin2, ells ))
-        #print(ret)
+            key = (types, bin1, bin2, noise_only, np.asarray(ells).tobytes())
+            if key not in self.c_ell_cache:
+                s = self.theory_spectra[ self.types.index( types ) ]
+                if noise_only:
+                    self.c_ell_cache[key] = s.get_noise_spec_values( bin1, bin2, ells )
+                else:
+                    self.c_ell_cache[key] = s.get_obs_spec_values( bin1, bin2, ells )
+            c_ells.append(self.c_ell_cache[key])
         return c_ells[0]*c_ells[1] + c_ells[2]*c_ells[3]
 
     def get_binned_cl_cov( self, ell_lims, noise_only=False):
@@ -523,49 +594,46 @@ class ClCov( object ):
         for i in range(n_spectra):
             cl_starts.append( int(sum(cl_lengths[:i])) )
 
-        #Now loop through pairs of Cls and pairs of bin pairs filling the covariance matrix
+        #The measured C(l) in each ell bin is the (2l+1)-weighted average,
+        #so Var(binned_cl) = \sum_l w_l^2 Var(C(l)) / (\sum_l w_l)^2
+        #where w_l = 2*l+1.  We do the sums for all the bins at once
+        #with reduceat, starting from the index of each bin's lower limit.
+        ell_lims = np.asarray(ell_lims).astype(int)
+        ell_vals = np.arange(ell_lims[0], ell_lims[-1])
+        w = 2*ell_vals+1
+        bin_starts = np.minimum(ell_lims[:-1] - ell_lims[0], max(len(ell_vals)-1, 0))
+        empty_bins = ell_lims[1:] == ell_lims[:-1]
+        sum_w = np.where(empty_bins, 0, np.add.reduceat(w, bin_starts))
+
+        #Now loop through pairs of Cls, doing all their pairs of bin pairs together
         for i_cl in range(n_spectra):
             cl_spec_i = self.theory_spectra[i_cl]
             for j_cl in range(i_cl, n_spectra):
                 cl_spec_j = self.theory_spectra[j_cl]
-                cov_blocks = {} #collect cov_blocks in this dictionary
-                for i_bp, bin_pair_i in enumerate(cl_spec_i.bin_pairs):
-                    for j_bp, bin_pair_j in enumerate(cl_spec_j.bin_pairs):
-                        print(f"Computing covariance {i_cl},{j_cl} pairs <{bin_pair_i} {bin_pair_j}>")
-                        #First check if we've already calculated this
-                        if (i_cl == j_cl) and cl_spec_i.is_auto and ( j_bp < i_bp ):
-                            cl_var_binned = cov_blocks[j_bp, i_bp]
-                        else:
-                            #First calculate the unbinned Cl covariance
-                            ell_max = ell_lims[-1]
-                            cl_var_unbinned = self.get_cov_diag_ijkl( cl_spec_i.name, 
-                                cl_spec_j.name, bin_pair_i, bin_pair_j, ell_max, 
-                                ell_min=ell_lims[0], noise_only=noise_only )
-                            #Now bin this diaginal covariance
-                            #Var(binned_cl) = \sum_l Var(w_l^2 C(l)) / (\sum_l w_l)^2
-                            #where w_l = 2*l+1
-                            cl_var_binned = np.zeros(n_ell)
-                            for ell_bin, (ell_low, ell_high) in enumerate(zip(ell_lims[:-1], ell_lims[1:])):
-                                #Get the ell values for this bin:
-                                ell_vals_bin = np.arange(ell_low, ell_high).astype(int)
-                                #Get the indices in cl_var_binned these correspond to:
-                                ell_vals_bin_inds = ell_vals_bin - ell_lims[0]
-                                cl_var_unbinned_bin = cl_var_unbinned[ell_vals_bin_inds]
-                                cl_var_binned[ell_bin] = np.sum((2*ell_vals_bin+1)**2 * 
-                                    cl_var_unbinned_bin) / np.sum(2*ell_vals_bin+1)**2
-
-                            cov_blocks[i_bp, j_bp] = cl_var_binned
-
-                        #Now work out where this goes in the full covariance matrix
-                        #and add it there.
-                        inds_i = np.arange( cl_starts[i_cl] + n_ell*i_bp, 
-                            cl_starts[i_cl] + n_ell*(i_bp+1) )
-                        inds_j = np.arange( cl_starts[j_cl] + n_ell*j_bp, 
-                            cl_starts[j_cl] + n_ell*(j_bp+1) )
-                        cov_inds = np.ix_( inds_i, inds_j )
-                        covmat[ cov_inds ] = np.diag(cl_var_binned)
-                        cov_inds_T = np.ix_( inds_j, inds_i )
-                        covmat[ cov_inds_T ] = np.diag(cl_var_binned)
+                #Blocks with j_bp < i_bp for an auto-correlation are the transpose
+                #of ones we already have, which is the same for these diagonal blocks
+                combos = [ (i_bp, j_bp) for i_bp in range(len(cl_spec_i.bin_pairs))
+                    for j_bp in range(len(cl_spec_j.bin_pairs))
+                    if not ((i_cl == j_cl) and cl_spec_i.is_auto and ( j_bp < i_bp )) ]
+                print(f"Computing covariance {cl_spec_i.name} x {cl_spec_j.name}: {len(combos)} bin pair combinations")
+
+                #First calculate the unbinned Cl covariances
+                cl_var_unbinned = np.array([ self.get_cov_diag_ijkl( cl_spec_i.name,
+                    cl_spec_j.name, cl_spec_i.bin_pairs[i_bp], cl_spec_j.bin_pairs[j_bp], ell_max,
+                    ell_min=ell_lims[0], noise_only=noise_only )[:len(ell_vals)] for (i_bp, j_bp) in combos ])
+
+                #Now bin these diagonal covariances
+                sum_w2_var = np.add.reduceat(w**2 * cl_var_unbinned, bin_starts, axis=1)
+                sum_w2_var[:, empty_bins] = 0.
+                cl_var_binned = sum_w2_var / sum_w**2
+
+                #Now work out where these go in the full covariance matrix
+                #and add them there, and their transposes.
+                i_bp, j_bp = np.array(combos).T
+                inds_i = (cl_starts[i_cl] + n_ell*i_bp)[:, np.newaxis] + np.arange(n_ell)
+                inds_j = (cl_starts[j_cl] + n_ell*j_bp)[:, np.newaxis] + np.arange(n_ell)
+                covmat[ inds_i, inds_j ] = cl_var_binned
+                covmat[ inds_j, inds_i ] = cl_var_binned
 
         print("Completed covariance")
         print("   Signed log det:", np.linalg.slogdet(covmat))
@@ -573,11 +641,92 @@ class ClCov( object ):
         return covmat, cl_lengths
 
 
+def downsample_weights( angle_lims_orig, angle_mids_orig, n_out ):
+    """
+    The (n_out, n_orig) matrix W that averages values on a fine angular grid
+    into n_out coarse bins, with the same weighting as downsample_block, so that
+    the downsampled covariance is W cov W^T.
+    """
+    dtheta = angle_lims_orig[1:]-angle_lims_orig[:-1]
+    n_orig = len(angle_mids_orig)
+    assert n_orig%n_out == 0
+    norig_per_nout = n_orig//n_out
+    weights = (angle_mids_orig * dtheta).reshape(n_out, norig_per_nout)
+    weights = weights / weights.sum(axis=1)[:, np.newaxis]
+    W = np.zeros( (n_out, n_orig) )
+    for i in range(n_out):
+        W[i, i*norig_per_nout:(i+1)*norig_per_nout] = weights[i]
+    return W
+
+
+def _real_space_cov_group( cl_cov, name_i, name_j, bin_pair_combos, ell_max, F_i, F_j,
+    noise_factor, angle_mids_rad, dangle, noise_only=False, max_chunk_elements=2**24 ):
+    """
+    Compute the real-space covariance blocks for a list of (bin_pair_i, bin_pair_j)
+    combinations of two spectra that share the transforms F_i and F_j, which
+    should already include any downsampling.
+
+    Returns an array of blocks with shape (n_combo, n_theta, n_theta).
+    """
+    n_combo = len(bin_pair_combos)
+    n_theta = F_i.shape[0]
+    n_ell = F_i.shape[1]
+
+    #Get the full cl covariance, and the pure noise part - we're going to transform
+    #the latter analytically...
+    cl_cov_signal_mixed = np.zeros((n_combo, n_ell))
+    noise = np.zeros(n_combo)
+    for c, (bin_pair_i, bin_pair_j) in enumerate(bin_pair_combos):
+        cl_cov_block = cl_cov.get_cov_diag_ijkl( name_i, name_j, bin_pair_i, bin_pair_j,
+            ell_max, noise_only=noise_only )
+        cl_cov_noise_noise = cl_cov.get_cov_diag_ijkl( name_i, name_j, bin_pair_i, bin_pair_j,
+            ell_max, noise_only=True )
+        cl_cov_signal_mixed[c] = cl_cov_block - cl_cov_noise_noise
+        noise[c] = cl_cov_noise_noise[0] #This is 2*cl_noise^2/fsky.
+
+    #Each block is F_i diag(cl_cov) F_j^T; scaling the columns of F_i
+    #avoids building the diagonal matrix, and we do as many combinations
+    #at once as fit in max_chunk_elements.
+    xi_cov_blocks = np.zeros((n_combo, n_theta, n_theta))
+    chunk = max(1, max_chunk_elements // (n_theta * n_ell))
+    for c in range(0, n_combo, chunk):
+        scaled_F_i = F_i[np.newaxis, :, :] * cl_cov_signal_mixed[c:c+chunk, np.newaxis, :]
+        xi_cov_blocks[c:c+chunk] = np.matmul(scaled_F_i, F_j.T)
+
+    #For the analytic calculation, we use the fact that 
+    #\int l J_nu(l theta) J_nu(l theta) = 1/theta.
+    #The noise term is 
+    #(1/4 pi^2) \int dtheta \int l J_nu(l theta) J_nu(l theta) * noise = noise / theta / 4pi^2
+    #For gg, npairs = pi*theta*dtheta*n_gal^2*area = 4*pi^2*fsky*n_gal^2*theta*dtheta
+    # cl_noise = 1./n_gal^2, so npairs = 4 * pi^2 * theta * dtheta / (cl_noise^2 / fsky)
+    # = 8 * pi^2 * theta * dtheta / (2 * cl_noise^2 / fsky)
+    # = 8 * pi^2 * theta * dtheta / noise
+    diag = np.arange(n_theta)
+    xi_cov_blocks[:, diag, diag] += ( (noise_factor * noise)[:, np.newaxis]
+        / angle_mids_rad / (8*np.pi*np.pi) / dangle )
+    return xi_cov_blocks
+
+
+#The ClCov object used by the worker processes in real_space_cov.
+#It is sent to each process once when the pool starts, rather than with every task.
+_pool_cl_cov = None
+
+def _init_real_space_cov_pool(cl_cov):
+    global _pool_cl_cov
+    _pool_cl_cov = cl_cov
+
+def _real_space_cov_pool_task(args):
+    return _real_space_cov_group(_pool_cl_cov, *args)
+
+
 def real_space_cov( cl_cov, cl_specs, cl2xi_types, ell_max, angle_lims_rad, 
-    upsample=None, high_l_filter=0.75, noise_only=False ):
+    upsample=None, high_l_filter=0.75, noise_only=False, n_processes=1 ):
     """
     Compute real space covariance given cl covariance
     Add cov blocks to a dictionary with keys: spec_index_i spec_index_j binpair_index_i binpair_index_j
+
+    All the bin pair combinations for each pair of spectra are computed together;
+    if n_processes > 1 the pairs of spectra are shared out among a pool of processes.
     """
     cov_blocks = {}
     ntheta = len(angle_lims_rad) - 1
@@ -599,70 +748,70 @@ def real_space_cov( cl_cov, cl_specs, cl2xi_types, ell_max, angle_lims_rad,
         angle_lims_rad_upsampled = angle_lims_rad
         angle_mids_rad_upsampled = np.exp( log_angle_mids_rad )
 
-    for i_xi in range(len(cl2xi_types)):
-        cl2xi_i = cl2xi_types[i_xi]
-        cl_spec_i = cl_specs[i_xi]
+    #Downsampling the upsampled covariance is linear, so we fold it into the
+    #transform for each cl2xi type, which we only need to compute once.
+    W = downsample_weights( angle_lims_rad_upsampled, angle_mids_rad_upsampled, ntheta )
+    transforms = {}
+    for cl2xi in cl2xi_types:
+        if cl2xi not in transforms:
+            F_l = legendre.get_F_theta_l(angle_mids_rad_upsampled, ell_max, cl2xi, high_l_filter=high_l_filter)
+            transforms[cl2xi] = np.matmul(W, F_l)
 
-        F_i_l = legendre.get_F_theta_l(angle_mids_rad_upsampled, ell_max, cl2xi_i, high_l_filter=high_l_filter)
+    for i_xi in range(len(cl2xi_types)):
         #Record datavector lengths
         xi_starts.append(n_dv)
-        n_dv += len(cl_spec_i.bin_pairs)*ntheta
+        n_dv += len(cl_specs[i_xi].bin_pairs)*ntheta
         xi_lengths.append( n_dv - xi_starts[i_xi] )
 
+    #Collect the bin pair combinations for each pair of spectra.
+    #We've already done a combination if its an auto-correlation i.e. i_xi==j_xi and
+    #j_bp is less than i_bp, so we skip those.
+    groups = []
+    tasks = []
+    for i_xi in range(len(cl2xi_types)):
+        cl2xi_i = cl2xi_types[i_xi]
+        cl_spec_i = cl_specs[i_xi]
         for j_xi in range(i_xi, len(cl2xi_types)):
             cl2xi_j = cl2xi_types[j_xi]
             cl_spec_j = cl_specs[ j_xi ]
-            if j_xi==i_xi:
-                F_j_l = F_i_l
-            else:
-                F_j_l = legendre.get_F_theta_l(angle_mids_rad_upsampled, ell_max, cl2xi_j, high_l_filter=high_l_filter)
-            #Now loop through bin pairs for each spectrum
-            #The calculation for each pair of bin_pairs is done via matrix multiplication...maybe
-            #we could speed things up by replacing the below for loops with more matrix multiplication,
-            #although it may be that the slow part is calculating the Cls, for which we need 
-            #for loops anyway...
+            combos = []
             for i_bp, bin_pair_i in enumerate(cl_spec_i.bin_pairs):
                 for j_bp, bin_pair_j in enumerate(cl_spec_j.bin_pairs):
-                    print(i_xi, j_xi, bin_pair_i, bin_pair_j)
-                    print(cl_spec_i.name, cl_spec_j.name)
-                    #Check if we've already done this combo
-                    #We've already done it if its an auto-correlation i.e. i_xi==j_xi and
-                    #j_bp is less than i_bp 
                     if (i_xi == j_xi) and cl_spec_i.is_auto and ( j_bp < i_bp ):
-                        xi_cov_block = cov_blocks[i_xi, j_xi, j_bp, i_bp]
-                    else:
-                        #Get the full cl covariance, and the pure noise part - we're going to transform
-                        #the latter analytically...
-                        cl_cov_block = cl_cov.get_cov_diag_ijkl( cl_spec_i.name, 
-                            cl_spec_j.name, bin_pair_i, bin_pair_j, ell_max, 
-                            noise_only=noise_only )
-                        cl_cov_noise_noise = cl_cov.get_cov_diag_ijkl( cl_spec_i.name, 
-                            cl_spec_j.name, bin_pair_i, bin_pair_j, ell_max, noise_only=True )
-                        cl_cov_block_signal_mixed = cl_cov_block - cl_cov_noise_noise 
-                        xi_cov_block_signal_mixed_upsampled = np.matmul( F_i_l, 
-                                                              np.matmul( np.diag(cl_cov_block_signal_mixed), 
-                                                              F_j_l.T ) )
-                        #For the analytic calculation, we use the fact that 
-                        #\int l J_nu(l theta) J_nu(l theta) = 1/theta.
-                        #The noise term is 
-                        #(1/4 pi^2) \int dtheta \int l J_nu(l theta) J_nu(l theta) * noise = noise / theta / 4pi^2
-                        noise = cl_cov_noise_noise[0] #This is 2*cl_noise^2/fsky. 
-                        #if shear-shear, we need to multiply this noise by 2, since we have noise from both E and B-modes.
-                        #Feel like a hack adding it at this stage...maybe there is a more motivated way...
-                        if (cl2xi_i==cl2xi_j) and (cl2xi_i in ["22+","22-"]):
-                            noise *= 2
-                        else:
-                            assert cl2xi_i in CL2XI_TYPES
-
-                        #For gg, npairs = pi*theta*dtheta*n_gal^2*area = 4*pi^2*fsky*n_gal^2*theta*dtheta
-                        # cl_noise = 1./n_gal^2, so npairs = 4 * pi^2 * theta * dtheta / (cl_noise^2 / fsky)
-                        # = 8 * pi^2 * theta * dtheta / (2 * cl_noise^2 / fsky)
-                        # = 8 * pi^2 * theta * dtheta / noise
-                        xi_cov_block_noise_noise_diag = (noise/angle_mids_rad/(8*np.pi*np.pi)/dangle )
-                        xi_cov_block_signal_mixed, angle_mids = downsample_block( angle_lims_rad_upsampled, 
-                            angle_mids_rad_upsampled, xi_cov_block_signal_mixed_upsampled, ntheta )
-                        xi_cov_block = xi_cov_block_signal_mixed + np.diag(xi_cov_block_noise_noise_diag)
-                    cov_blocks[i_xi, j_xi, i_bp, j_bp] = xi_cov_block
+                        continue
+                    combos.append((i_bp, j_bp))
+            #if shear-shear, we need to multiply the noise by 2, since we have noise from both E and B-modes.
+            #Feel like a hack adding it at this stage...maybe there is a more motivated way...
+            if (cl2xi_i==cl2xi_j) and (cl2xi_i in ["22+","22-"]):
+                noise_factor = 2.
+            else:
+                assert cl2xi_i in CL2XI_TYPES
+                noise_factor = 1.
+            print("Computing real space covariance for {} x {}: {} bin pair combinations".format(
+                cl_spec_i.name, cl_spec_j.name, len(combos)))
+            groups.append((i_xi, j_xi, combos))
+            bin_pair_combos = [ (cl_spec_i.bin_pairs[i_bp], cl_spec_j.bin_pairs[j_bp]) for (i_bp, j_bp) in combos ]
+            tasks.append((cl_spec_i.name, cl_spec_j.name, bin_pair_combos, ell_max,
+                transforms[cl2xi_i], transforms[cl2xi_j], noise_factor, angle_mids_rad, dangle, noise_only))
+
+    if n_processes > 1:
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_real_space_cov_pool,
+            initargs=(cl_cov,)) as pool:
+            results = list(pool.map(_real_space_cov_pool_task, tasks))
+    else:
+        results = [_real_space_cov_group(cl_cov, *task) for task in tasks]
+
+    #Put the blocks in the same order as we would have looping over
+    #bin pairs, re-using the ones we skipped above
+    for (i_xi, j_xi, combos), xi_cov_blocks in zip(groups, results):
+        group_blocks = dict(zip(combos, xi_cov_blocks))
+        cl_spec_i = cl_specs[i_xi]
+        for i_bp in range(len(cl_spec_i.bin_pairs)):
+            for j_bp in range(len(cl_specs[j_xi].bin_pairs)):
+                if (i_xi == j_xi) and cl_spec_i.is_auto and ( j_bp < i_bp ):
+                    cov_blocks[i_xi, j_xi, i_bp, j_bp] = cov_blocks[i_xi, j_xi, j_bp, i_bp]
+                else:
+                    cov_blocks[i_xi, j_xi, i_bp, j_bp] = group_blocks[i_bp, j_bp]
 
     #construct full covariance
     covmat = np.zeros((n_dv, n_dv))
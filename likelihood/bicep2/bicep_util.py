@@ -258,22 +258,53 @@ def calc_vecp(l, C_l_hat, C_fl, C_l):
     return X
 
 
+def sqrtm_symmetric(mats):
+    # Square roots of a stack of symmetric positive-definite matrices,
+    # via their eigendecompositions. Also returns the inverse square roots.
+    w, v = LA.eigh(mats)
+    vt = np.swapaxes(v, -1, -2)
+    sqrt_w = np.sqrt(w)[..., np.newaxis, :]
+    return np.matmul(v * sqrt_w, vt), np.matmul(v / sqrt_w, vt)
+
+
+def calc_vecp_all(C_l_hat, C_fl, C_l):
+    # The same as calc_vecp, but for all the l bins at once, using stacked
+    # eigendecompositions of the (symmetric) bandpower matrices.
+    # Returns an array of shape (nbin, dim*(dim+1)/2)
+    C_fl_12, _ = sqrtm_symmetric(C_fl)
+    _, C_l_inv_12 = sqrtm_symmetric(C_l)
+
+    res = np.matmul(C_l_inv_12, np.matmul(C_l_hat, C_l_inv_12))
+    d, u = LA.eigh(res)
+
+    # g(x) applied to the eigenvalues, equation 10 in Barkats et al
+    gd = np.sign(d - 1) * np.sqrt(2 * (d - np.log(d) - 1))
+    # Argument of vecp in equation 8
+    X = np.matmul(u * gd[..., np.newaxis, :], np.swapaxes(u, -1, -2))
+    X = np.matmul(C_fl_12, np.matmul(X, C_fl_12))
+    # This is the vector of equation 7
+    rows, cols = vecp_indices(X.shape[-1])
+    return X[..., rows, cols]
+
+
 # def g(x):
 #    #  sign(x-1) \sqrt{ 2(x-ln(x) -1 }
 #    return np.sign(x-1) * np.sqrt( 2* (x - np.log(x) -1) )
 
+def vecp_indices(dim):
+    # The (row, column) indices of the elements that vecp takes, in order:
+    # the main diagonal, then each successive upper diagonal
+    rows = np.concatenate([np.arange(dim - iDiag) for iDiag in range(dim)])
+    cols = np.concatenate([np.arange(iDiag, dim) for iDiag in range(dim)])
+    return rows, cols
+
+
 def vecp(mat):
     # This returns the unique elements of a symmetric matrix
     # 2014-02-11 now mirrors matlab vecp.m
 
-    dim = mat.shape[0]
-
-    vec = np.zeros((dim * (dim + 1) // 2))
-    counter = 0
-    for iDiag in range(0, dim):
-        vec[counter:counter + dim - iDiag] = np.diag(mat, iDiag)
-
-        counter = counter + dim - iDiag
+    rows, cols = vecp_indices(mat.shape[0])
+    vec = np.real(mat[rows, cols])
 
     return vec
 
@@ -282,17 +313,10 @@ def vecp(mat):
 
 
 def evaluateLikelihood(C_l, C_l_hat, C_fl, M_inv):
-    logL = 0
-    # Calculate X vector (Eq 8) for each l, lp
-    for l in range(0, 9):
-        X = calc_vecp(l, C_l_hat, C_fl, C_l)
-        for lp in range(0, 9):
-            # print l, lp, r
-            Xp = calc_vecp(lp, C_l_hat, C_fl, C_l)
-            M_inv_pp = M_inv[l, lp, :, :]
-            # calculate loglikelihood (Eq 7)
-            thislogL = (-0.5) * np.dot(X, np.dot(M_inv_pp, Xp))
-            logL = logL + thislogL
+    # Calculate X vector (Eq 8) for all l at once
+    X = calc_vecp_all(C_l_hat, C_fl, C_l)
+    # calculate loglikelihood (Eq 7), summed over all l, lp
+    logL = (-0.5) * np.einsum('li,lpij,pj->', X, M_inv, X)
 
     if np.isnan(logL):
         logL = -1e20
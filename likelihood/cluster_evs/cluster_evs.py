@@ -4,7 +4,7 @@ from cosmosis.datablock import names as section_names
 from cosmosis.datablock import option_section
 import scipy.integrate
 from math import log10, floor
-from scipy.interpolate import UnivariateSpline, RectBivariateSpline, SmoothBivariateSpline
+from scipy.interpolate import UnivariateSpline, RectBivariateSpline, SmoothBivariateSpline, make_interp_spline
 
 cosmo = section_names.cosmological_parameters
 clusters = section_names.clusters
@@ -24,7 +24,13 @@ def setup(options):
     Mmax = options.get_double(section, "M_max", default=2.e15)
     n_m = options.get_int(section, "n_M", default=100)
     minput = np.logspace(np.log10(Mmin), np.log10(Mmax), n_m)
-    return (feedback, redshift, frac, minput, output_pdf)
+    method = options.get_string(section, "method", default="quad")
+    if method not in ["quad", "grid"]:
+        raise ValueError("method in cluster_evs should be 'quad' or 'grid'")
+    n_z_grid = options.get_int(section, "n_z_grid", default=201)
+    n_M_grid = options.get_int(section, "n_M_grid", default=2000)
+    grid = (method == "grid", n_z_grid, n_M_grid)
+    return (feedback, redshift, frac, minput, output_pdf, grid)
 
 
 def massfunction(m, zz, rbs):
@@ -56,9 +62,46 @@ def dVcdz(z, omega_matter, h0, interp_da):
     return c_light / (h0 * 100.0) * (da_z**2) * (1.0 + z)**2 / (np.sqrt(omega_matter * (1.0 + z)**3 + (1.0 - omega_matter))) * (h0**3)
 
 
+class MassFunctionTable(object):
+    """
+    The number of clusters between zmin and zmax above a mass M, and its
+    density in M, tabulated once on a grid of (z, log M) for all the masses
+    we need, instead of with nested integrals per mass.
+    """
+    def __init__(self, zmin, zmax, Mmin, Mmax, omega_matter, h0, interp_da, rbs, n_z, n_M):
+        self.z = np.linspace(zmin, zmax, n_z)
+        self.logm = np.linspace(np.log(Mmin), np.log(Mmax), n_M)
+        self.dvdz = dVcdz(self.z, omega_matter, h0, interp_da)
+        # massfunction rounds z to two decimal places; we do the same
+        self.z_mf = np.round(self.z, 2)
+        self.rbs = rbs
+        # dV/dz * dn/dlnM on the grid, shape (n_z, n_M), integrated over z
+        # at each mass
+        Z, M = np.meshgrid(self.z_mf, np.exp(self.logm), indexing='ij')
+        integrand = self.dvdz[:, np.newaxis] * rbs.ev(M, Z)
+        dndlogm = scipy.integrate.simpson(integrand, x=self.z, axis=0)
+        # The cumulative integral over log M, from the integral of a spline
+        # through it.  The integral over each interval only depends on
+        # nearby points, so the number above M is accurate even when it
+        # is a tiny fraction of the total.
+        self.cumulative = make_interp_spline(self.logm, dndlogm, k=3).antiderivative()
+        self.ntot = float(self.cumulative(self.logm[-1]))
+
+    def number_above(self, m):
+        "The number of clusters between zmin and zmax with mass above m"
+        return self.ntot - self.cumulative(np.log(m))
+
+    def number_density(self, m):
+        "The number of clusters between zmin and zmax per unit mass at m"
+        m = np.atleast_1d(m)
+        Z, M = np.meshgrid(self.z_mf, m, indexing='ij')
+        integrand = self.dvdz[:, np.newaxis] * self.rbs.ev(M, Z) / M
+        return scipy.integrate.simpson(integrand, x=self.z, axis=0)
+
+
 def execute(block, config):
     # Configuration data, read from ini file above
-    feedback, redshift, frac, minput, output_pdf = config
+    feedback, redshift, frac, minput, output_pdf, (use_grid, n_z_grid, n_M_grid) = config
     zmin = redshift - 0.01
     zmax = redshift + 0.01
 
@@ -84,39 +127,57 @@ def execute(block, config):
     # 2D interpolator into mass function
     rbs = RectBivariateSpline(marray, zarray, dndmarray)
 
-    ntot = scipy.integrate.quad(dvdzdndmint, zmin, zmax, args=(
-        Mmin, Mmax, omega_matter, h0, interp_da, rbs), epsrel=1e-6, epsabs=0)[0]
-    NUM = ntot * frac
-
-    LogPhi = np.zeros(minput.size)
-    i = 0
-    # Optionally (switched on in the ini file; this takes a bit longer)
-    # Generate a complete PDF of the maximum mass instead of just at the
-    # specified maximum mass
-    if output_pdf:
-        for i, mm in enumerate(minput):
-            FFm = 1.0 / ntot * scipy.integrate.quad(
-                dvdzdndmint, zmin, zmax,
-                args=(Mmin, mm, omega_matter, h0, interp_da, rbs),
-                epsrel=1e-6, epsabs=0)[0]
-            fm = 1.0 / ntot * (scipy.integrate.quad(
-                dvdm_zint, zmin, zmax,
-                args=(mm, omega_matter, h0, interp_da, rbs),
-                epsrel=1e-6, epsabs=0)[0])
-            LogPhi[i] = np.log(NUM * fm) + (NUM - 1) * np.log(FFm)
-
-        # Save the complete PDF
-        block[evs, 'logphi'] = LogPhi
-        block[evs, 'm'] = minput
-
-    # Always genereate the log-likelihood of M_max
-    FFm = 1.0 / ntot * scipy.integrate.quad(dvdzdndmint, zmin, zmax, args=(
-        Mmin, maxmass, omega_matter, h0, interp_da, rbs), epsrel=1e-6, epsabs=0)[0]
-
-    fm = 1.0 / ntot * (scipy.integrate.quad(dvdm_zint, zmin, zmax, args=(
-        maxmass, omega_matter, h0, interp_da, rbs), epsrel=1e-6, epsabs=0)[0])
-
-    LogLike = np.log(NUM * fm) + (NUM - 1) * np.log(FFm)
+    if use_grid:
+        table = MassFunctionTable(zmin, zmax, Mmin, Mmax, omega_matter, h0, interp_da, rbs,
+            n_z_grid, n_M_grid)
+        ntot = table.ntot
+        NUM = ntot * frac
+
+        # Do the PDF and the likelihood of M_max together
+        masses = np.append(minput, maxmass) if output_pdf else np.array([maxmass])
+        # log(F(<M)), from the number above M to avoid losing precision
+        # when F is very close to one
+        logFFm = np.log1p(-table.number_above(masses) / ntot)
+        fm = table.number_density(masses) / ntot
+        LogPhi = np.log(NUM * fm) + (NUM - 1) * logFFm
+        if output_pdf:
+            block[evs, 'logphi'] = LogPhi[:-1]
+            block[evs, 'm'] = minput
+        LogLike = LogPhi[-1]
+    else:
+        ntot = scipy.integrate.quad(dvdzdndmint, zmin, zmax, args=(
+            Mmin, Mmax, omega_matter, h0, interp_da, rbs), epsrel=1e-6, epsabs=0)[0]
+        NUM = ntot * frac
+
+        LogPhi = np.zeros(minput.size)
+        i = 0
+        # Optionally (switched on in the ini file; this takes a bit longer)
+        # Generate a complete PDF of the maximum mass instead of just at the
+        # specified maximum mass
+        if output_pdf:
+            for i, mm in enumerate(minput):
+                FFm = 1.0 / ntot * scipy.integrate.quad(
+                    dvdzdndmint, zmin, zmax,
+                    args=(Mmin, mm, omega_matter, h0, interp_da, rbs),
+                    epsrel=1e-6, epsabs=0)[0]
+                fm = 1.0 / ntot * (scipy.integrate.quad(
+                    dvdm_zint, zmin, zmax,
+                    args=(mm, omega_matter, h0, interp_da, rbs),
+                    epsrel=1e-6, epsabs=0)[0])
+                LogPhi[i] = np.log(NUM * fm) + (NUM - 1) * np.log(FFm)
+
+            # Save the complete PDF
+            block[evs, 'logphi'] = LogPhi
+            block[evs, 'm'] = minput
+
+        # Always genereate the log-likelihood of M_max
+        FFm = 1.0 / ntot * scipy.integrate.quad(dvdzdndmint, zmin, zmax, args=(
+            Mmin, maxmass, omega_matter, h0, interp_da, rbs), epsrel=1e-6, epsabs=0)[0]
+
+        fm = 1.0 / ntot * (scipy.integrate.quad(dvdm_zint, zmin, zmax, args=(
+            maxmass, omega_matter, h0, interp_da, rbs), epsrel=1e-6, epsabs=0)[0])
+
+        LogLike = np.log(NUM * fm) + (NUM - 1) * np.log(FFm)
 
     # Save the likelihood
     block[likes, 'EVS_LIKE'] = LogLike
@@ -0,0 +1,85 @@
+"""
+Shared tools for Gaussian likelihoods whose covariance matrix is fixed.
+
+The covariance is Cholesky factorized once, at setup, as C = L L^T.
+Each chi^2 is then computed as |L^{-1} d|^2 using a triangular solve
+rather than a product with an explicit inverse, and the log-determinant
+is read off the diagonal of L.
+
+Modules in other directories can use this with e.g.:
+
+    dirname = os.path.split(__file__)[0]
+    sys.path.append(os.path.join(dirname, "..", "fixed_covariance"))
+    from fixed_covariance import FixedCovariance
+
+"""
+import numpy as np
+import scipy.linalg
+from cosmosis.gaussian_likelihood import GaussianLikelihood
+
+
+class FixedCovariance(object):
+    """
+    The Cholesky factor of a fixed covariance matrix, with its log-determinant,
+    used to compute chi^2 for one or many residual vectors.
+    """
+    def __init__(self, cov):
+        cov = np.atleast_2d(cov)
+        self.n = cov.shape[0]
+        self.cholesky = scipy.linalg.cholesky(cov, lower=True)
+        self.log_det = 2 * np.log(np.diag(self.cholesky)).sum()
+
+    def whiten(self, delta):
+        """
+        Return L^{-1} delta. delta can be a single residual vector of
+        length n or an (m, n) array of m of them.
+        """
+        delta = np.asarray(delta)
+        w = scipy.linalg.solve_triangular(self.cholesky, delta.T, lower=True, check_finite=False)
+        return w.T
+
+    def chi2(self, delta):
+        """
+        Return delta^T C^{-1} delta. If delta is an (m, n) array then
+        an array of m chi^2 values is returned.
+        """
+        w = self.whiten(delta)
+        return (w**2).sum(axis=-1)
+
+    def inverse(self):
+        "The inverse covariance matrix, for saving or for Fisher matrices"
+        return scipy.linalg.cho_solve((self.cholesky, True), np.identity(self.n), check_finite=False)
+
+
+class FixedCovarianceGaussianLikelihood(GaussianLikelihood):
+    """
+    A GaussianLikelihood that, when its covariance is constant, stores
+    a FixedCovariance at setup and uses it for chi^2 and the log-determinant.
+
+    Subclasses that over-ride build_inverse_covariance themselves (e.g. to
+    apply a correction to the inverse) fall back to the standard behaviour.
+    """
+    fixed_covariance = None
+
+    def __init__(self, options):
+        super(FixedCovarianceGaussianLikelihood, self).__init__(options)
+        # Use the log-det we already have from the factorization
+        if self.fixed_covariance is not None and self.options.get_bool("include_norm", False):
+            self.log_det_constant = self.fixed_covariance.log_det
+
+    def build_inverse_covariance(self):
+        try:
+            self.fixed_covariance = FixedCovariance(self.cov)
+        except np.linalg.LinAlgError:
+            # Not positive-definite; leave it to the general code
+            print("Covariance for {} is not positive-definite; not using Cholesky chi^2".format(self.like_name))
+            return super(FixedCovarianceGaussianLikelihood, self).build_inverse_covariance()
+        return self.fixed_covariance.inverse()
+
+    def _use_fixed_covariance(self):
+        return self.constant_covariance and (self.fixed_covariance is not None)
+
+    def _compute_chi2(self, d):
+        if self._use_fixed_covariance():
+            return float(self.fixed_covariance.chi2(d))
+        return super(FixedCovarianceGaussianLikelihood, self)._compute_chi2(d)
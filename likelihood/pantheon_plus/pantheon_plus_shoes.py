@@ -3,21 +3,25 @@ The likelihood module for Pantheon+ SNe combined with SH0ES Cepheids
 
 """
 
-from cosmosis.gaussian_likelihood import GaussianLikelihood
 from cosmosis.datablock import names
 import os
+import sys
 import numpy as np
 import pandas as pd
 import gzip
 import pantheon_covariance_io as pan_io
 
+# Shared Cholesky-based chi^2 for fixed covariances
+sys.path.append(os.path.join(os.path.split(__file__)[0], "..", "fixed_covariance"))
+from fixed_covariance import FixedCovarianceGaussianLikelihood
+
 # Default is to use SN data from https://arxiv.org/abs/2202.04077
 # and Cepheids data from https://arxiv.org/abs/2112.04510
 default_data_file = os.path.join(os.path.split(__file__)[0], "Pantheon+SH0ES.dat")
 default_covmat_file = os.path.join(os.path.split(__file__)[0], "Pantheon+SH0ES_STAT+SYS.cov_compressed.gz")
 
 
-class PantheonLikelihood(GaussianLikelihood):
+class PantheonLikelihood(FixedCovarianceGaussianLikelihood):
     x_section = names.distances
     x_name = "z"
     y_section = names.distances
@@ -74,8 +78,8 @@ class PantheonLikelihood(GaussianLikelihood):
 
         C = C[self.ww][:, self.ww]
 
-        # Return the covariance; the parent class knows to invert this
-        # later to get the precision matrix that we need for the likelihood.
+        # Return the covariance; the parent class Cholesky factorizes this
+        # once, and uses the factor to compute chi^2 for each sample.
         return C
 
     def extract_theory_points(self, block):
@@ -155,17 +155,8 @@ class PlanckLitePy:
         else:
             raise NotImplementedError("Specified combination of tt, te, ee is not implemented")
 
-        #invert high ell covariance matrix (cholesky decomposition should be faster)
-        fisher=scipy.linalg.cho_solve(scipy.linalg.cho_factor(cov), np.identity(bin_no))
-        fisher=fisher.transpose()
-
-
         if self.use_low_ell_bins:
             bin_no += self.nbintt_low_ell
-            inv_covmat_with_lo=np.zeros(shape=(bin_no, bin_no))
-            inv_covmat_with_lo[0:2, 0:2]=np.diag(1./self.X_sig_low_ell**2)
-            inv_covmat_with_lo[2:,2:]= fisher
-            fisher=inv_covmat_with_lo
             fullcov=np.zeros(shape=(bin_no, bin_no))
             fullcov[0:2,0:2] = np.diag(self.X_sig_low_ell**2)
             fullcov[2:,2:] = cov
@@ -173,6 +164,11 @@ class PlanckLitePy:
 
         self.cov = cov
 
+        # Cholesky decompose the covariance once. We use the factor for chi^2
+        # via a triangular solve in loglike, and to get the inverse here.
+        self.cov_cholesky = scipy.linalg.cholesky(cov, lower=True)
+        fisher=scipy.linalg.cho_solve((self.cov_cholesky, True), np.identity(bin_no))
+
         return fisher
 
     def make_mean_vector(self, Dltt, Dlte, Dlee, ellmin=2):
@@ -244,7 +240,8 @@ class PlanckLitePy:
 
         diff_vec = self._cut_vector(Y)
 
-        return -0.5*diff_vec.dot(self.fisher.dot(diff_vec))
+        w = scipy.linalg.solve_triangular(self.cov_cholesky, diff_vec, lower=True, check_finite=False)
+        return -0.5*w.dot(w)
 
 
     def test(self):
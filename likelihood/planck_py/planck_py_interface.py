@@ -1,12 +1,14 @@
 from cosmosis.datablock import names
-from cosmosis.gaussian_likelihood import GaussianLikelihood
 import planck_lite_py
 import numpy as np
 import os
+import sys
 
 dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "fixed_covariance"))
+from fixed_covariance import FixedCovarianceGaussianLikelihood
 
-class PlanckPythonLikelihood(GaussianLikelihood):
+class PlanckPythonLikelihood(FixedCovarianceGaussianLikelihood):
     x_section = 'cmb_cl'
     x_name = 'ell'
     y_section = 'cmb_cl'
@@ -54,9 +56,6 @@ class PlanckPythonLikelihood(GaussianLikelihood):
     def build_covariance(self):
         return self.calculator.cov
 
-    def build_inverse_covariance(self):
-        return self.calculator.fisher
-
     def extract_theory_points(self, block):
         ell = block[self.x_section, self.x_name]
         ellmin = ell[0]
@@ -0,0 +1,110 @@
+"""
+Shared tools for shifting, stretching and skewing all the tomographic
+n(z) of a sample at once, as used by the photo-z nuisance modules.
+
+Each transformed n(z) is the original evaluated at an affine remapping
+of z, so all the bins can be interpolated together from the (n_bin, n_z)
+matrix of n(z), rather than building an interpolator per bin.
+
+Modules in other directories can use this with e.g.:
+
+    dirname = os.path.split(__file__)[0]
+    sys.path.append(os.path.join(dirname, "..", "nz_transform"))
+    import nz_transform
+
+"""
+import numpy as np
+from scipy.interpolate import interp1d, CubicSpline
+
+
+def load_nz(block, section, nbin):
+    "Read bin_1 ... bin_nbin from a section into an (nbin, n_z) array"
+    return np.array([block[section, "bin_%d" % i] for i in range(1, nbin + 1)])
+
+
+def save_nz(block, section, nz):
+    "Save the rows of an (nbin, n_z) array to bin_1 ... bin_nbin in a section"
+    for i, nz_i in enumerate(nz):
+        block[section, "bin_%d" % (i + 1)] = nz_i
+
+
+def mean_z(z, nz):
+    "The mean redshift of each row of an (n_bin, n_z) array of n(z)"
+    return np.average(np.broadcast_to(z, nz.shape), weights=nz, axis=1)
+
+
+def peak_z(z, nz):
+    "The redshift of the (first) peak of each row of an (n_bin, n_z) array of n(z)"
+    return z[np.argmax(nz, axis=1)]
+
+
+def normalize(z, nz):
+    "Normalize each row of an (n_bin, n_z) array of n(z) to integrate to one"
+    return nz / np.trapz(nz, z, axis=1)[:, np.newaxis]
+
+
+def interpolate_bins(z, nz, z_eval, kind="cubic"):
+    """
+    Evaluate an interpolator for each row of the (n_bin, n_z) array nz,
+    tabulated at z, at the corresponding row of the (n_bin, n_eval) array
+    z_eval.  Points outside the range of z give zero.
+
+    This is equivalent to using a scipy.interpolate.interp1d per bin with
+    fill_value=0.0 and bounds_error=False.  Linear and cubic interpolation
+    are done for all the bins together; other kinds bin by bin.
+    """
+    z = np.asarray(z, dtype=float)
+    nz = np.atleast_2d(nz)
+    z_eval = np.asarray(z_eval, dtype=float)
+    rows = np.arange(nz.shape[0])[:, np.newaxis]
+
+    if kind == "linear":
+        # The same interval choice and arithmetic as interp1d
+        hi = np.clip(np.searchsorted(z, z_eval), 1, len(z) - 1)
+        lo = hi - 1
+        slope = (nz[rows, hi] - nz[rows, lo]) / (z[hi] - z[lo])
+        result = slope * (z_eval - z[lo]) + nz[rows, lo]
+    elif kind == "cubic":
+        # interp1d's cubic is the not-a-knot spline; we use its piecewise
+        # polynomial form so each point picks out its own bin's coefficients
+        c = CubicSpline(z, nz, axis=1, bc_type='not-a-knot').c
+        lo = np.clip(np.searchsorted(z, z_eval, side='right') - 1, 0, len(z) - 2)
+        c = c[:, lo, rows]
+        dz = z_eval - z[lo]
+        result = ((c[0] * dz + c[1]) * dz + c[2]) * dz + c[3]
+    else:
+        return np.array([
+            interp1d(z, nz_i, kind=kind, fill_value=0.0, bounds_error=False)(z_i)
+            for nz_i, z_i in zip(nz, z_eval)
+        ])
+
+    result[(z_eval < z[0]) | (z_eval > z[-1])] = 0.0
+    return result
+
+
+def transform_nz(z, nz, shift=0.0, stretch=1.0, pivot=0.0, skew=None, kind="cubic"):
+    """
+    Shift, stretch and skew all the n(z) in the (n_bin, n_z) array nz at once.
+    Each of the transformation parameters may be a scalar or have one value per bin.
+
+    Bin i becomes:
+
+        n_i(pivot_i + stretch_i * (z - pivot_i) - shift_i) + 2 skew_i (z - pivot_i)
+
+    clipped at zero if skew is set (even to zero).  The result is not normalized.
+    """
+    nz = np.atleast_2d(nz)
+    n_bin = nz.shape[0]
+    shift, stretch, pivot = [
+        np.broadcast_to(np.asarray(p, dtype=float), (n_bin,))[:, np.newaxis]
+        for p in (shift, stretch, pivot)
+    ]
+    z_eval = pivot + stretch * (z - pivot) - shift
+    nz_new = interpolate_bins(z, nz, z_eval, kind=kind)
+
+    if skew is not None:
+        skew = np.broadcast_to(np.asarray(skew, dtype=float), (n_bin,))[:, np.newaxis]
+        nz_new += 2 * skew * (z - pivot)
+        np.putmask(nz_new, nz_new < 0., 0.)
+
+    return nz_new
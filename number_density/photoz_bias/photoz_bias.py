@@ -1,7 +1,12 @@
 from builtins import range
 from cosmosis.datablock import option_section, names
-from scipy.interpolate import interp1d
 import numpy as np
+import os
+import sys
+
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "nz_transform"))
+import nz_transform
 
 MODES = ["multiplicative", "additive"]
 
@@ -41,34 +46,29 @@ def execute(block, config):
     biases = config['bias_section']
     nbin = block[pz, "nbin"]
     z = block[pz, "z"]
-    for i in range(1, nbin + 1):
-        bin_name = "bin_%d" % i
-        nz = block[pz, bin_name]
-        # Calculate delta z output
-        if config["output_deltaz"]:
-            mean_z_input=np.average(z, weights=nz)
+    nz = nz_transform.load_nz(block, pz, nbin)
+
+    if config["per_bin"]:
+        bias = np.array([block[biases, "bias_%d" % i] for i in range(1, nbin + 1)])
+    else:
+        bias = block[biases, "bias_0"]
+
+    if mode == "multiplicative":
+        nz_biased = nz_transform.transform_nz(z, nz, stretch=1 - bias, kind=interpolation)
+    elif mode == "additive":
+        nz_biased = nz_transform.transform_nz(z, nz, shift=bias, kind=interpolation)
+    else:
+        raise ValueError("Unknown photo-z mode")
+    # normalize
+    nz_biased = nz_transform.normalize(z, nz_biased)
+
+    #calculate delta z output
+    if config["output_deltaz"]:
+        delta_z = nz_transform.mean_z(z, nz_biased) - nz_transform.mean_z(z, nz)
+        for i in range(nbin):
+            block[config["output_deltaz_section_name"], "bin_%d" % (i + 1)] = delta_z[i]
 
-        if config["per_bin"]:
-            bias = block[biases, "bias_%d" % i]
-        else:
-            bias = block[biases, "bias_0"]
-        f = interp1d(z, nz, kind=interpolation,
-                     fill_value=0.0, bounds_error=False)
-        if mode == "multiplicative":
-            nz_biased = f(z * (1 - bias))
-        elif mode == "additive":
-            nz_biased = f(z - bias)
-        else:
-            raise ValueError("Unknown photo-z mode")
-        # normalize
-        nz_biased /= np.trapz(nz_biased, z)
-        #calculate delta z output
-        if config["output_deltaz"]:
-            mean_z_shifted=np.average(z,weights=nz_biased)
-            delta_z = mean_z_shifted-mean_z_input
-            block[config["output_deltaz_section_name"], bin_name] = delta_z
-        #
-        block[pz, bin_name] = nz_biased
+    nz_transform.save_nz(block, pz, nz_biased)
     return 0
 
 
@@ -1,7 +1,12 @@
 from builtins import range
 from cosmosis.datablock import option_section, names
-from scipy.interpolate import interp1d
 import numpy as np
+import os
+import sys
+
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "nz_transform"))
+import nz_transform
 
 MODES = ["skew", "mean", "width"]
 
@@ -38,80 +43,61 @@ def execute(block, config):
     pad = np.zeros(add_pts)
     padz = np.arange(z.max() + d, z.max() + (add_pts + 1) * d, d)
     z = np.append(z, padz)
-    for i in range(1, nbin + 1):
-        bin_name = "bin_%d" % i
-        nz = block[pz, bin_name]
-        nz = np.append(nz, pad)
+    nz = nz_transform.load_nz(block, pz, nbin)
+    nz = np.hstack([nz, np.broadcast_to(pad, (nbin, add_pts))])
+
+    def get_parameter(name):
         if config['per_bin']:
-            if additive:
-                bias = block[biases, "bias_%d" % i]
-            if broadening:
-                S = block[biases, "S_z_%d" % i]
-            if skew:
-                T = block[biases, "T_z_%d" % i]
+            return np.array([block[biases, "%s_%d" % (name, i)] for i in range(1, nbin + 1)])
         else:
-            if additive:
-                bias = block[biases, "bias_1"]
-            if broadening:
-                S_z = block[biases, "S_z_1"]
-            if skew:
-                T = block[biases, "T_z_1"]
-        dz = np.zeros_like(z)
-        f = interp1d(z, nz, kind='cubic', fill_value=0.0, bounds_error=False)
-        # if mode=="multiplicative":
-        #	nz_biased = f(z*(1-bias))
-        if broadening:
-            # Use the main peak of n(z) as a pivot point about which to distort n(z)
-            zp = z[np.argwhere(nz == nz.max())[0][0]]
-            dz += S * (z - zp)
-        if additive:
-            dz -= bias
-        nz_biased = f(z + dz)
-
-        if skew:
-            # Redistribute proability upwards in redshift witout altering
-            # the peak of the n(z)
-            delta1 = T * (z - zp) + nz.max()
-            delta2 = -1. * T * (z - zp) + nz.max()
-            nz_biased += delta1 - delta2
-            np.putmask(nz_biased, nz_biased < 0., 0.)
-
-        # normalise
-        nz_biased /= np.trapz(nz_biased, z)
-
-        # Add a population of catastrophic outliers
-        # See Hearin et al (2010)
-
-        if config['catastrophic_outliers'] != None:
-            cat_mode = block[pz, 'method']
-            fcat = block[pz, 'fcat']  # 0.05
-            dzcat = block[pz, 'dzcat']  # 0.129
-            zcat0 = block[pz, 'zcat0']  # 0.65
-            zcat = block[pz, 'zcat']  # 0.5
-            sigcat = block[pz, 'sigcat']  # 0.1
-
-            step = (dzcat / 2.) - abs(z - zcat0)
-            step[step == 0.0] = -1.0
-            step = 0.5 * (step / abs(step) + 1.0)
-
-            dz = (z[1] - z[0])
-
-            # Define a Gaussian island of outliers, normalised to
-            # the probability scattered from the affected region
-            if cat_mode == 'island':
-                pcat = (1. / (2.0 * np.pi)**0.5 / sigcat) * np.exp(-1.0 *
-                                                                   (z - zcat) * (z - zcat) / (2. * sigcat * sigcat))
-                pcat *= np.trapz(step * fcat * nz_biased, z)
-                nz_biased = (1. - step * fcat) * nz_biased + pcat
-
-            # Or scatter it uniformly across the theory redshift range
-            elif cat_mode == 'uniform':
-                nz_biased = (1. - step * fcat) * nz_biased + \
-                    step * fcat / (z[-1] - z[0])
-
-        # renormalise
-        nz_biased /= np.trapz(nz_biased, z)
-        block[pz, bin_name] = nz_biased
+            return block[biases, "%s_1" % name]
+
+    bias = get_parameter("bias") if additive else 0.0
+    S = get_parameter("S_z") if broadening else 0.0
+    T = get_parameter("T_z") if skew else None
+
+    # Use the main peak of n(z) as a pivot point about which to distort n(z)
+    zp = nz_transform.peak_z(z, nz)
+
+    # Broaden about the peak and shift.  If skewed, redistribute probability
+    # upwards in redshift without altering the peak of the n(z)
+    nz_biased = nz_transform.transform_nz(z, nz, shift=bias, stretch=1 + np.asarray(S),
+                                          pivot=zp, skew=T, kind='cubic')
+
+    # normalise
+    nz_biased = nz_transform.normalize(z, nz_biased)
+
+    # Add a population of catastrophic outliers
+    # See Hearin et al (2010)
+
+    if config['catastrophic_outliers'] != None:
+        cat_mode = block[pz, 'method']
+        fcat = block[pz, 'fcat']  # 0.05
+        dzcat = block[pz, 'dzcat']  # 0.129
+        zcat0 = block[pz, 'zcat0']  # 0.65
+        zcat = block[pz, 'zcat']  # 0.5
+        sigcat = block[pz, 'sigcat']  # 0.1
+
+        step = (dzcat / 2.) - abs(z - zcat0)
+        step[step == 0.0] = -1.0
+        step = 0.5 * (step / abs(step) + 1.0)
+
+        # Define a Gaussian island of outliers, normalised to
+        # the probability scattered from the affected region
+        if cat_mode == 'island':
+            pcat = (1. / (2.0 * np.pi)**0.5 / sigcat) * np.exp(-1.0 *
+                                                               (z - zcat) * (z - zcat) / (2. * sigcat * sigcat))
+            pcat = pcat * np.trapz(step * fcat * nz_biased, z, axis=1)[:, np.newaxis]
+            nz_biased = (1. - step * fcat) * nz_biased + pcat
+
+        # Or scatter it uniformly across the theory redshift range
+        elif cat_mode == 'uniform':
+            nz_biased = (1. - step * fcat) * nz_biased + \
+                step * fcat / (z[-1] - z[0])
+
+    # renormalise
+    nz_biased = nz_transform.normalize(z, nz_biased)
+    nz_transform.save_nz(block, pz, nz_biased)
 
     block[pz, 'z'] = z
 
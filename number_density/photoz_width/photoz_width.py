@@ -1,7 +1,12 @@
 from builtins import range
 from cosmosis.datablock import option_section, names
-from scipy.interpolate import interp1d
 import numpy as np
+import os
+import sys
+
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "nz_transform"))
+import nz_transform
 
 MODES = ["stretch"]
 
@@ -33,25 +38,25 @@ def execute(block, config):
     biases = config['bias_section']
     nbin = block[pz, "nbin"]
     z = block[pz, "z"]
-    for i in range(1, nbin + 1):
-        bin_name = "bin_%d" % i
-        nz = block[pz, bin_name]
-        if config["per_bin"]:
-            stretch = block[biases, "width_%d" % i]
-        else:
-            stretch = block[biases, "width_0"]
-
-        if mode == "stretch":
-            zmean = np.average(z,weights=nz)
-            f = interp1d(stretch*(z-zmean)+zmean, nz, kind=interpolation, 
-                fill_value=0.0, bounds_error=False)
-            nz_biased = f(z)
-        else:
-            raise ValueError("Unknown photo-z mode")
-
-        # normalize
-        nz_biased /= np.trapz(nz_biased, z)
-        block[pz, bin_name] = nz_biased
+    nz = nz_transform.load_nz(block, pz, nbin)
+
+    if config["per_bin"]:
+        stretch = np.array([block[biases, "width_%d" % i] for i in range(1, nbin + 1)])
+    else:
+        stretch = block[biases, "width_0"]
+
+    if mode == "stretch":
+        # Stretching n(z) by a factor about its mean is the same as
+        # evaluating it at the inversely stretched redshifts
+        zmean = nz_transform.mean_z(z, nz)
+        nz_biased = nz_transform.transform_nz(
+            z, nz, stretch=1.0 / np.asarray(stretch), pivot=zmean, kind=interpolation)
+    else:
+        raise ValueError("Unknown photo-z mode")
+
+    # normalize
+    nz_biased = nz_transform.normalize(z, nz_biased)
+    nz_transform.save_nz(block, pz, nz_biased)
     return 0
 
 
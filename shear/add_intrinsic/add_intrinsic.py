@@ -1,6 +1,12 @@
 from __future__ import print_function
 from builtins import range
 from cosmosis.datablock import option_section, names
+import numpy as np
+import os
+import sys
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
+import packed_spectra
 
 def setup(options):
     do_shear_shear = options.get_bool(option_section, "shear-shear", True)
@@ -44,18 +50,54 @@ def setup(options):
     return do_shear_shear, do_position_shear, do_shear_cmbkappa, perbin, sec_names
 
 
+def add_shear_shear(block, sec_names, A_ij, A_i, A_j):
+    # Add the II and GI terms to all the shear-shear bin pairs at once,
+    # in whichever layout the section uses, and save the GG term separately
+    shear_shear = sec_names['shear_shear']
+    layout = packed_spectra.section_layout(block, shear_shear)
+    gg, mask = packed_spectra.get_packed(block, shear_shear)
+    ii, ii_mask = packed_spectra.get_packed(block, sec_names['intrinsic_intrinsic'])
+    gi, gi_mask = packed_spectra.get_packed(block, sec_names['shear_intrinsic'])
+    n = A_ij.shape[0]
+    # C_ij = C_ji so we only use the j <= i pairs
+    mask = mask[:n, :n] & np.tri(n, dtype=bool)
+    # Missing IA pairs would otherwise be silently added as zero
+    packed_spectra.require_bin_pairs(sec_names['intrinsic_intrinsic'], ii_mask, mask)
+    packed_spectra.require_bin_pairs(sec_names['shear_intrinsic'], gi_mask, mask | mask.T)
+    gg = gg[:n, :n]
+    total = gg + (
+        A_ij * ii[:n, :n]  # II
+        + A_j * gi[:n, :n]  # The two GI terms
+        + A_i * gi[:n, :n].transpose(1, 0, 2)
+    )
+    total[~mask] = 0.0
+    packed_spectra.put_packed(block, sec_names['shear_shear_gg'], gg, mask, layout)
+    packed_spectra.put_packed(block, shear_shear, total, mask, layout)
+    if block.has_section(sec_names['intrinsic_intrinsic_bb']):
+        bb, bb_mask = packed_spectra.get_packed(block, sec_names['intrinsic_intrinsic_bb'])
+        packed_spectra.require_bin_pairs(sec_names['intrinsic_intrinsic_bb'], bb_mask, mask)
+        packed_spectra.put_packed(block, sec_names['shear_shear_bb'], bb[:n, :n], mask, layout)
+
+
+def add_cross(block, section, intrinsic_section, A):
+    # Add the IA term to all the bin pairs of a cross-spectrum, where the
+    # IA amplitude array A multiplies the shear bin along its axis
+    gs, mask = packed_spectra.get_packed(block, section)
+    gi, gi_mask = packed_spectra.get_packed(block, intrinsic_section)
+    packed_spectra.require_bin_pairs(intrinsic_section, gi_mask, mask)
+    gs = gs + A * gi
+    gs[~mask] = 0.0
+    packed_spectra.put_packed(block, section, gs, mask)
+
+
 def execute(block, config):
     do_shear_shear, do_position_shear, do_shear_cmbkappa, perbin, sec_names = config
 
     shear_shear = sec_names['shear_shear']
-    shear_shear_bb = sec_names['shear_shear_bb']
     shear_shear_gg = sec_names['shear_shear_gg']
     galaxy_shear = sec_names['galaxy_shear']
     galaxy_intrinsic = sec_names['galaxy_intrinsic']
-    shear_intrinsic = sec_names['shear_intrinsic']
     parameters = sec_names['parameters']
-    intrinsic_intrinsic = sec_names['intrinsic_intrinsic']
-    intrinsic_intrinsic_bb = sec_names['intrinsic_intrinsic_bb']
     shear_cmbkappa = sec_names['shear_cmbkappa']
     intrinsic_cmbkappa = sec_names['intrinsic_cmbkappa']
 
@@ -65,44 +107,31 @@ def execute(block, config):
         nbin_shear = block[galaxy_intrinsic, 'nbin_b']
     elif do_shear_cmbkappa:
         nbin_shear = block[shear_cmbkappa, 'nbin_a']
-    if do_position_shear:
-        nbin_pos = block[galaxy_shear, 'nbin_a']
 
     if perbin:
-        A = [block[parameters, "A{}".format(i + 1)]
-             for i in range(nbin_shear)]
+        A = np.array([block[parameters, "A{}".format(i + 1)]
+             for i in range(nbin_shear)])
     else:
-        A = [1 for i in range(nbin_shear)]
+        A = np.ones(nbin_shear)
+
+    # The IA weights for all the bin pairs, A_i A_j for II
+    # and A_i or A_j for GI
+    A_ij = np.outer(A, A)[:, :, np.newaxis]
+    A_i = A[:, np.newaxis, np.newaxis]
+    A_j = A[np.newaxis, :, np.newaxis]
 
     if do_shear_shear:
         # for shear-shear, we're replacing 'shear_cl' (the GG term) with GG+GI+II...
         # so in case useful, save the GG term to shear_cl_gg.
         # also check for a b-mode contribution from IAs
         block[shear_shear_gg, 'ell'] = block[shear_shear, 'ell']
-        for i in range(nbin_shear):
-            for j in range(i + 1):
-                bin_ij = 'bin_{0}_{1}'.format(i + 1, j + 1)
-                bin_ji = 'bin_{1}_{0}'.format(i + 1, j + 1)
-                block[shear_shear_gg, bin_ij] = block[shear_shear, bin_ij]
-                block[shear_shear, bin_ij] += (
-                    A[i] * A[j] * block[intrinsic_intrinsic, bin_ij]  # II
-                    + A[j] * block[shear_intrinsic, bin_ij]  # The two GI terms
-                    + A[i] * block[shear_intrinsic, bin_ji]
-                )
-                if block.has_section(intrinsic_intrinsic_bb):
-                    block[shear_shear_bb, bin_ij] = block[intrinsic_intrinsic_bb, bin_ij]
+        add_shear_shear(block, sec_names, A_ij, A_i, A_j)
+
     if do_position_shear:
-        for i in range(nbin_pos):
-            for j in range(nbin_shear):
-                bin_ij = 'bin_{0}_{1}'.format(i + 1, j + 1)
-                block[galaxy_shear, bin_ij] += A[j] * \
-                    block[galaxy_intrinsic, bin_ij]
+        add_cross(block, galaxy_shear, galaxy_intrinsic, A_j)
 
     if do_shear_cmbkappa:
-        for i in range(nbin_shear):
-            bin_ij = 'bin_{0}_{1}'.format(i + 1, 1)
-            block[shear_cmbkappa, bin_ij] += A[i] * \
-                    block[intrinsic_cmbkappa, bin_ij]
+        add_cross(block, shear_cmbkappa, intrinsic_cmbkappa, A_i)
 
 
     return 0
@@ -4,6 +4,12 @@ import scipy.interpolate
 import pyfftlog
 import numpy as np
 from cosmosis.datablock import option_section
+import os
+import sys
+
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
+import packed_spectra
 
 # These are the ones the user can use
 TRANSFORM_W = "w"
@@ -141,30 +147,46 @@ class Transformer(object):
 
     def __call__(self, ell_in, cl_in):
         """Convert the input ell and cl points to the points this transform requires, and then
-        transform."""
+        transform.  cl_in can be a single spectrum or a 2D array with one spectrum per row,
+        in which case all the rows are transformed together."""
 
         # Sample onto self.ell
         cl = self._interpolate_and_extrapolate_cl(ell_in, cl_in)
 
         if self.q == 0:
             xi = pyfftlog.fht(self.ell * cl, self.xsave,
-                              tdir=self.direction) / (2 * np.pi) / self.theta_rad
+                              tdir=self.direction)
         else:
             xi = pyfftlog.fhtq(self.ell * cl, self.xsave,
-                               tdir=self.direction) / (2 * np.pi) / self.theta_rad
-        return self.theta_arcmin, xi[self.range]
+                               tdir=self.direction)
+        xi = xi[..., self.range] / (2 * np.pi) / self.theta_rad[self.range]
+        return self.theta_arcmin, xi
 
     def _interpolate_and_extrapolate_cl(self, ell, cl):
-        """Extrapolate and interpolate the input ell and cl to the default points for this transform"""
+        """Extrapolate and interpolate the input ell and cl to the default points for this transform.
+        If cl is 2D then each row is a separate spectrum."""
         ell_min = ell[0]
         ell_max = ell[-1]
-        interpolator = LogInterp(ell, cl, 'linear')
-        cl_out = interpolator(self.ell)
-        bad_low = np.isnan(cl_out) & (self.ell < ell_min)
-        bad_high = np.isnan(cl_out) & (self.ell > ell_max)
-
-        cl_out[bad_low] = cl[0] * (self.ell[bad_low] / ell_min)**self.lower
-        cl_out[bad_high] = cl[-1] * (self.ell[bad_high] / ell_max)**self.upper
+        low = self.ell < ell_min
+        high = self.ell > ell_max
+        inside = ~(low | high)
+
+        cl_out = np.empty(cl.shape[:-1] + self.ell.shape)
+        if cl.ndim == 1:
+            interpolator = LogInterp(ell, cl, 'linear')
+            cl_out[inside] = interpolator(self.ell[inside])
+        else:
+            # Rows that are all positive, all negative, or mixed are interpolated
+            # differently by LogInterp, so do one interpolation for each group.
+            positive = np.all(cl > 0, axis=1)
+            negative = np.all(cl < 0, axis=1)
+            for group in [positive, negative, ~(positive | negative)]:
+                if group.any():
+                    interpolator = LogInterp(ell, cl[group], 'linear')
+                    cl_out[np.ix_(group, inside)] = interpolator(self.ell[inside])
+
+        cl_out[..., low] = cl[..., :1] * (self.ell[low] / ell_min)**self.lower
+        cl_out[..., high] = cl[..., -1:] * (self.ell[high] / ell_max)**self.upper
 
         return cl_out
 
@@ -238,32 +260,29 @@ class CosmosisTransformer(Transformer):
         sample_b = block.get_string(self.input_section, "sample_b", default="")
         is_auto = block.get_bool(self.input_section, "is_auto", default=False)
 
-        # Loop through bin pairs and see if C_ell exists for all of them
-        for i in range(nbin_a):
-            for j in range(nbin_b):
-                b1 = i + 1
-                b2 = j + 1
-
-                # The key name for each bin
-                input_name = self.input_name.format(b1, b2)
-                output_name = self.output_name.format(b1, b2)
-
-                # Some bins may not be present.  e.g. might only have
-                # auto-correlations
-                if not block.has_value(self.input_section, input_name):
-                    continue
-
-                # Read input c_ell from data block.
-                cl = block[self.input_section, input_name]
-
-                # Compute the transform.  Calls the earlier __call__ method above.
-                theta, xi = super(CosmosisTransformer, self).__call__(ell, cl)
+        # Read all the bin pairs that exist, in either layout - some bins
+        # may not be present, e.g. we might only have auto-correlations.
+        # The output is saved in the same layout.
+        layout = packed_spectra.section_layout(block, self.input_section)
+        c_ells, mask = packed_spectra.get_packed(block, self.input_section)
+        cls = c_ells[mask]
+
+        # Compute the transforms for all the bin pairs together.
+        # Calls the earlier __call__ method above.  If there are no
+        # bin pairs there is nothing to transform, but we still save
+        # the theta values and metadata.
+        if len(cls) == 0:
+            theta, xi = self.theta_arcmin, np.zeros((0, len(self.theta_arcmin)))
+        else:
+            theta, xi = super(CosmosisTransformer, self).__call__(ell, cls)
 
-                # Cosmosis wants theta in radians
-                theta = np.radians(theta / 60.)
+        # Cosmosis wants theta in radians
+        theta = np.radians(theta / 60.)
 
-                # Save results back to cosmosis
-                block[self.output_section, output_name] = xi
+        # Save results back to cosmosis
+        xi_packed = np.zeros(mask.shape + (len(theta),))
+        xi_packed[mask] = xi
+        packed_spectra.put_packed(block, self.output_section, xi_packed, mask, layout)
         block[self.output_section, "nbin_a"] = nbin_a
         block[self.output_section, "nbin_b"] = nbin_b
         block[self.output_section, "sample_a"] = sample_a
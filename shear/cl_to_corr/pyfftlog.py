@@ -434,6 +434,8 @@ def fftl(a, xsave, rk=1, tdir=1):
     a : array
         Array A(r) to transform: a(j) is A(r_j) at r_j = r_c exp[(j-jc) dlnr],
         where jc = (n+1)/2 = central index of array.
+        If a is multi-dimensional then each row (along the last axis) is
+        transformed, re-using the same xsave.
 
     xsave : array
         Working array set up by fhti.
@@ -464,8 +466,8 @@ def fftl(a, xsave, rk=1, tdir=1):
     kr = xsave[2]
 
     # centre point of array
-    jc = np.array((fct.size + 1) / 2.0)
-    j = np.arange(fct.size) + 1
+    jc = np.array((fct.shape[-1] + 1) / 2.0)
+    j = np.arange(fct.shape[-1]) + 1
 
     # a(r) = A(r) (r/rc)^[-dir*(q-.5)]
     fct *= np.exp(-tdir * (q - 0.5) * (j - jc) * dlnr)
@@ -519,6 +521,8 @@ def fht(a, xsave, tdir=1):
     a : array
         Array A(r) to transform: a(j) is A(r_j) at r_j = r_c exp[(j-jc) dlnr],
         where jc = (n+1)/2 = central index of array.
+        If a is multi-dimensional then each row (along the last axis) is
+        transformed, re-using the same xsave.
 
     xsave : array
         Working array set up by fhti.
@@ -535,7 +539,7 @@ def fht(a, xsave, tdir=1):
         Transformed array Ã(k): a(j) is Ã(k_j) at k_j = k_c exp[(j-jc) dlnr].
 
     """
-    fct = a.copy()
+    fct = a
     q = xsave[0]
     dlnr = xsave[1]
     kr = xsave[2]
@@ -543,9 +547,9 @@ def fht(a, xsave, tdir=1):
     # a(r) = A(r) (r/rc)^(-dir*q)
     if q != 0:
         #  centre point of array
-        jc = np.array((fct.size + 1) / 2.0)
-        j = np.arange(fct.size) + 1
-        fct *= np.exp(-tdir * q * (j - jc) * dlnr)
+        jc = np.array((fct.shape[-1] + 1) / 2.0)
+        j = np.arange(fct.shape[-1]) + 1
+        fct = fct * np.exp(-tdir * q * (j - jc) * dlnr)
 
     # transform a(r) -> ã(k)
     fct = fhtq(fct, xsave, tdir)
@@ -582,6 +586,8 @@ def fhtq(a, xsave, tdir=1):
     a : array
         Periodic array a(r) to transform: a(j) is a(r_j) at r_j = r_c
         exp[(j-jc) dlnr] where jc = (n+1)/2 = central index of array.
+        If a is multi-dimensional then each row (along the last axis) is
+        transformed, with a single FFT call for all of them.
 
     xsave : array
         Working array set up by fhti.
@@ -599,49 +605,52 @@ def fhtq(a, xsave, tdir=1):
         dlnr].
 
     """
-    fct = a.copy()
     q = xsave[0]
-    n = fct.size
+    n = a.shape[-1]
 
-    # normal FFT
-    fct = rfft(fct)
+    # normal FFT. This returns a new array, so a is not modified.
+    fct = rfft(a, axis=-1)
     # _raw_fft(fct, n, -1, 1, 1, _fftpack.drfft)
     # breakpoint()
     # fct = drfft(fct, n, 1, 0)
 
     m = np.arange(1, n / 2, dtype=int)  # index variable
+    # The real and imaginary parts of the FFT for these m, i.e. the elements
+    # 2m-1 and 2m, as views along the last axis
+    real = slice(1, 2 * m.size, 2)
+    imag = slice(2, 2 * m.size + 1, 2)
     if q == 0:  # unbiased (q = 0) transform
         # multiply by (kr)^[- i 2 m pi/(n dlnr)] U_mu[i 2 m pi/(n dlnr)]
-        ar = fct[2 * m - 1]
-        ai = fct[2 * m]
-        fct[2 * m - 1] = ar * xsave[2 * m + 1] - ai * xsave[2 * m + 2]
-        fct[2 * m] = ar * xsave[2 * m + 2] + ai * xsave[2 * m + 1]
+        ar = fct[..., real]
+        ai = fct[..., imag]
+        fct[..., real], fct[..., imag] = (ar * xsave[2 * m + 1] - ai * xsave[2 * m + 2],
+                                          ar * xsave[2 * m + 2] + ai * xsave[2 * m + 1])
         # problem(2*m)atical last element, for even n
         if np.mod(n, 2) == 0:
             ar = xsave[-2]
             if (tdir == 1):  # forward transform: multiply by real part
                 # Why? See http://casa.colorado.edu/~ajsh/FFTLog/index.html#ure
-                fct[-1] *= ar
+                fct[..., -1] *= ar
             elif (tdir == -1):  # backward transform: divide by real part
                 # Real part ar can be zero for maximally bad choice of kr.
                 # This is unlikely to happen by chance, but if it does, policy
                 # is to let it happen.  For low-ringing kr, imaginary part ai
                 # is zero by construction, and real part ar is guaranteed
                 # nonzero.
-                fct[-1] /= ar
+                fct[..., -1] /= ar
 
     else:  # biased (q != 0) transform
         # multiply by (kr)^[- i 2 m pi/(n dlnr)] U_mu[q + i 2 m pi/(n dlnr)]
         # phase
-        ar = fct[2 * m - 1]
-        ai = fct[2 * m]
-        fct[2 * m - 1] = ar * xsave[3 * m + 2] - ai * xsave[3 * m + 3]
-        fct[2 * m] = ar * xsave[3 * m + 3] + ai * xsave[3 * m + 2]
+        ar = fct[..., real]
+        ai = fct[..., imag]
+        fct[..., real], fct[..., imag] = (ar * xsave[3 * m + 2] - ai * xsave[3 * m + 3],
+                                          ar * xsave[3 * m + 3] + ai * xsave[3 * m + 2])
 
         if tdir == 1:  # forward transform: multiply by amplitude
-            fct[0] *= xsave[3]
-            fct[2 * m - 1] *= xsave[3 * m + 1]
-            fct[2 * m] *= xsave[3 * m + 1]
+            fct[..., 0] *= xsave[3]
+            fct[..., real] *= xsave[3 * m + 1]
+            fct[..., imag] *= xsave[3 * m + 1]
 
         elif tdir == -1:  # backward transform: divide by amplitude
             # amplitude of m=0 element
@@ -650,36 +659,36 @@ def fhtq(a, xsave, tdir=1):
                 # Amplitude of m=0 element can be zero for some mu, q
                 # combinations (singular inverse); policy is to drop
                 # potentially infinite constant.
-                fct[0] = 0
+                fct[..., 0] = 0
             else:
-                fct[0] /= ar
+                fct[..., 0] /= ar
 
             # remaining amplitudes should never be zero
-            fct[2 * m - 1] /= xsave[3 * m + 1]
-            fct[2 * m] /= xsave[3 * m + 1]
+            fct[..., real] /= xsave[3 * m + 1]
+            fct[..., imag] /= xsave[3 * m + 1]
 
         # problematical last element, for even n
         if np.mod(n, 2) == 0:
             m = int(n / 2)
             ar = xsave[3 * m + 2] * xsave[3 * m + 1]
             if tdir == 1:  # forward transform: multiply by real part
-                fct[-1] *= ar
+                fct[..., -1] *= ar
             elif (tdir == -1):  # backward transform: divide by real part
                 # Real part ar can be zero for maximally bad choice of kr.
                 # This is unlikely to happen by chance, but if it does, policy
                 # is to let it happen.  For low-ringing kr, imaginary part ai
                 # is zero by construction, and real part ar is guaranteed
                 # nonzero.
-                fct[-1] /= ar
+                fct[..., -1] /= ar
 
     # normal FFT back
-    fct = irfft(fct)
+    fct = irfft(fct, axis=-1)
     # _raw_fft(fct, n, -1, -1, 1, _fftpack.drfft)
     # fct = drfft(fct, n, -1, 1)
 
     # reverse the array and at the same time undo the FFTs' multiplication by n
     # => Just reverse the array, the rest is already done in drfft.
-    fct = fct[::-1]
+    fct = fct[..., ::-1]
 
     return fct
 
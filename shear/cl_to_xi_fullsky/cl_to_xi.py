@@ -41,6 +41,63 @@ class SpectrumInterp(object):
             spec = self.interp_func(np.log(angle))
         return np.where(non_zero, spec, self.spec0)
 
+class MultiSpectrumInterp(object):
+    """
+    Interpolation of a set of spectra sampled at the same angles (or ells), 
+    given as the columns of a (n_angle, n_spectra) array.  Each column is 
+    interpolated exactly as SpectrumInterp would, but the columns sharing 
+    an interpolation type (loglog, minus_loglog, log_ang) are done together 
+    in a single call.
+    """
+
+    def __init__(self, angle, specs, kind='cubic'):
+        assert np.all(angle>=0.)
+        specs = np.atleast_2d(np.asarray(specs, dtype=float).T).T
+        self.n_spec = specs.shape[1]
+        self.spec0 = np.zeros(self.n_spec)
+        if angle[0]<1.e-9:
+            self.spec0 = specs[0].copy()
+            angle, specs = angle[1:], specs[1:]
+        log_angle = np.log(angle)
+
+        positive = np.all(specs > 0, axis=0)
+        negative = np.all(specs < 0, axis=0)
+        mixed = ~(positive | negative)
+
+        # One interpolator for each interpolation type that is present,
+        # with the column indices it is responsible for.
+        self.groups = []
+        if positive.any():
+            cols, = np.where(positive)
+            f = interp.interp1d(log_angle, np.log(specs[:, cols]), axis=0,
+                                bounds_error=False, kind=kind)
+            self.groups.append((cols, f, 'loglog'))
+        if negative.any():
+            cols, = np.where(negative)
+            f = interp.interp1d(log_angle, np.log(-specs[:, cols]), axis=0,
+                                bounds_error=False, kind=kind)
+            self.groups.append((cols, f, 'minus_loglog'))
+        if mixed.any():
+            cols, = np.where(mixed)
+            f = interp.interp1d(log_angle, specs[:, cols], axis=0,
+                                bounds_error=False, fill_value=0., kind=kind)
+            self.groups.append((cols, f, 'log_ang'))
+
+    def __call__(self, angle):
+        """Returns an (n_angle, n_spectra) array"""
+        angle = np.asarray(angle, dtype=float)
+        non_zero = angle>1.e-12
+        log_angle = np.log(np.where(non_zero, angle, 1.))
+        spec = np.zeros((len(angle), self.n_spec))
+        for cols, f, interp_type in self.groups:
+            if interp_type == 'loglog':
+                spec[:, cols] = np.exp(f(log_angle))
+            elif interp_type == 'minus_loglog':
+                spec[:, cols] = -np.exp(f(log_angle))
+            else:
+                spec[:, cols] = f(log_angle)
+        return np.where(non_zero[:, np.newaxis], spec, self.spec0)
+
 def radians_to_arcmin(r):
     return np.degrees(r) * 60
 
@@ -59,8 +116,7 @@ def cl_to_xi_to_block_eb(block, output_section, name,
         except TypeError:
             ells = np.arange(ell_max + 1)
             cl_interp = cl_interp(ells)
-        for it, t in enumerate(thetas):
-            xis[it] = np.sum(cl_interp * leg[it])
+        xis[:] = np.dot(leg, cl_interp)
         block[o, name] = xis
 
 
@@ -77,8 +133,7 @@ def cl_to_xi_to_block(block, output_section, name,
         except TypeError:
             ells = np.arange(ell_max + 1)
             cl_interp = cl_interp(ells)
-        for it, t in enumerate(thetas):
-            xis[it] = np.sum(cl_interp * leg[it])
+        xis[:] = np.dot(leg, cl_interp)
         block[o, name] = xis
 
 def cl_to_xi_precomp_00_02(cl_input, thetas, legfacs):
@@ -92,8 +147,7 @@ def cl_to_xi_precomp_00_02(cl_input, thetas, legfacs):
         ells = np.arange(ell_max + 1)
         cl_input = cl_input(ells)
 
-    for it, t in enumerate(thetas):
-        xis[it] = np.sum(cl_input * legfacs[it])
+    xis[:] = np.dot(legfacs, cl_input)
     return xis
 
 def cl_to_xi_plus_and_minus_precomp(cl_input, thetas, G_plus_minus_pre):
@@ -110,14 +164,10 @@ def cl_to_xi_plus_and_minus_precomp(cl_input, thetas, G_plus_minus_pre):
     N_ell[:2] = 0.
     assert G_plus_pre.shape[0] == G_minus_pre.shape[0] == len(thetas)
     assert G_plus_pre.shape[1] == G_minus_pre.shape[1] == ell_max + 1
-    C_plus, C_cross = np.zeros_like(thetas), np.zeros_like(thetas)
     Cls = cl_input(ells)
-    for i, theta in enumerate(thetas):
-        # print theta, G_plus, G_minus
-        C_plus[i] = np.sum(((2 * ells + 1) / 2. / pi) *
-                           N_ell**2 * Cls * G_plus_pre[i]) / 2
-        C_cross[i] = np.sum(((2 * ells + 1) / 2. / pi) *
-                            N_ell**2 * Cls * G_minus_pre[i]) / 2
+    weighted_cls = ((2 * ells + 1) / 2. / pi) * N_ell**2 * Cls
+    C_plus = np.dot(G_plus_pre, weighted_cls) / 2
+    C_cross = np.dot(G_minus_pre, weighted_cls) / 2
 
     xi_plus = C_plus + C_cross
     xi_minus = C_plus - C_cross
@@ -4,14 +4,19 @@ from __future__ import print_function
 from builtins import range
 import numpy as np
 from cosmosis.datablock import option_section, names as section_names
-from cl_to_xi import save_xi_00_02, save_xi_22, arcmin_to_radians, SpectrumInterp, cl_to_xi_to_block, cl_to_xi_to_block_eb
+from cl_to_xi import save_xi_00_02, save_xi_22, arcmin_to_radians, SpectrumInterp, cl_to_xi_to_block, cl_to_xi_to_block_eb, \
+    MultiSpectrumInterp
 from legendre import get_legfactors_00, get_legfactors_02, get_legfactors_22, precomp_GpGm, apply_filter, get_legfactors_02_binav, get_legfactors_00_binav, get_legfactors_22_binav
 import sys
 import os
+import hashlib
+import tempfile
 dirname = os.path.split(__file__)[0]
 twopoint_path = os.path.join(dirname,"..","..","likelihood","2pt")
 sys.path.insert(0, twopoint_path)
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
 import twopoint
+import packed_spectra
 import warnings
 
 def read_theta(filename, xi_type_2pt, theta_type = 'centers', desired_units = 'arcmin'):
@@ -44,6 +49,74 @@ def read_theta(filename, xi_type_2pt, theta_type = 'centers', desired_units = 'a
 
 
 
+# Bump this if the way the Legendre factors are computed changes,
+# to invalidate any cached tables.
+LEGFACS_CACHE_VERSION = 1
+
+def legfacs_cache_filename(cache_dir, precomp_func, theta_values, ell_max, high_l_filter):
+    """
+    Content-addressed name for a cached table of Legendre factors, built
+    from everything the table depends on: the transform type, the theta 
+    values or edges (in radians), ell_max, and the high-ell filter.
+    """
+    h = hashlib.sha1()
+    h.update(str(LEGFACS_CACHE_VERSION).encode())
+    h.update(precomp_func.__name__.encode())
+    h.update(np.ascontiguousarray(theta_values, dtype=np.float64).tobytes())
+    h.update(str(int(ell_max)).encode())
+    h.update(repr(float(high_l_filter)).encode())
+    return os.path.join(cache_dir, "legfacs_{}.npy".format(h.hexdigest()))
+
+def compute_legfacs(precomp_func, theta_values, ell_max, high_l_filter):
+    # This is the (potentially) slow bit - actually work out the Legendre coefficients
+    legfacs = precomp_func(np.arange(ell_max + 1), theta_values)
+
+    if high_l_filter>0:
+        if isinstance(legfacs, tuple):
+            legfacs = (
+                apply_filter(ell_max, high_l_filter, legfacs[0]), 
+                apply_filter(ell_max, high_l_filter, legfacs[1])
+            )
+        else:
+            legfacs = apply_filter( ell_max, high_l_filter, legfacs )
+    return legfacs
+
+def load_or_compute_legfacs(cache_dir, precomp_func, theta_values, ell_max, high_l_filter):
+    """
+    Get the Legendre factor tables, from the on-disk cache in cache_dir if
+    they are there, or by computing them and saving them there if not.
+
+    Cached tables are memory-mapped read-only, so processes on the same
+    node share a single copy through the page cache.
+    """
+    filename = legfacs_cache_filename(cache_dir, precomp_func, theta_values, ell_max, high_l_filter)
+
+    if os.path.exists(filename):
+        print("Loading cached Legendre factors from {}".format(filename))
+        legfacs = np.load(filename, mmap_mode='r')
+        # Tuples of tables (e.g. for xi+ and xi-) are stored stacked.
+        if legfacs.ndim == 3:
+            legfacs = tuple(legfacs)
+        return legfacs
+
+    legfacs = compute_legfacs(precomp_func, theta_values, ell_max, high_l_filter)
+
+    # Write to a temporary file and then rename it, so that other processes 
+    # doing the same thing at the same time never see a partial file.
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, suffix=".npy.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.array(legfacs))
+        os.replace(tmp_filename, filename)
+        print("Saved Legendre factors to cache file {}".format(filename))
+    except OSError as error:
+        warnings.warn("Could not save Legendre factors to cache: {}".format(error))
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+    return legfacs
+
 def setup(options):
 
     xi_type = options.get_string(option_section, 'xi_type')
@@ -76,6 +149,9 @@ def setup(options):
     #Filter the Cls at high ell to reduce ringing:
     high_l_filter = options.get_double(option_section, "high_l_filter", 0.75)
 
+    # Optional directory in which to cache the Legendre factor tables
+    cache_dir = options.get_string(option_section, "cache_dir", "")
+
     # How to get the theta mid-points from the edges.
     two_thirds_midpoint = options.get_bool(option_section, "two_thirds_midpoint", True)
 
@@ -249,21 +325,14 @@ def setup(options):
 
     print("Computing coefficients to transform {} -> {}".format(cl_section, output_section))
 
-    # This is the (potentially) slow bit - actually work out the Legendre coefficients
-    if bin_avg:
-        legfacs = precomp_func(np.arange(ell_max + 1), theta_edges)
-    else:
-        legfacs = precomp_func(np.arange(ell_max + 1), theta)
-
+    # The Legendre coefficients depend on the theta bin edges if
+    # we are bin-averaging, or on the theta values if not.
+    theta_values = theta_edges if bin_avg else theta
 
-    if high_l_filter>0:
-        if isinstance(legfacs, tuple):
-            legfacs = (
-                apply_filter(ell_max, high_l_filter, legfacs[0]), 
-                apply_filter(ell_max, high_l_filter, legfacs[1])
-            )
-        else:
-            legfacs = apply_filter( ell_max, high_l_filter, legfacs )
+    if cache_dir:
+        legfacs = load_or_compute_legfacs(cache_dir, precomp_func, theta_values, ell_max, high_l_filter)
+    else:
+        legfacs = compute_legfacs(precomp_func, theta_values, ell_max, high_l_filter)
 
     return xi_type, theta, theta_edges, ell_max, legfacs, cl_section, output_section, save_name, bin_avg, e_plus_b_name
 
@@ -280,6 +349,15 @@ def combine_eb(block, ee_section, bb_section, e_plus_b_name):
     block[m_section, "ell"] = ell
     block[p_section, "nbin"] = nbin_shear
     block[m_section, "nbin"] = nbin_shear
+
+    if packed_spectra.has_packed(block, ee_section):
+        layout = packed_spectra.section_layout(block, ee_section)
+        ee, mask = packed_spectra.get_packed(block, ee_section)
+        bb, _ = packed_spectra.get_packed(block, bb_section)
+        packed_spectra.put_packed(block, p_section, ee + bb, mask, layout)
+        packed_spectra.put_packed(block, m_section, ee - bb, mask, layout)
+        return p_section, m_section
+
     for i in range(nbin_shear):
         for j in range(0,i+1):
             bin_ij = 'bin_{0}_{1}'.format(i+1,j+1)
@@ -312,26 +390,33 @@ def execute(block, config):
         output_section = (output_section,)
         legfacs = (legfacs,)
 
-    for i in range(1, nbina + 1):
-        for j in range(1, nbinb + 1):
-            name = 'bin_%d_%d' % (i, j)
-            if not block.has_value(cl_section, name):
-                continue
-
-            if xi_type == "EB":
-                # Get the E+B and E-B separately.
-                # These were just calculated above when we called combine_eb 
-                e_plus_b = block[p_section, name]
-                e_minus_b = block[m_section, name]
-                e_plus_b_interp = SpectrumInterp(ell, e_plus_b)
-                e_minus_b_interp = SpectrumInterp(ell, e_minus_b)
-                cl_to_xi_to_block_eb(block, output_section, name,
-                              e_plus_b_interp, e_minus_b_interp, thetas, legfacs)
-            else:
-                c_ell = block[cl_section, name]
-                cl_interp = SpectrumInterp(ell, c_ell)
-                cl_to_xi_to_block(block, output_section, name,
-                              cl_interp, thetas, legfacs)
+    # All the bin pairs present in the input, in either layout.
+    # The output is saved in the same layout.
+    layout = packed_spectra.section_layout(block, cl_section)
+    c_ells, mask = packed_spectra.get_packed(block, cl_section)
+    pairs = np.nonzero(mask)
+
+    if len(pairs[0]):
+        # Interpolate all the bin pairs onto integer ell together into
+        # an (n_ell, n_pair) matrix, and then transform all of them at once 
+        # with a single matrix product for each output.
+        ells = np.arange(ell_max + 1)
+        if xi_type == "EB":
+            # Get the E+B and E-B separately.
+            # These were just calculated above when we called combine_eb 
+            e_plus_b = packed_spectra.get_packed(block, p_section)[0][pairs].T
+            e_minus_b = packed_spectra.get_packed(block, m_section)[0][pairs].T
+            cl_matrices = (MultiSpectrumInterp(ell, e_plus_b)(ells), 
+                           MultiSpectrumInterp(ell, e_minus_b)(ells))
+        else:
+            cl_matrix = MultiSpectrumInterp(ell, c_ells[pairs].T)(ells)
+            cl_matrices = (cl_matrix,) * len(output_section)
+
+        for (o, leg, cl_matrix) in zip(output_section, legfacs, cl_matrices):
+            xis = np.dot(leg, cl_matrix)
+            xi_packed = np.zeros(mask.shape + (xis.shape[0],))
+            xi_packed[pairs] = xis.T
+            packed_spectra.put_packed(block, o, xi_packed, mask, layout)
 
     if isinstance(output_section, str):
         output_section = (output_section,)
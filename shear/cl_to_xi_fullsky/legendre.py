@@ -5,6 +5,23 @@ from scipy.special import lpn
 
 PI=np.pi
 
+def lpn_array(n, x):
+    """
+    Legendre polynomials P_l(x) and their derivatives for all l from 
+    0 to n inclusive, for an array of x values.  Returns two arrays
+    with shape (n+1,) + x.shape, like scipy.special.lpn.
+    """
+    x = np.asarray(x, dtype=float)
+    try:
+        return lpn(n, x)
+    except ValueError:
+        # Older versions of scipy only accept scalar x
+        pn = np.zeros((n + 1,) + x.shape)
+        pd = np.zeros_like(pn)
+        for index in np.ndindex(x.shape):
+            pn[(slice(None),) + index], pd[(slice(None),) + index] = lpn(n, x[index])
+        return pn, pd
+
 def sin_filter(ell_max, ell_right):
     ells = np.arange(ell_max+1)
     y = (ell_max-ells)/(ell_max-ell_right)
@@ -43,20 +60,15 @@ def get_F_theta_l(theta_vals, ell_max, cl2xi_type, high_l_filter=0.75):
     return leg_factors
 
 def get_legfactors_00(ells, thetas):
-    n_ell, n_theta = len(ells), len(thetas)
-    legfacs = np.zeros((n_theta, n_ell))
-    for it, t in enumerate(thetas):
-        legfacs[it] = (2 * ells + 1) * lpn(ells[-1], np.cos(t))[0] / 4. / PI
+    Pl = lpn_array(ells[-1], np.cos(thetas))[0].T
+    legfacs = (2 * ells + 1) * Pl / 4. / PI
     return legfacs
 
 def get_legfactors_02(ells, thetas):
-    n_ell, n_theta = len(ells), len(thetas)
-    legfacs = np.zeros((n_theta, n_ell))
     ell_factor = np.zeros(len(ells))
     ell_factor[1:] = (2 * ells[1:] + 1) / 4. / PI / ells[1:] / (ells[1:] + 1)
-    for it, t in enumerate(thetas):
-        P2l = P2l_rec_norm(ells, np.cos(t))
-        legfacs[it] = P2l * ell_factor
+    P2l = P2l_rec_norm(ells, np.cos(thetas))
+    legfacs = P2l * ell_factor
     return legfacs
 
 def get_legfactors_22(ells, thetas):
@@ -68,58 +80,57 @@ def get_legfactors_22(ells, thetas):
     return ( leg_factors_p, leg_factors_m )
 
 def P2l_rec(ells, cost):
-    """Calculate P2l using recurrence relation"""
+    """Calculate P2l using recurrence relation.
+    cost may be a scalar or an array, in which case the result 
+    has shape cost.shape + (len(ells),)"""
+    cost = np.asarray(cost, dtype=float)
     P22 = 3 * (1 - cost**2)
     P23 = 15 * cost * (1 - cost**2)
-    P2l = np.zeros(len(ells))
-    P2l[0] = 0.
-    P2l[1] = 0.
+    # The recurrence runs along the first axis so each step 
+    # updates a contiguous row for all cos(theta) at once
+    P2l = np.zeros((len(ells),) + cost.shape)
     P2l[2] = P22
     P2l[3] = P23
     for ell in ells[4:]:
-        # print ell, P2l[ell-1], P2l[ell-2]
         P2l[ell] = ((2 * ell - 1) * cost * P2l[ell - 1] -
                     (ell + 2 - 1) * P2l[ell - 2]) / (ell - 2)
-    return P2l
+    return np.moveaxis(P2l, 0, -1)
 
 def P2l_norm_prefac(ell):
     return np.sqrt((2. * ell + 1) / ((ell - 1.) * ell * (ell + 1.) * (ell + 2.)) / 4. / PI)
 
 def P2l_rec_norm(ells, cost):
-    """Calculate P2l using recurrence relation for normalised P2l"""
+    """Calculate P2l using recurrence relation for normalised P2l.
+    cost may be a scalar or an array, in which case the result 
+    has shape cost.shape + (len(ells),)"""
+    cost = np.asarray(cost, dtype=float)
     P22 = 3. * (1. - cost**2)
     P23 = 15. * cost * (1. - cost**2)
-    P2l = np.zeros(len(ells))
-    P2l[0] = 0.
-    P2l[1] = 0.
+    # The recurrence runs along the first axis so each step 
+    # updates a contiguous row for all cos(theta) at once
+    P2l = np.zeros((len(ells),) + cost.shape)
     P2l[2] = P22
     P2l[3] = P23
     P2l_norm = np.copy(P2l)
     P2l_norm[2] *= P2l_norm_prefac(2)
     P2l_norm[3] *= P2l_norm_prefac(3)
-    for ell in ells[4:]:
-        # print ell, P2l[ell-1], P2l[ell-2]
-        a = np.sqrt((4 * ell**2 - 1.) / (ell**2 - 4))
-        b = cost * P2l_norm[ell - 1]
-        c = np.sqrt(((ell - 1.)**2 - 4) /
-                    (4 * (ell - 1.)**2 - 1)) * P2l_norm[ell - 2]
-        # print a,b,c
-        P2l_norm[ell] = a * (b - c)
-        # print ell, P2l_norm[ell], P2l_norm_prefac(ell)
-        P2l[ell] = P2l_norm[ell] / P2l_norm_prefac(ell)
-    return P2l
+
+    # The ell-dependent coefficients, for all ell at once
+    ell = ells[4:]
+    a = np.sqrt((4 * ell**2 - 1.) / (ell**2 - 4))
+    c = np.sqrt(((ell - 1.)**2 - 4) / (4 * (ell - 1.)**2 - 1))
+    for i, ell_i in enumerate(ell):
+        P2l_norm[ell_i] = a[i] * (cost * P2l_norm[ell_i - 1] - c[i] * P2l_norm[ell_i - 2])
+
+    prefac = P2l_norm_prefac(ell)
+    P2l[4:] = P2l_norm[4:] / prefac.reshape((-1,) + (1,) * cost.ndim)
+    return np.moveaxis(P2l, 0, -1)
 
 def precomp_GpGm(ells, thetas):
     """G+/- eqn. 2.26 and 2.27 from astro-ph/9611125v1"""
-    n_ell, n_theta = len(ells), len(thetas)
-    P_m_l = np.zeros((n_theta, n_ell))
-    P_m_lminus1 = np.zeros_like(P_m_l)
     costs = np.cos(thetas)
-    sints = np.sin(thetas)
-    for it in range(n_theta):
-        P_m_l[it] = P2l_rec_norm(ells, costs[it])
-        # for il in range(n_ell):
-        #    P_m_l[it,il] = sp.lpmv(2, ells[il], costs[it])
+    P_m_l = P2l_rec_norm(ells, costs)
+    P_m_lminus1 = np.zeros_like(P_m_l)
     P_m_lminus1[:, 1:] = P_m_l[:, :-1]
     ELLS, THETAS = np.meshgrid(ells, thetas)
     COSTS, SINTS = np.cos(THETAS), np.sin(THETAS)
@@ -152,10 +163,12 @@ def G_plus_minus_l2(ells, theta, s_switch=100.):
     return G_plus, G_minus
     
 def P2l_rec_binav(ells, cost_min, cost_max):
-    """Calculate P2l using recurrence relation for normalised P2l"""
-    P2l_binav = np.zeros(len(ells))
-    P2l_binav[0] = 0.
-    P2l_binav[1] = 0.
+    """Calculate P2l using recurrence relation for normalised P2l.
+    cost_min and cost_max may be scalars or arrays, in which case the 
+    result has shape cost_min.shape + (len(ells),)"""
+    cost_min = np.asarray(cost_min, dtype=float)[..., np.newaxis]
+    cost_max = np.asarray(cost_max, dtype=float)[..., np.newaxis]
+    P2l_binav = np.zeros(cost_min.shape[:-1] + (len(ells),))
     # coefficients that are a function of ell only
     ell = ells[2:]
     coeff_lm1 = ell+2./(2.*ell+1.)
@@ -163,16 +176,16 @@ def P2l_rec_binav(ells, cost_min, cost_max):
     coeff_l   = 2.-ell
     # computation of legendre polynomials
     # --- this computes all polynomials of order 0 to ell_max+1 and for all ell's
-    lpns_min = lpn(ell[-1]+1, cost_min)[0][1:]
-    lpns_max = lpn(ell[-1]+1, cost_max)[0][1:]
+    lpns_min = np.moveaxis(lpn_array(ell[-1]+1, cost_min[..., 0])[0][1:], 0, -1)
+    lpns_max = np.moveaxis(lpn_array(ell[-1]+1, cost_max[..., 0])[0][1:], 0, -1)
     # terms in the numerator of average P2l
-    term_lm1 = coeff_lm1 * (lpns_max[:-2]-lpns_min[:-2])
-    term_lp1 = coeff_lp1 * (lpns_max[2:]-lpns_min[2:])
-    term_l   = coeff_l   * (cost_max*lpns_max[1:-1]-cost_min*lpns_min[1:-1])
+    term_lm1 = coeff_lm1 * (lpns_max[..., :-2]-lpns_min[..., :-2])
+    term_lp1 = coeff_lp1 * (lpns_max[..., 2:]-lpns_min[..., 2:])
+    term_l   = coeff_l   * (cost_max*lpns_max[..., 1:-1]-cost_min*lpns_min[..., 1:-1])
     # denominator in average P2l
     dcost = cost_max-cost_min
     # computation of bin-averaged P2l(ell)
-    P2l_binav[ell] = (term_lm1 + term_l - term_lp1) / dcost
+    P2l_binav[..., ell] = (term_lm1 + term_l - term_lp1) / dcost
     return P2l_binav
 
 def Gp_plus_minus_Gm_binav_dep1(ells, cost_min, cost_max):
@@ -230,23 +243,27 @@ def Gp_plus_minus_Gm_binav_dep1(ells, cost_min, cost_max):
     return Gp_plus_Gm, Gp_minus_Gm
 
 def Pl_rec_binav(ells, cost_min, cost_max):
-    """Calculate average Pl"""
-    Pl_binav = np.zeros(len(ells))
-    Pl_binav[0] = 1.
+    """Calculate average Pl.
+    cost_min and cost_max may be scalars or arrays, in which case the 
+    result has shape cost_min.shape + (len(ells),)"""
+    cost_min = np.asarray(cost_min, dtype=float)[..., np.newaxis]
+    cost_max = np.asarray(cost_max, dtype=float)[..., np.newaxis]
+    Pl_binav = np.zeros(cost_min.shape[:-1] + (len(ells),))
+    Pl_binav[..., 0] = 1.
     # coefficients that are a function of ell only
     ell = ells[1:]
     coeff = 1./(2.*ell+1.)
     # computation of legendre polynomials
     # --- this computes all polynomials of order 0 to ell_max+1 and for all ell's
-    lpns_min = lpn(ell[-1]+1, cost_min)[0]
-    lpns_max = lpn(ell[-1]+1, cost_max)[0]
+    lpns_min = np.moveaxis(lpn_array(ell[-1]+1, cost_min[..., 0])[0], 0, -1)
+    lpns_max = np.moveaxis(lpn_array(ell[-1]+1, cost_max[..., 0])[0], 0, -1)
     # terms in the numerator of average Pl
-    term_lm1 = lpns_max[:-2] - lpns_min[:-2]
-    term_lp1 = lpns_max[2:] - lpns_min[2:]
+    term_lm1 = lpns_max[..., :-2] - lpns_min[..., :-2]
+    term_lp1 = lpns_max[..., 2:] - lpns_min[..., 2:]
     # denominator in average Pl
     dcost = cost_max-cost_min
     # computation of bin-averaged Pl(ell)
-    Pl_binav[ell] = coeff * (term_lp1 - term_lm1) / dcost
+    Pl_binav[..., ell] = coeff * (term_lp1 - term_lm1) / dcost
     return Pl_binav
 
 def theta_bin_means_to_edges(thetas, binning='log'):
@@ -284,34 +301,24 @@ def theta_bin_means_to_edges(thetas, binning='log'):
     
 def get_legfactors_02_binav(ells, theta_edges):
     print('getting bin averaged leg factors for 02')
-    n_ell, n_theta = len(ells), len(theta_edges)-1
     #theta_edges = theta_bin_means_to_edges(thetas) # this does geometric mean
-    legfacs = np.zeros((n_theta, n_ell))
     ell_factor = np.zeros(len(ells))
     ell_factor[1:] = (2 * ells[1:] + 1) / 4. / PI / ells[1:] / (ells[1:] + 1)
-    for it, t in enumerate(theta_edges[1:]):
-        t_min = theta_edges[it]
-        t_max = t
-        cost_min = np.cos(t_min) # thetas are already converted to radians
-        cost_max = np.cos(t_max)
-        P2l = P2l_rec_binav(ells, cost_min, cost_max)
-        legfacs[it] = P2l * ell_factor
+    cost_min = np.cos(theta_edges[:-1]) # thetas are already converted to radians
+    cost_max = np.cos(theta_edges[1:])
+    P2l = P2l_rec_binav(ells, cost_min, cost_max)
+    legfacs = P2l * ell_factor
     return legfacs
 
 def get_legfactors_00_binav(ells, theta_edges):
     print('getting bin averaged leg factors for 00')
-    n_ell, n_theta = len(ells), len(theta_edges)-1
     #theta_edges = theta_bin_means_to_edges(thetas) # this does geometric mean
-    legfacs = np.zeros((n_theta, n_ell))
     ell_factor = np.zeros(len(ells))
     ell_factor[1:] = (2 * ells[1:] + 1) / 4. / PI
-    for it, t in enumerate(theta_edges[1:]):
-        t_min = theta_edges[it]
-        t_max = t
-        cost_min = np.cos(t_min) # thetas are already converted to radians
-        cost_max = np.cos(t_max)
-        Pl = Pl_rec_binav(ells, cost_min, cost_max)
-        legfacs[it] = Pl * ell_factor
+    cost_min = np.cos(theta_edges[:-1]) # thetas are already converted to radians
+    cost_max = np.cos(theta_edges[1:])
+    Pl = Pl_rec_binav(ells, cost_min, cost_max)
+    legfacs = Pl * ell_factor
     return legfacs
 
 def Gp_plus_minus_Gm_binav_dep2(ells, cost_min, cost_max):
@@ -369,13 +376,14 @@ def Gp_plus_minus_Gm_binav_dep2(ells, cost_min, cost_max):
     return Gp_plus_Gm, Gp_minus_Gm
     
 def Gp_plus_minus_Gm_binav(ells, cost_min, cost_max):
-    """Calculate bin-averaged G_{l,2}^{+/-}"""
-    Gp_plus_Gm  = np.zeros(len(ells))
-    Gp_minus_Gm = np.zeros(len(ells))
-
+    """Calculate bin-averaged G_{l,2}^{+/-}.
+    cost_min and cost_max may be scalars or arrays, in which case the 
+    results have shape cost_min.shape + (len(ells),)"""
+    cost_min = np.asarray(cost_min, dtype=float)[..., np.newaxis]
+    cost_max = np.asarray(cost_max, dtype=float)[..., np.newaxis]
     # for ell=0,1 it is 0
-    Gp_plus_Gm[0:1]  = 0.
-    Gp_minus_Gm[0:1] = 0.
+    Gp_plus_Gm  = np.zeros(cost_min.shape[:-1] + (len(ells),))
+    Gp_minus_Gm = np.zeros(cost_min.shape[:-1] + (len(ells),))
 
     # for the rest of ell's compute equation (5.8) in https://arxiv.org/abs/1911.11947
     ell = ells[2:]
@@ -392,30 +400,32 @@ def Gp_plus_minus_Gm_binav(ells, cost_min, cost_max):
 
     # computation of legendre polynomials
     #---this computes all polynomials of order 0 to ell_max+1 and for all ell's
-    lpns_min  = lpn(ell[-1]+1, cost_min)[0][1:]
-    lpns_max  = lpn(ell[-1]+1, cost_max)[0][1:]
-    dlpns_min = lpn(ell[-1]+1, cost_min)[1][1:]
-    dlpns_max = lpn(ell[-1]+1, cost_max)[1][1:]
+    Pl_min, dPl_min = lpn_array(ell[-1]+1, cost_min[..., 0])
+    Pl_max, dPl_max = lpn_array(ell[-1]+1, cost_max[..., 0])
+    lpns_min  = np.moveaxis(Pl_min[1:], 0, -1)
+    lpns_max  = np.moveaxis(Pl_max[1:], 0, -1)
+    dlpns_min = np.moveaxis(dPl_min[1:], 0, -1)
+    dlpns_max = np.moveaxis(dPl_max[1:], 0, -1)
 
     # denominator in average
     dcost = cost_max-cost_min
 
     # numerator in average
     #---common part in both plus and minus
-    common_part  = coeff_lm1*(lpns_max[:-2]-lpns_min[:-2])
-    common_part += coeff_l*(cost_max*lpns_max[1:-1] - cost_min*lpns_min[1:-1])
-    common_part += coeff_lp1*(lpns_max[2:]-lpns_min[2:])
-    common_part += coeff_dl*(dlpns_max[1:-1]-dlpns_min[1:-1])
-    common_part += coeff_xdlm1*(cost_max*dlpns_max[:-2]-cost_min*dlpns_min[:-2])
+    common_part  = coeff_lm1*(lpns_max[..., :-2]-lpns_min[..., :-2])
+    common_part += coeff_l*(cost_max*lpns_max[..., 1:-1] - cost_min*lpns_min[..., 1:-1])
+    common_part += coeff_lp1*(lpns_max[..., 2:]-lpns_min[..., 2:])
+    common_part += coeff_dl*(dlpns_max[..., 1:-1]-dlpns_min[..., 1:-1])
+    common_part += coeff_xdlm1*(cost_max*dlpns_max[..., :-2]-cost_min*dlpns_min[..., :-2])
     #---plus
-    Gp_plus_Gm_extra  = coeff_xdl_plus*(cost_max*dlpns_max[1:-1]-cost_min*dlpns_min[1:-1])
-    Gp_plus_Gm_extra += coeff_l_plus*(lpns_max[1:-1] - lpns_min[1:-1])
-    Gp_plus_Gm_extra += coeff_dlm1_plus*(dlpns_max[:-2]-dlpns_min[:-2])
-    Gp_plus_Gm[2:] = common_part + Gp_plus_Gm_extra
+    Gp_plus_Gm_extra  = coeff_xdl_plus*(cost_max*dlpns_max[..., 1:-1]-cost_min*dlpns_min[..., 1:-1])
+    Gp_plus_Gm_extra += coeff_l_plus*(lpns_max[..., 1:-1] - lpns_min[..., 1:-1])
+    Gp_plus_Gm_extra += coeff_dlm1_plus*(dlpns_max[..., :-2]-dlpns_min[..., :-2])
+    Gp_plus_Gm[..., 2:] = common_part + Gp_plus_Gm_extra
     Gp_plus_Gm /= dcost
     #---minus
     Gp_minus_Gm_extra = -Gp_plus_Gm_extra
-    Gp_minus_Gm[2:] = common_part + Gp_minus_Gm_extra
+    Gp_minus_Gm[..., 2:] = common_part + Gp_minus_Gm_extra
     Gp_minus_Gm /= dcost
 
     return Gp_plus_Gm, Gp_minus_Gm
@@ -423,18 +433,12 @@ def Gp_plus_minus_Gm_binav(ells, cost_min, cost_max):
 
 def get_legfactors_22_binav(ells, theta_edges):
     print('getting bin averaged leg factors for 22')
-    n_ell, n_theta = len(ells), len(theta_edges)-1
     #theta_edges = theta_bin_means_to_edges(thetas) # this does geometric mean
-    leg_factors_p  = np.zeros((n_theta, n_ell))
-    leg_factors_m = np.zeros((n_theta, n_ell))
     ell_factor = np.zeros(len(ells))
     ell_factor[2:] = (2 * ells[2:] + 1) / 2. / PI / ells[2:] / ells[2:] / (ells[2:]+1.) / (ells[2:]+1.)
-    for it, t in enumerate(theta_edges[1:]):
-        t_min = theta_edges[it]
-        t_max = t
-        cost_min = np.cos(t_min) # thetas are already converted to radians
-        cost_max = np.cos(t_max)
-        gp, gm = Gp_plus_minus_Gm_binav(ells, cost_min, cost_max)
-        leg_factors_p[it] = gp * ell_factor
-        leg_factors_m[it] = gm * ell_factor
+    cost_min = np.cos(theta_edges[:-1]) # thetas are already converted to radians
+    cost_max = np.cos(theta_edges[1:])
+    gp, gm = Gp_plus_minus_Gm_binav(ells, cost_min, cost_max)
+    leg_factors_p = gp * ell_factor
+    leg_factors_m = gm * ell_factor
     return ( leg_factors_p, leg_factors_m )
@@ -2,6 +2,7 @@ from cosmosis.datablock import option_section, names
 import ctypes as ct
 import numpy.ctypeslib as ctl
 import numpy as np
+import scipy.sparse
 
 import os
 import sys
@@ -9,7 +10,9 @@ import sys
 dirname = os.path.split(__file__)[0]
 tp_dir = os.path.abspath(os.path.join(dirname,'../../likelihood/2pt/'))
 sys.path.append(tp_dir)
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
 import twopoint
+import packed_spectra
 
 # This opens a library written in C
 lib = ct.cdll.LoadLibrary("{}/wigner_d.so".format(dirname))
@@ -21,6 +24,15 @@ lib.wigner_d.restype = None
 lib.wigner_d.argtypes = [ ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_double,
     np.ctypeslib.ndpointer(dtype=np.double, ndim=1, flags=("C_CONTIGUOUS","WRITEABLE")) ]
 
+# The same, but for an array of theta values at once, filling the rows of
+# an (ntheta, l1-l0+1) array
+# void wigner_d_array(int l0, int l1, int n, int m, int ntheta,
+#                     const double* theta, double* d);
+lib.wigner_d_array.restype = None
+lib.wigner_d_array.argtypes = [ ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int,
+    np.ctypeslib.ndpointer(dtype=np.double, ndim=1, flags="C_CONTIGUOUS"),
+    np.ctypeslib.ndpointer(dtype=np.double, ndim=2, flags=("C_CONTIGUOUS","WRITEABLE")) ]
+
 # These are constants that describe which transform to do
 XI_PLUS  = 0
 XI_MINUS = 1
@@ -32,6 +44,39 @@ XIMINUS_TYPE = (twopoint.Types.galaxy_shear_minus_real, twopoint.Types.galaxy_sh
 GAMMAT_TYPE  = (twopoint.Types.galaxy_position_real, twopoint.Types.galaxy_shear_plus_real)
 WTHETA_TYPE  = (twopoint.Types.galaxy_position_real, twopoint.Types.galaxy_position_real)
 
+def interpolation_matrix(ell, lint):
+    """
+    Sparse (len(lint), len(ell)) matrix W such that W . c_ell linearly
+    interpolates c_ell to the integer l values lint:
+
+        C[l] = (1-x)*c_ell[k] + x*c_ell[k+1]
+
+    Rows for l outside the range of ell are left empty.
+    """
+    # Indices corresponding to ell values
+    lidx = np.arange(len(ell))
+
+    # position of each l in ell array
+    x = np.interp(lint, ell, lidx, left=-1, right=-1)
+
+    # integer and fractional part for interpolation
+    k = x.astype(int)
+    x = x - k
+
+    # check for hitting the last value
+    last = k == lidx[-1]
+    k[last] -= 1
+    x[last] = 1
+
+    # drop the values out of range
+    rows = np.flatnonzero(k != -1)
+    k = k[rows]
+    x = x[rows]
+
+    return scipy.sparse.csr_matrix(
+        (np.concatenate([1-x, x]), (np.concatenate([rows, rows]), np.concatenate([k, k+1]))),
+        shape=(len(lint), len(ell)))
+
 def transform(calc_type, ell, theta):
     # Check calculation type
     if calc_type not in [XI_PLUS, XI_MINUS, GAMMA_T, W_THETA]:
@@ -50,45 +95,22 @@ def transform(calc_type, ell, theta):
     lmax = int(np.max(ell))
     lint = np.arange(lmin, lmax+1)
 
-    # Indices corresponding to ell values
-    lidx = np.arange(len(ell))
-
-    # transformation matrix to go from cl to xi
-    tfm = np.zeros((len(theta), len(ell)))
-
-    # Go through theta values
-    for i, t in enumerate(theta):
+    # Wigner d values for every theta and integer l in one call to the C code
+    theta = np.ascontiguousarray(theta, dtype=np.double)
+    d = np.zeros((len(theta), lmax-lmin+1), dtype=np.double)
+    lib.wigner_d_array(lmin, lmax, s1, s2, len(theta), theta, d)
 
-        # Set up output result space
-        d = np.zeros(lmax-lmin+1, dtype=np.double)
+    # Summing over all integer lmin <= l <= lmax, the terms would be
+    #     (2*l + 1)/(4*pi)*C[l]*d[l]
+    # so fold the prefactor into the d values
+    d *= (2*lint + 1)/(4*np.pi)
 
-        # Call C code.
-        lib.wigner_d(lmin, lmax, s1, s2, t, d)
-
-        # Create the transformation from all C_l to xi of this theta:
-        # Summing over all integer lmin <= l <= lmax, the terms would be
-        #     (2*l + 1)/(4*pi)*C[l]*d[l]
-        # However, C[l] at integer l is interpolated from the array of values
-        # at non-integer ell:
-        #     C[l] = (1-x)*c_ell[k] + x*c_ell[k+1]
-        # Hence collect the contribution of each c_ell to xi in a matrix
-        for l, z in zip(lint, (2*lint + 1)/(4*np.pi)*d):
-            # position of l in ell array
-            x = np.interp(l, ell, lidx, left=-1, right=-1)
-
-            # integer and fractional part for interpolation
-            k = int(x)
-            x = x - k
-
-            # check for hitting the last value
-            if k == lidx[-1]:
-                k = k-1
-                x = 1
-
-            # interpolate
-            if k != -1:
-                tfm[i,k] += (1-x)*z
-                tfm[i,k+1] += x*z
+    # The transformation from all C_l to xi is then
+    #     tfm = d . W
+    # where W is the (sparse) linear interpolation matrix from c_ell at
+    # the non-integer ell to C[l] at the integers.
+    W = interpolation_matrix(ell, lint)
+    tfm = (W.T @ d.T).T
 
     # the array to transform from c_ell to theta
     return tfm
@@ -198,6 +220,14 @@ def execute(block, config):
             print('computing transform type {} from ell ({:g}, {:g}, {}) to theta ({:g}, {:g}, {})'.format(corr_type, ell[0], ell[-1], len(ell), theta[0], theta[-1], len(theta)))
             tfm.append(transform(corr_type, ell, theta))
 
+        # Packed sections can be transformed in one matrix product
+        if packed_spectra.has_packed(block, input_section):
+            c_ells, mask = packed_spectra.get_packed(block, input_section)
+            xi = np.zeros(mask.shape + (len(theta),))
+            xi[mask] = c_ells[mask] @ tfm[0].T
+            packed_spectra.put_packed(block, output_section, xi, mask, "packed")
+            continue
+
         for b1 in range(1,nbin_a+1):
             for b2 in range(1,nbin_b+1):
                 name = "bin_{}_{}".format(b1,b2)
@@ -135,3 +135,12 @@ void wigner_d(int l0, int l1, int n, int m, double theta, double* d)
 #endif
     }
 }
+
+void wigner_d_array(int l0, int l1, int n, int m, int ntheta, const double* theta, double* d)
+{
+    int i, nl;
+    
+    nl = l1 - l0 + 1;
+    for(i = 0; i < ntheta; ++i)
+        wigner_d(l0, l1, n, m, theta[i], d + (size_t)i*nl);
+}
@@ -5,7 +5,9 @@ import ctypes as ct
 import scipy as sp
 path = os.path.join(current_dir, '../../structure/projection/projection_tools')
 sys.path.append(path)
+sys.path.append(os.path.join(current_dir, "..", "..", "utility", "packed_spectra"))
 from gsl_wrappers import GSLSpline
+import packed_spectra
 from cosmosis.datablock import names
 from cosmosis.datablock import option_section
 from scipy.interpolate import InterpolatedUnivariateSpline as IUSpline
@@ -96,6 +98,8 @@ def execute(block, config):
         num[ind_lzero] = 0
 
     if config['add_togammat']:
+        # We only know how to add to the bin_i_j layout
+        packed_spectra.require_legacy(block, config["gammat_section"])
         theta_th = block['galaxy_shear_xi','theta']
 
 
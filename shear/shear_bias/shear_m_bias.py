@@ -10,7 +10,12 @@ assuming model values of the multplicative factor m, either per bin or for all b
 from __future__ import print_function
 from builtins import range
 from cosmosis.datablock import names, option_section
+import numpy as np
+import os
 import sys
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
+import packed_spectra
 
 warning_note_displayed = False
 
@@ -49,17 +54,22 @@ def get_nbins(block, section):
 def calibrate_section(block, section, m_a, m_b, verbose):
     n_a = len(m_a)
     n_b = len(m_b)
-    for i in range(n_a):
-        for j in range(n_b):
-
-            # Get existing C_ell
-            cl_name = "bin_{}_{}".format(i + 1, j + 1)
-            if block.has_value(section, cl_name):
-                if verbose:
-                    print("Calibrating {} bin {} {} by (1+{}) * (1+{}) = {}".format(section, i + 1, j + 1, m_a[i], m_b[j], (1 + m_a[i]) * (1 + m_b[j])))
-                block[section, cl_name] *= (1 + m_a[i]) * (1 + m_b[j])
-            elif verbose:
-                print("No {} bin {} {} to calibrate".format(section, i + 1, j + 1))
+
+    # Scale all the bin pairs at once by the (1+m_a[i]) * (1+m_b[j]) matrix,
+    # in whichever layout the section uses
+    cl, mask = packed_spectra.get_packed(block, section)
+    calibration = np.outer(1 + np.array(m_a), 1 + np.array(m_b))
+    cl[:n_a, :n_b] *= calibration[:, :, np.newaxis]
+
+    if verbose:
+        for i in range(n_a):
+            for j in range(n_b):
+                if mask[i, j]:
+                    print("Calibrating {} bin {} {} by (1+{}) * (1+{}) = {}".format(section, i + 1, j + 1, m_a[i], m_b[j], calibration[i, j]))
+                else:
+                    print("No {} bin {} {} to calibrate".format(section, i + 1, j + 1))
+
+    packed_spectra.put_packed(block, section, cl, mask)
 
 
 def calibrate_shear_shear(block, section, cal_section, m_per_bin, verbose):
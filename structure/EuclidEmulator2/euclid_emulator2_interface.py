@@ -46,16 +46,11 @@ def execute(block, config):
 
     # Get z and k from the NL power section
     z, k, P = block.get_grid(input_section, "z", "k_h", "P_k")
-    _, b = ee2.get_boost(params, z, k)
 
-    if len(z) > 100:
-        raise ValueError("EuclidEmulator2 only allows up to 100 redshift values")
-
-    # Not sure why but b comes back as a dictionary of arrays
-    # instead of a 2D array
-    P_boosted = P.copy()
-    for i in range(len(z)):
-        P_boosted[i] *= b[i]
+    # The boost for all z at once, as an (nz, nk) array which we
+    # then scale in-place to make the boosted spectrum
+    _, P_boosted = ee2.get_boost_array(params, z, k)
+    P_boosted *= P
 
     if output_section == input_section:
         # save the original grid to a new section, with _dm added
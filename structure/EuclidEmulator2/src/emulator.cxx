@@ -50,6 +50,10 @@ EuclidEmulator::EuclidEmulator():
 
 	pc_2d_interp();
 
+	for (int ipar=0; ipar < 8; ipar++){
+		univ_legendre[ipar] = new double[lmax+1];
+	}
+
 }
 
 /* DESTRUCTOR */
@@ -57,6 +61,9 @@ EuclidEmulator::~EuclidEmulator(){
 	for(int i=0; i<15; i++) {
 		gsl_spline2d_free(logklogz2pc_spline[i]);
 	}
+	for (int ipar=0; ipar < 8; ipar++){
+		delete[] univ_legendre[ipar];
+	}
 }
 
 /* FUNCTION TO READ IN THE DATA FILE */
@@ -138,46 +145,52 @@ void EuclidEmulator::pc_2d_interp(){
 }
 
 /* COMPUTE NLC */
-//void EuclidEmulator::compute_nlc(Cosmology csm, double* redshift, int n_redshift, double* kmodes, int n_kmodes){
+// Fills the fixed-size Bvec member, so at most nz redshifts per call.
 void EuclidEmulator::compute_nlc(Cosmology csm, vector<double> redshift, int n_redshift){
+	if(n_redshift > nz){
+		std::cout << "ERROR: compute_nlc can only store " << nz << " redshifts in Bvec; " \
+				  << "use compute_nlc_into for more." << std::endl;
+		n_redshift = nz;
+	}
+	compute_nlc_into(csm, redshift.data(), n_redshift, &Bvec[0][0]);
+}
+
+/* COMPUTE NLC INTO A CALLER-SUPPLIED BUFFER */
+// B must hold n_redshift*nk doubles, stored row-major as B[iz*nk + ik].
+// There is no limit on the number of redshifts.
+void EuclidEmulator::compute_nlc_into(Cosmology csm, const double* redshift, int n_redshift, double* B){
 	double pc_weight;
 	double basisfunc;
-	double stp_no[n_redshift];
+	vector<double> stp_no(n_redshift);
+	vector<double> logk(nk);
 
-	//printf("There are %d redshifts to compute.\n", n_redshift);
+	for(int ik=0; ik<nk; ik++) logk[ik] = log(this->kvec[ik]);
 
 	// Convert all redshifts into step numbers
-	// As we are looping through all redshifts anyway, we can just
-	// as well use the same loop to declare Bvec[iz]
 	for(int iz=0; iz<n_redshift; iz++) {
-		if(redshift.at(iz) > 10.0 || redshift.at(iz) < 0.0){
+		if(redshift[iz] > 10.0 || redshift[iz] < 0.0){
 			std::cout << "ERROR: EuclidEmulator2 accepts only redshifts in the interval [0.0, 10.0]\n" \
-					  << "The current redshift z = " << redshift.at(iz) << " is therefore ignored." << std::endl;
+					  << "The current redshift z = " << redshift[iz] << " is therefore ignored." << std::endl;
 			continue;
 		}
-		stp_no[iz] = csm.compute_step_number(redshift.at(iz));
-        //printf("nStep(%.2f) = %.4f\n", redshift.at(iz), stp_no[iz]);
+		stp_no[iz] = csm.compute_step_number(redshift[iz]);
 	}
-	//printf("Redshifts mapped to nStep\n");
 
 	// Pre-compute all Legendre polynomials up to order lmax
 	for (int ipar=0; ipar < 8; ipar++){
-		univ_legendre[ipar] = new double[lmax+1];
 		gsl_sf_legendre_Pl_array(lmax, csm.cosmo_tf[ipar], univ_legendre[ipar]);
 		for (int l=0; l<=lmax; l++){
 			univ_legendre[ipar][l] *= sqrt(2.0*l + 1.0); //normalization
 		}
 	}
-	//printf("Legendre polynomials computed\n");
 
 	// Initialize with PCA mean
 	for(int iz=0; iz<n_redshift; iz++){
+		double * Bz = B + (size_t) iz*nk;
 		for(int ik=0; ik<nk; ik++){
-			Bvec[iz][ik] = gsl_spline2d_eval(logklogz2pc_spline[0], log(this->kvec[ik]), stp_no[iz], logk2pc_acc[0], logz2pc_acc[0]);
+			Bz[ik] = gsl_spline2d_eval(logklogz2pc_spline[0], logk[ik], stp_no[iz], logk2pc_acc[0], logz2pc_acc[0]);
 		}
-		//printf("B(k_max, z=%.2f) = %.2f\n", redshift.at(iz), Bvec[iz][nk-1]);
 	}
-	//printf("PCA initialized\n");
 
 	// Loop over principal components
 	for(int ipc=1; ipc<15; ipc++){
@@ -194,13 +207,12 @@ void EuclidEmulator::compute_nlc(Cosmology csm, vector<double> redshift, int n_r
 		// assemble PCA to get the final NLC according
         // to outer sum of eq. 27 in EE2 paper
 		for(int iz=0; iz<n_redshift; iz++){
-			//printf("Treating z[%d] = %.3f ==> nStep = %.3f\n", iz, redshift.at(iz), stp_no[iz]);
+			double * Bz = B + (size_t) iz*nk;
 			for(int ik=0; ik<nk; ik++){
-				Bvec[iz][ik] += (pc_weight*gsl_spline2d_eval(logklogz2pc_spline[ipc], log(this->kvec[ik]), stp_no[iz], logk2pc_acc[ipc], logz2pc_acc[ipc]));
+				Bz[ik] += (pc_weight*gsl_spline2d_eval(logklogz2pc_spline[ipc], logk[ik], stp_no[iz], logk2pc_acc[ipc], logz2pc_acc[ipc]));
 			}
 		}
 	}
-	//printf("PCA assembled\n");
 }
 
 /* WRITE NLC TO FILE */
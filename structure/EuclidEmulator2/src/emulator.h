@@ -66,6 +66,7 @@ class EuclidEmulator{
 		EuclidEmulator();
 		~EuclidEmulator();
 		void compute_nlc(Cosmology csm, vector<double> redshift, int n_redshift);
+		void compute_nlc_into(Cosmology csm, const double* redshift, int n_redshift, double* B);
 		void write_nlc2file(const string &filename, vector<double> zvec, int n_redshift);
 };
 
@@ -55,6 +55,7 @@ cdef extern from "emulator.h":
         EuclidEmulator() except +
 
         void compute_nlc(Cosmology csm, vector[double] redshift, int n_redshift);
+        void compute_nlc_into(Cosmology csm, const double* redshift, int n_redshift, double* B);
         void write_nlc2file(const string &filename, vector[double] zvec, int n_redshift);
 
 
@@ -77,6 +78,9 @@ cdef class PyCosmology:
 
         self.cosm =new Cosmology((<double>Omega_b), (<double>Omega_m), (<double>Sum_m_nu), (<double>n_s), (<double>h), (<double>w_0), (<double>w_a), (<double>A_s))
 
+     def __dealloc__(self):
+        del self.cosm
+
      # Attribute access
      @property
      def Omega_nu_0(self):
@@ -93,10 +97,26 @@ cdef class PyEuclidEmulator:
      def __cinit__(self):
         self.ee2 = new EuclidEmulator()
 
+     def __dealloc__(self):
+        del self.ee2
+
 
      def compute_nlc(self,PyCosmology csm, redshift, n_redshift):
           self.ee2.compute_nlc((<Cosmology *> csm.cosm)[0], redshift, n_redshift)
 
+     def compute_nlc_into(self, PyCosmology csm, double[::1] redshift, double[:, ::1] logboost):
+          """
+          Compute log10 of the boost at all the redshifts in one call,
+          writing it into logboost, which must have shape (len(redshift), len(kvec)).
+          Unlike compute_nlc there is no limit on the number of redshifts.
+          """
+          cdef int n_redshift = redshift.shape[0]
+          if logboost.shape[0] != n_redshift or logboost.shape[1] != 613:
+              raise ValueError("logboost buffer should have shape ({}, 613)".format(n_redshift))
+          if n_redshift == 0:
+              return
+          self.ee2.compute_nlc_into((<Cosmology *> csm.cosm)[0], &redshift[0], n_redshift, &logboost[0, 0])
+
      def write_nlc2file(self,filename, zvec, n_redshift):
           self.ee2.write_nlc2file(<string>filename, zvec, n_redshift)
 
@@ -337,98 +357,156 @@ def convert_to_emu(class_pars_dict):
 
 
 
-def get_boost(cosmo_par_in,redshifts,custom_kvec=None):
+# Reading the data file and setting up the PC splines is expensive,
+# so we only do it once per process.
+_emulator = None
 
-    if isinstance(redshifts, (int, float)):
-        redshifts = np.asarray([redshifts])
-    else:
-        redshifts = np.asarray(redshifts)
+def _get_emulator():
+    global _emulator
+    if _emulator is None:
+        _emulator = PyEuclidEmulator()
+    return _emulator
 
-    for z in redshifts:
-        assert z <= 10.0 and z>=0.0, "EuclidEmulator2 allows only redshifts in the interval [0.0, 10.0]"
 
+def _make_cosmology(cosmo_par_in):
     #Check if all variables are passed and convert to emu dict
     cosmo_par=convert_to_emu(cosmo_par_in)
     #Check if all parameters are in range
     check_param_range(cosmo_par)
-    cosmo=PyCosmology(cosmo_par['Omega_b'],
-                      cosmo_par['Omega_m'],
-                      cosmo_par['m_ncdm'],
-                      cosmo_par['n_s'],
-                      cosmo_par['h'],
-                      cosmo_par['w0_fld'],
-                      cosmo_par['wa_fld'],
-                      cosmo_par['A_s'])
-    ee2=PyEuclidEmulator()
-    ee2.compute_nlc(cosmo,redshifts,len(redshifts))
-
-    k=np.asarray(ee2.kvec)
-    logboost=np.reshape(ee2.Bvec[0:len(redshifts)],(len(redshifts),len(k)))
-
-    #Extrapolate for custom k-range
-    kvals = k
-    k_shape = kvals.shape
-
-    do_extrapolate_above = False
-    do_extrapolate_below = False
-    if not(custom_kvec is None):
-        upper_mask = custom_kvec < max(kvals)
-        lower_mask = custom_kvec > min(kvals)
-        mask = [u and l for (u,l) in zip(lower_mask, upper_mask)]
-        custom_k_within_range = custom_kvec[mask]
-        custom_k_below = custom_kvec[[not(l) for l in lower_mask]]
-        custom_k_above = custom_kvec[[not(u) for u in upper_mask]]
-
-        if any(custom_kvec > max(kvals)):
-            wrn_message = ("Warning:\nEuclidEmulator2 emulates the non-linear correction in \n"
-                           "the interval [8.73e-3 h/Mpc, 9.41h/Mpc]. You are \n"
-                           "requesting k modes beyond k_max = 9.41h/Mpc. \n"
-                           "Higher k modes constantly extrapolated.")
-
-            _warnings.warn(wrn_message)
-            do_extrapolate_above = True
-
-        if any(custom_kvec < min(kvals)):
-            wrn_message = ("Warning:\nEuclidEmulator2 emulates the non-linear correction in \n"
-                           "the interval [8.73e-3 h/Mpc, 9.41h/Mpc]. You are \n"
-                           "requesting k modes below k_min = 8.73e-3 h/Mpc. \n"
-                           "Lower k modes constantly extrapolated.")
-
-            _warnings.warn(wrn_message)
-            do_extrapolate_below = True
-
-
-    len_kvals = len(kvals)
-    len_redshifts = len(redshifts)
-
-
-    bvals = {}
-    for i in range(len_redshifts):
-        tmp = logboost[i]
-        if not(custom_kvec is None):
-            bvals[i] = 10.0**_CubicSpline(np.log10(kvals),
-                                          tmp.reshape(k_shape)
-                                          )(np.log10(custom_k_within_range))
-
-            #Extrapolate if necessary
-            if do_extrapolate_below:
-                # below the k_min of EuclidEmulator2, we are in the linear regime where
-                # the boost factor is unity by construction
-                b_extrap = np.ones_like(custom_k_below)
-                bvals[i]= np.concatenate((b_extrap, bvals[i]))
-
-            if do_extrapolate_above:
-                # We extrapolate by setting all b(k > k_max) to b(k_max)
-                b_extrap = bvals[i][-1] * np.ones_like(custom_k_above)
-                bvals[i] = np.concatenate((bvals[i], b_extrap))
-
-        else:
-            bvals[i] = 10.**tmp.reshape(k_shape)
-
-    if not(custom_kvec is None):       # This could probably be done cleaner!
-        kvals = custom_kvec
+    return PyCosmology(cosmo_par['Omega_b'],
+                       cosmo_par['Omega_m'],
+                       cosmo_par['m_ncdm'],
+                       cosmo_par['n_s'],
+                       cosmo_par['h'],
+                       cosmo_par['w0_fld'],
+                       cosmo_par['wa_fld'],
+                       cosmo_par['A_s'])
+
+
+def _check_redshifts(redshifts):
+    redshifts = np.ascontiguousarray(np.atleast_1d(redshifts), dtype=np.float64)
+    assert np.all((redshifts <= 10.0) & (redshifts >= 0.0)), \
+        "EuclidEmulator2 allows only redshifts in the interval [0.0, 10.0]"
+    return redshifts
+
+
+def _check_output_buffer(out, shape):
+    if out is None:
+        return np.empty(shape)
+    if out.shape != shape or out.dtype != np.float64 or not out.flags.c_contiguous:
+        raise ValueError("Output buffer for the boost should be a C-contiguous "
+                         "float64 array of shape {}".format(shape))
+    return out
+
+
+def _interpolate_boost(kvals, logboost, custom_kvec, out):
+    # Spline log10(B) in log10(k) for all the redshifts at once
+    # and write B at custom_kvec into out.
+    upper_mask = custom_kvec < kvals.max()
+    lower_mask = custom_kvec > kvals.min()
+    within = upper_mask & lower_mask
+
+    if np.any(custom_kvec > kvals.max()):
+        wrn_message = ("Warning:\nEuclidEmulator2 emulates the non-linear correction in \n"
+                       "the interval [8.73e-3 h/Mpc, 9.41h/Mpc]. You are \n"
+                       "requesting k modes beyond k_max = 9.41h/Mpc. \n"
+                       "Higher k modes constantly extrapolated.")
+        _warnings.warn(wrn_message)
+
+    if np.any(custom_kvec < kvals.min()):
+        wrn_message = ("Warning:\nEuclidEmulator2 emulates the non-linear correction in \n"
+                       "the interval [8.73e-3 h/Mpc, 9.41h/Mpc]. You are \n"
+                       "requesting k modes below k_min = 8.73e-3 h/Mpc. \n"
+                       "Lower k modes constantly extrapolated.")
+        _warnings.warn(wrn_message)
+
+    spline = _CubicSpline(np.log10(kvals), logboost, axis=1)
+    out[:, within] = 10.0**spline(np.log10(custom_kvec[within]))
+
+    # below the k_min of EuclidEmulator2, we are in the linear regime where
+    # the boost factor is unity by construction
+    out[:, ~lower_mask] = 1.0
+
+    # We extrapolate by setting all b(k > k_max) to the value at the
+    # largest k we interpolated to
+    if np.any(within):
+        i_last = np.flatnonzero(within)[np.argmax(custom_kvec[within])]
+        b_last = out[:, i_last]
+    else:
+        b_last = 10.0**logboost[:, -1]
+    out[:, ~upper_mask] = b_last[:, np.newaxis]
 
-    return kvals,bvals
 
+def get_boost_array(cosmo_par_in, redshifts, custom_kvec=None, out=None):
+    """
+    Signature:    get_boost_array(cosmo_par_in, redshifts, custom_kvec=None, out=None)
+
+    Description:  Computes the non-linear boost for one cosmology at all
+                  the given redshifts in a single emulator call, with no
+                  limit on the number of redshifts.
+
+    Input type:   cosmo_par_in - python dictionary as for convert_to_emu
+                  redshifts - scalar or 1D array
+                  custom_kvec - optional 1D array of k in h/Mpc
+                  out - optional preallocated C-contiguous float64 array
+                        of shape (n_z, n_k) to write the boost into
+
+    Output type:  (k, boost), with boost of shape (n_z, n_k)
+
+    """
+    redshifts = _check_redshifts(redshifts)
+    cosmo = _make_cosmology(cosmo_par_in)
+    ee2 = _get_emulator()
+    kvals = np.asarray(ee2.kvec)
+
+    if custom_kvec is None:
+        out = _check_output_buffer(out, (len(redshifts), len(kvals)))
+        ee2.compute_nlc_into(cosmo, redshifts, out)
+        np.power(10.0, out, out=out)
+        return kvals, out
+
+    custom_kvec = np.asarray(custom_kvec, dtype=np.float64)
+    out = _check_output_buffer(out, (len(redshifts), len(custom_kvec)))
+    logboost = np.empty((len(redshifts), len(kvals)))
+    ee2.compute_nlc_into(cosmo, redshifts, logboost)
+    _interpolate_boost(kvals, logboost, custom_kvec, out)
+    return custom_kvec, out
+
+
+def get_boosts(cosmo_par_list, redshifts, custom_kvec=None, out=None):
+    """
+    Signature:    get_boosts(cosmo_par_list, redshifts, custom_kvec=None, out=None)
+
+    Description:  Computes the non-linear boost for several cosmologies
+                  at once, sharing the emulator set-up between them.
+
+    Input type:   cosmo_par_list - sequence of python dictionaries
+                  redshifts, custom_kvec - as for get_boost_array
+                  out - optional preallocated C-contiguous float64 array
+                        of shape (n_cosmo, n_z, n_k)
+
+    Output type:  (k, boost), with boost of shape (n_cosmo, n_z, n_k)
+
+    """
+    redshifts = _check_redshifts(redshifts)
+    if custom_kvec is None:
+        kvals = np.asarray(_get_emulator().kvec)
+    else:
+        kvals = np.asarray(custom_kvec, dtype=np.float64)
+    out = _check_output_buffer(out, (len(cosmo_par_list), len(redshifts), len(kvals)))
+    for i, cosmo_par_in in enumerate(cosmo_par_list):
+        get_boost_array(cosmo_par_in, redshifts, custom_kvec, out=out[i])
+    return kvals, out
 
 
+def get_boost(cosmo_par_in,redshifts,custom_kvec=None):
+    """
+    Signature:    get_boost(cosmo_par_in, redshifts, custom_kvec=None)
+
+    Description:  As get_boost_array, but returns the boost as a
+                  dictionary of arrays, keyed by the redshift index.
+
+    """
+    kvals, boost = get_boost_array(cosmo_par_in, redshifts, custom_kvec)
+    bvals = {i: boost[i] for i in range(len(boost))}
+    return kvals,bvals
@@ -15,15 +15,139 @@ Contact Jonathan Blazek with questions.
 #
 
 from cosmosis.datablock import names, option_section
+import fastpt as fastpt_package
 import fastpt.FASTPT as FASTPT
 from fastpt.P_extend import k_extend 
 import numpy as np
 from time import time
+import os
+import json
+import shutil
+import hashlib
 
 from scipy.interpolate import interp1d
 from scipy.interpolate import InterpolatedUnivariateSpline as intspline
 #import matplotlib as plt
 
+# FAST-PT initialization builds large tables that depend only on the k grid and
+# the settings below. We can optionally save the initialized object to disk, so
+# that other processes (e.g. MPI ranks, or restarted chains) can re-use it.
+# The cache is a directory of plain .npy arrays, which are memory-mapped when
+# loaded rather than read and copied, and a JSON description of how to put them
+# back together. Nothing in it is unpickled, so loading a cache file cannot run
+# code; only the classes listed here are rebuilt from it.
+
+FASTPT_CACHE_VERSION = 2
+FASTPT_CACHE_CLASSES = {"FASTPT": FASTPT, "k_extend": k_extend}
+
+def fastpt_cache_path(cache_dir, k, to_do, low_extrap, high_extrap, n_pad):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(k, dtype=np.float64).tobytes())
+    settings = (FASTPT_CACHE_VERSION, getattr(fastpt_package, "__version__", ""),
+        float(low_extrap), float(high_extrap), int(n_pad), tuple(sorted(to_do)))
+    h.update(repr(settings).encode())
+    return os.path.join(cache_dir, "fastpt_{}".format(h.hexdigest()))
+
+def _encode_cache_value(value, dirname, arrays):
+    # Convert a value to a JSON description, saving any arrays to dirname
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"value": value}
+    if isinstance(value, np.generic):
+        return {"scalar": value.item(), "dtype": value.dtype.str}
+    if isinstance(value, np.ndarray):
+        spec = {"array": len(arrays)}
+        if value.dtype == object:
+            # FAST-PT keeps some coefficients as object arrays of numpy scalars
+            value = np.array(value.tolist())
+            if value.dtype == object:
+                raise TypeError("cannot cache an object array of non-numeric values")
+            spec["object"] = True
+        np.save(os.path.join(dirname, "{}.npy".format(len(arrays))), value, allow_pickle=False)
+        arrays.append(value)
+        return spec
+    if isinstance(value, (tuple, list)):
+        return {type(value).__name__: [_encode_cache_value(v, dirname, arrays) for v in value]}
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        return {"dict": {key: _encode_cache_value(v, dirname, arrays) for key, v in value.items()}}
+    name = type(value).__name__
+    if FASTPT_CACHE_CLASSES.get(name) is type(value):
+        return {"object": name, "state": _encode_cache_value(vars(value), dirname, arrays)}
+    raise TypeError("cannot cache a value of type {}".format(name))
+
+def _decode_cache_value(spec, dirname):
+    if "value" in spec:
+        return spec["value"]
+    if "scalar" in spec:
+        return np.dtype(spec["dtype"]).type(spec["scalar"])
+    if "array" in spec:
+        filename = os.path.join(dirname, "{}.npy".format(spec["array"]))
+        # Copy-on-write, so FAST-PT can modify its arrays without touching the file
+        value = np.load(filename, mmap_mode='c', allow_pickle=False)
+        if spec.get("object"):
+            obj = np.empty(value.shape, dtype=object)
+            obj.flat[:] = list(value.flat)
+            value = obj
+        return value
+    if "tuple" in spec:
+        return tuple(_decode_cache_value(v, dirname) for v in spec["tuple"])
+    if "list" in spec:
+        return [_decode_cache_value(v, dirname) for v in spec["list"]]
+    if "dict" in spec:
+        return {key: _decode_cache_value(v, dirname) for key, v in spec["dict"].items()}
+    cls = FASTPT_CACHE_CLASSES[spec["object"]]
+    obj = cls.__new__(cls)
+    obj.__dict__.update(_decode_cache_value(spec["state"], dirname))
+    return obj
+
+def save_fastpt_cache(dirname, fpt):
+    # Write to a temporary directory and rename, so that other processes
+    # never see a partly written cache
+    tmp_dirname = "{}.{}.tmp".format(dirname, os.getpid())
+    os.makedirs(tmp_dirname)
+    try:
+        spec = _encode_cache_value(fpt, tmp_dirname, [])
+        with open(os.path.join(tmp_dirname, "fastpt.json"), "w") as f:
+            json.dump(spec, f)
+        os.rename(tmp_dirname, dirname)
+    except Exception:
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+        # Fine if another process saved the same cache first
+        if not os.path.exists(os.path.join(dirname, "fastpt.json")):
+            raise
+
+def load_fastpt_cache(dirname):
+    with open(os.path.join(dirname, "fastpt.json")) as f:
+        spec = json.load(f)
+    return _decode_cache_value(spec, dirname)
+
+def init_fastpt(k, to_do, low_extrap, high_extrap, n_pad, cache_dir="", verbose=False):
+    """
+    Initialize FAST-PT, or load an initialized object from cache_dir if one
+    has already been saved with the same k grid and settings there.
+    """
+    if not cache_dir:
+        return FASTPT(k, to_do=to_do, low_extrap=low_extrap, high_extrap=high_extrap, n_pad=n_pad)
+
+    cache_name = fastpt_cache_path(cache_dir, k, to_do, low_extrap, high_extrap, n_pad)
+    if os.path.exists(cache_name):
+        try:
+            fpt = load_fastpt_cache(cache_name)
+        except Exception as error:
+            print("Could not load FAST-PT cache {} ({}); re-initializing".format(cache_name, error))
+        else:
+            if verbose: print("Loaded FAST-PT initialization from", cache_name)
+            return fpt
+
+    fpt = FASTPT(k, to_do=to_do, low_extrap=low_extrap, high_extrap=high_extrap, n_pad=n_pad)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_fastpt_cache(cache_name, fpt)
+    except Exception as error:
+        print("Could not save FAST-PT cache {} ({})".format(cache_name, error))
+    else:
+        if verbose: print("Saved FAST-PT initialization to", cache_name)
+    return fpt
+
 def setup(options):
     do_dd_spt = options.get_bool(option_section, 'do_dd_spt', False)
     do_ia = options.get_bool(option_section, 'do_ia', False)
@@ -41,6 +165,7 @@ def setup(options):
     high_extrap = options.get_double(option_section, "high_extrap", 3)
     C_window = options.get_double(option_section, "C_window", 0.75)
     n_pad_fac = options.get_double(option_section, "n_pad_fac", 1.0)
+    cache_dir = options.get_string(option_section, "cache_dir", "")
     verbose = options.get_bool(option_section, "verbose", False)
     if options.has_value(option_section, "P_window"):
         P_window = options.get_double(option_section, "P_window")
@@ -78,6 +203,7 @@ def setup(options):
         'P_window':P_window,
         'C_window':C_window,
         'n_pad_fac':n_pad_fac,
+        'cache_dir':cache_dir,
         'verbose':verbose
     }
     config.update(fpt_config)
@@ -225,7 +351,8 @@ def execute(block, config):
         # bias parameter and padding length 
         #nu=-2 #shouldn't be required in v2
         n_pad=int(config['n_pad_fac']*len(k))
-        config['fastpt_kinit'] = FASTPT(k,to_do=to_do,low_extrap=config['low_extrap'],high_extrap=config['high_extrap'],n_pad=n_pad) 
+        config['fastpt_kinit'] = init_fastpt(k, to_do, config['low_extrap'], config['high_extrap'], n_pad,
+            cache_dir=config['cache_dir'], verbose=verbose)
         config['k0'] = k0
         config['knl1'] = knl1
         t6=time()
@@ -3,8 +3,13 @@ add the magnification terms to the shear-gal and gal-gal Cls
 based on the add_intrinsic module
 """
 from cosmosis.datablock import option_section, names
-from scipy.interpolate import InterpolatedUnivariateSpline
+from scipy.interpolate import InterpolatedUnivariateSpline, make_interp_spline
 import numpy as np
+import os
+import sys
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
+import packed_spectra
 
 def setup(options):
     do_galaxy_galaxy = options.get_bool(option_section, "galaxy-galaxy", True)
@@ -25,6 +30,56 @@ def setup(options):
     print()
     return do_galaxy_galaxy, do_galaxy_shear, do_galaxy_cmbkappa, include_intrinsic
 
+def resample_packed(cl, cl_ells, ells):
+    # Cubic spline in log(ell) of all the bin pairs at once,
+    # leaving zero at ell=0 as in the per-bin-pair version
+    index = ells > 0
+    resampled = np.zeros(cl.shape[:2] + ells.shape)
+    spline = make_interp_spline(np.log(cl_ells), cl, k=3, axis=-1)
+    resampled[:, :, index] = spline(np.log(ells[index]))
+    return resampled
+
+
+def add_galaxy_galaxy_packed(block, auto_only):
+    # The packed-layout version of the galaxy-galaxy loop in execute
+    layout = packed_spectra.section_layout(block, names.galaxy_cl)
+    ells = block[names.galaxy_cl, 'ell']
+    gg, mask = packed_spectra.get_packed(block, names.galaxy_cl)
+    gal_mag, _ = packed_spectra.get_packed(block, "galaxy_magnification_cl")
+    mag_mag, _ = packed_spectra.get_packed(block, "magnification_cl")
+
+    gal_mag_ells = block["galaxy_magnification_cl", 'ell']
+    mag_mag_ells = block["magnification_cl", "ell"]
+    if (len(gal_mag_ells) != len(ells)) or not np.allclose(gal_mag_ells, ells):
+        gal_mag = resample_packed(gal_mag, gal_mag_ells, ells)
+    if (len(mag_mag_ells) != len(ells)) or not np.allclose(mag_mag_ells, ells):
+        mag_mag = resample_packed(mag_mag, mag_mag_ells, ells)
+
+    # As in the legacy layout we only use the j <= i pairs
+    n = len(mask)
+    mask = mask & np.tri(n, dtype=bool)
+    if auto_only:
+        mask &= np.identity(n, dtype=bool)
+
+    total = gg + (gal_mag + gal_mag.transpose(1, 0, 2) + mag_mag)
+    total[~mask] = 0.0
+    packed_spectra.put_packed(block, "galaxy_cl_gg", gg, mask, layout)
+    packed_spectra.put_packed(block, names.galaxy_cl, total, mask, layout)
+
+
+def add_cross_packed(block, section, save_section, mag_sections):
+    # The packed-layout version of the galaxy-shear and galaxy-kappa loops,
+    # saving the original to save_section
+    layout = packed_spectra.section_layout(block, section)
+    cl, mask = packed_spectra.get_packed(block, section)
+    packed_spectra.put_packed(block, save_section, cl, mask, layout)
+    for mag_section in mag_sections:
+        mag, _ = packed_spectra.get_packed(block, mag_section)
+        cl = cl + mag
+    cl[~mask] = 0.0
+    packed_spectra.put_packed(block, section, cl, mask, layout)
+
+
 def execute(block, config):
     do_galaxy_galaxy, do_galaxy_shear, do_galaxy_cmbkappa, include_intrinsic = config
 
@@ -36,7 +91,12 @@ def execute(block, config):
     if do_galaxy_shear:
         nbin_shear = block["galaxy_shear_cl", 'nbin_b']
         
-    if do_galaxy_galaxy:
+    if do_galaxy_galaxy and packed_spectra.has_packed(block, names.galaxy_cl):
+        # The same as below, for all the bin pairs at once
+        block["galaxy_cl_gg", 'ell'] = block[names.galaxy_cl, 'ell']
+        auto_only = block.get_bool(names.galaxy_cl, "auto_only", False)
+        add_galaxy_galaxy_packed(block, auto_only)
+    elif do_galaxy_galaxy:
         # for galaxy_galaxy, we're replacing 'galaxy_cl' (the gg term) with gg+gm+mg+mm
         # so in case useful, save the gg term to galaxy_cl_gg.
         ells = block[names.galaxy_cl, 'ell']
@@ -98,7 +158,13 @@ def execute(block, config):
 
     #if include_intrinsic is True, we're replacing gG+gI with gG+gI+mG+mI       
     #else,                         we're replacing gG    with gG+mG 
-    if do_galaxy_shear:
+    if do_galaxy_shear and packed_spectra.has_packed(block, "galaxy_shear_cl"):
+        block["galaxy_shear_cl_gG", "ell"] = block["galaxy_shear_cl", "ell"]
+        mag_sections = ["magnification_shear_cl"]
+        if include_intrinsic:
+            mag_sections.append("magnification_intrinsic_cl")
+        add_cross_packed(block, "galaxy_shear_cl", "galaxy_shear_cl_gG", mag_sections)
+    elif do_galaxy_shear:
         block["galaxy_shear_cl_gG", "ell"] = block["galaxy_shear_cl", "ell"]
         for i in range(nbin_pos):
             for j in range(nbin_shear):
@@ -112,7 +178,10 @@ def execute(block, config):
                         block["magnification_intrinsic_cl", bin_ij]
                         )
 
-    if do_galaxy_cmbkappa:
+    if do_galaxy_cmbkappa and packed_spectra.has_packed(block, "galaxy_cmbkappa_cl"):
+        add_cross_packed(block, "galaxy_cmbkappa_cl", "galaxy_cmbkappa_cl_gK",
+                         ["magnification_cmbkappa_cl"])
+    elif do_galaxy_cmbkappa:
         for i in range(nbin_pos):
             bin_i = 'bin_{0}_1'.format(i + 1)
             block["galaxy_cmbkappa_cl_gK", bin_i] = block["galaxy_cmbkappa_cl", bin_i]
@@ -1,13 +1,18 @@
 # coding:utf-8
 import os
+import hashlib
 import numpy as np
 from cosmosis.datablock import names, option_section, BlockError
 import re
 import sys
 import scipy.interpolate as interp
-from projection_tools import exact_integral, limber_integral, get_dlogchi, \
+from concurrent.futures import ThreadPoolExecutor
+from projection_tools import exact_integral, limber_integral, limber_integral_batch, get_dlogchi, \
                              TomoNzKernel, get_Pk_basis_funcs, get_bias_params_bin, \
-                             get_PXX, get_PXm, Enum
+                             get_PXX, get_PXm, Enum, LimberPowerCache, KernelSplineError
+dirname = os.path.split(__file__)[0]
+sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
+import packed_spectra
 
 # for timing
 from timeit import default_timer as timer
@@ -28,6 +33,9 @@ def compute_c1_baseline():
 
 C1_RHOCRIT = compute_c1_baseline()
 
+# The kernel types that SpectrumCalculator.set_kernel_splines can build
+KERNEL_TYPES = ["N", "W", "K", "W_W", "F"]
+
 class Power3D(object):
     """
     Class representing the 3D power spectrum that enters the Limber calculation.
@@ -245,14 +253,20 @@ class Spectrum(object):
         default section name for this spectrum e.g. shear_cl
     prefactor_type: (str, str)
         tuple of prefactor type e.g. "lensing", None, "mag"
+    and may specify
+    batch_limber: bool
+        whether the Limber integrals for all bin pairs can be done
+        together, which requires the P(k) not to depend on the bin pair
     """
     autocorrelation = False
     # These should make it more obvious if the values are not overwritten by subclasses
     kernel_types = ("?", "?")
     name = "?"
     prefactor_type = ("", "")
+    batch_limber = True
 
     def __init__(self, source, sample_a, sample_b, power_key, save_name="", only_bins=None, len_only_bins=None):
+        self.mag_alphas = {}
         # caches of n(z), w(z), P(k,z), etc.
         self.source = source
         self.sample_a, self.sample_b = sample_a, sample_b
@@ -329,9 +343,30 @@ class Spectrum(object):
     # e.g. mag_alpha_redmagic, alpha_3 for the 3rd redshift bin of sample
     # redmagic
     def get_magnification_prefactor(self, block, sample, bin_num):
-        alpha = block[ f"mag_alpha_{sample}", f"alpha_{bin_num}" ]
+        alphas = self.mag_alphas.get(sample, {})
+        if bin_num in alphas:
+            alpha = alphas[bin_num]
+        else:
+            alpha = block[ f"mag_alpha_{sample}", f"alpha_{bin_num}" ]
         return 2 * (alpha - 1)
 
+    def load_magnification_alphas(self, block):
+        """
+        Read the alpha values needed by get_magnification_prefactor,
+        so that the block need not be accessed when computing bin pairs.
+        """
+        self.mag_alphas = {}
+        samples = [self.sample_a, self.sample_b]
+        for sample, prefactor_type in zip(samples, self.prefactor_type):
+            if prefactor_type != "mag":
+                continue
+            nbin = self.source.kernels[sample].nbin
+            section = f"mag_alpha_{sample}"
+            self.mag_alphas[sample] = {
+                i: block[section, f"alpha_{i}"] for i in range(1, nbin+1)
+                if block.has_value(section, f"alpha_{i}")
+            }
+
     def compute_limber(self, block, ell, bin1, bin2, dchi=None, sig_over_dchi=100.,
         chimin=None, chimax=None):
         r"""
@@ -387,7 +422,8 @@ class Spectrum(object):
 
         # Run the main Limber integral
         c_ell, c_ell_err = limber_integral(ell, K1, K2, P_chi_logk_spline, chimin,
-            chimax, dchi, interpolation_cache=self.source.interpolation_cache)
+            chimax, dchi, interpolation_cache=self.source.interpolation_cache,
+            cache_key=self.pk_cache_key)
 
         # Rescale by the h, Omega_m, etc factor, which depends which spectrum
         # us being computed
@@ -395,6 +431,51 @@ class Spectrum(object):
 
         return c_ell
 
+    def compute_limber_batch(self, block, ell, bin_pairs, sig_over_dchi=100.):
+        r"""
+        Calculate the Limber integral for a list of bin pairs at once,
+        sharing a single chi grid and P(k, chi) evaluation between them.
+        This is only possible when the power spectrum does not depend
+        on the bin pair (see the batch_limber attribute).
+
+        Parameters
+        ----------
+        block: DataBlock instance
+            block from which to read data
+        ell: float array
+            np.array of ell values at which to calculate C(l)
+        bin_pairs: list of (int, int)
+            tomographic bin index pairs (starting from 1)
+        sig_over_dchi: float
+            ratio between width of kernel sigma and dchi
+
+        Returns
+        -------
+        c_ells: float array
+            (n_pair, n_ell) array of C(l) values
+        """
+        bin1, bin2 = bin_pairs[0]
+        P_chi_logk_spline = self.get_power_spline(block, bin1, bin2)
+
+        kernels_a = self.source.kernels[self.sample_a]
+        kernels_b = self.source.kernels[self.sample_b]
+        K1s = [kernels_a.get_kernel_spline(self.kernel_types[0], b1) for (b1, b2) in bin_pairs]
+        K2s = [kernels_b.get_kernel_spline(self.kernel_types[1], b2) for (b1, b2) in bin_pairs]
+
+        # Each pair keeps the integration range it would have had in
+        # compute_limber, but we use the finest spacing for all of them.
+        chimins = [max(K1.xmin_clipped, K2.xmin_clipped) for (K1, K2) in zip(K1s, K2s)]
+        chimaxs = [min(K1.xmax_clipped, K2.xmax_clipped) for (K1, K2) in zip(K1s, K2s)]
+        dchi = min(min(K1.sigma, K2.sigma) for (K1, K2) in zip(K1s, K2s)) / sig_over_dchi
+
+        c_ells = limber_integral_batch(ell, K1s, K2s, P_chi_logk_spline, chimins,
+            chimaxs, dchi, interpolation_cache=self.source.interpolation_cache,
+            cache_key=self.pk_cache_key)
+
+        prefactors = [self.get_prefactor(block, b1, b2) for (b1, b2) in bin_pairs]
+        c_ells *= np.array(prefactors)[:, np.newaxis]
+        return c_ells
+
     def compute_exact(self, block, ell, bin1, bin2, dlogchi=None,
         sig_over_dchi=20.0, chi_pad_lower=2.0, chi_pad_upper=2.0,
         chimin=None, chimax=None, dchi_limber=None, do_rsd=False):
@@ -477,7 +558,8 @@ class Spectrum(object):
             dchi_limber = min( K1.sigma/sig_over_dchi, K2.sigma/sig_over_dchi )
 
         c_ell_sublin,_ = limber_integral(ell, K1, K2, P_sublin_spline,
-            chimin, chimax, dchi_limber, interpolation_cache=self.source.interpolation_cache)
+            chimin, chimax, dchi_limber, interpolation_cache=self.source.interpolation_cache,
+            cache_key=self.pk_sublin_cache_key)
 
         # Add the Limber on the non-linear part to the total
         c_ell += c_ell_sublin
@@ -568,6 +650,12 @@ class Spectrum(object):
         self.pk_sublin_spline = p.sublin_spline
         self.pk_lin_z0_logk_spline = p.lin_z0_logk_spline
         self.lin_growth_spline = p.lin_growth_spline
+
+        # Keys for the shared P(k, chi) evaluation cache. Every spectrum
+        # using the same 3D power shares these evaluations.  We include
+        # the class name because some (e.g. PPF) modify the P(k) they read.
+        self.pk_cache_key = (p.__class__.__name__, p.section_name)
+        self.pk_sublin_cache_key = self.pk_cache_key + ("sublin",)
         return 0
 
 class LingalLingalSpectrum(Spectrum):
@@ -626,7 +714,8 @@ class LingalLingalSpectrum(Spectrum):
             dchi_limber = min( K1.sigma/sig_over_dchi, K2.sigma/sig_over_dchi )
 
         c_ell_sublin,_ = limber_integral(ell, K1, K2, P_sublin_spline, chimin,
-            chimax, dchi_limber, interpolation_cache=self.source.interpolation_cache)
+            chimax, dchi_limber, interpolation_cache=self.source.interpolation_cache,
+            cache_key=self.pk_sublin_cache_key)
 
         # We apply the linear bias here to the NL-only (sublin) part.  The
         # linear bias is already applied in the exact_integral above to the
@@ -647,6 +736,13 @@ class LingalLingalSpectrum(Spectrum):
             chimin=chimin, chimax=chimax)
         return c_ell * self.lin_bias_values_a[bin1] * self.lin_bias_values_b[bin2]
 
+    def compute_limber_batch(self, block, ell, bin_pairs, sig_over_dchi=100.):
+        # same as the base class but we multiply by galaxy bias
+        c_ells = super().compute_limber_batch(block, ell, bin_pairs,
+            sig_over_dchi=sig_over_dchi)
+        bias = [self.lin_bias_values_a[b1] * self.lin_bias_values_b[b2] for (b1, b2) in bin_pairs]
+        return c_ells * np.array(bias)[:, np.newaxis]
+
     def prepare(self, block, lin_bias_prefix="b", **kwargs):
         # Call the parent prepare
         super().prepare(block)
@@ -714,6 +810,13 @@ class LingalLensingSpectrum(Spectrum):
             chimin=chimin, chimax=chimax)
         return c_ell * self.lin_bias_values_a[bin1]
 
+    def compute_limber_batch(self, block, ell, bin_pairs, sig_over_dchi=100.):
+        # As above, apply the linear bias to the parent class values
+        c_ells = super().compute_limber_batch(block, ell, bin_pairs,
+            sig_over_dchi=sig_over_dchi)
+        bias = [self.lin_bias_values_a[b1] for (b1, b2) in bin_pairs]
+        return c_ells * np.array(bias)[:, np.newaxis]
+
     def prepare(self, block, lin_bias_prefix="b", **kwargs):
         # Call the parent prepare, which pulls the power splines out
         # of the source (which has read them from the data block)
@@ -755,6 +858,9 @@ class NlgalNlgalSpectrum(LingalLingalSpectrum):
     We might want to revise how that all works at some point
     as it seems a bit clumsy. But oh well.
     """
+    # The P(k) depends on the bin pair
+    batch_limber = False
+
     def prepare(self, block, pt_type="oneloop_eul_bk", **kwargs):
 
         self.pt_type = pt_type
@@ -778,6 +884,8 @@ class NlgalNlgalSpectrum(LingalLingalSpectrum):
         p = self.source.power[self.power_key]
         self.pk_chi_logk_spline = None # Set these to None as
         self.pk_sublin_spline = None # they depend on the bin pair
+        self.pk_cache_key = None # and so can't be cached
+        self.pk_sublin_cache_key = None
         self.pk_lin_z0_logk_spline = p.lin_z0_logk_spline
         self.lin_growth_spline = p.lin_growth_spline
 
@@ -852,6 +960,9 @@ class NlgalShearSpectrum(LingalLensingSpectrum):
     just the linear matter power spectrum (and the b_1 values are passed
     along with this). We also need to construct the non-Linear P(k) using fast-pt.
     """
+    # The P(k) depends on the bin pair
+    batch_limber = False
+
     def prepare(self, block, pt_type="oneloop_eul_bk", **kwargs):
         # assign pt_type
         self.pt_type = pt_type
@@ -869,6 +980,8 @@ class NlgalShearSpectrum(LingalLensingSpectrum):
         p = self.source.power[self.power_key]
         self.pk_chi_logk_spline = None # Set these to None as
         self.pk_sublin_spline = None # they depend on the bin pair
+        self.pk_cache_key = None # and so can't be cached
+        self.pk_sublin_cache_key = None
         self.pk_lin_z0_logk_spline = p.lin_z0_logk_spline
         self.lin_growth_spline = p.lin_growth_spline
 
@@ -1221,6 +1334,11 @@ class SpectrumCalculator(object):
         self.fatal_errors = options.get_bool(option_section, "fatal_errors", False)
         self.get_kernel_peaks = options.get_bool(option_section, "get_kernel_peaks", False)
         self.save_kernels = options.get_bool(option_section, "save_kernels", False)
+        self.batch_limber = options.get_bool(option_section, "batch_limber", False)
+        self.n_threads = options.get_int(option_section, "n_threads", 1)
+        self.cl_layout = options.get_string(option_section, "cl_layout", "legacy")
+        if self.cl_layout not in packed_spectra.LAYOUTS:
+            raise ValueError("cl_layout should be one of {}".format(packed_spectra.LAYOUTS))
 
         self.limber_ell_start = options.get_int(option_section, "limber_ell_start", 300)
         do_exact_string = options.get_string(option_section, "do_exact", "")
@@ -1324,6 +1442,14 @@ class SpectrumCalculator(object):
         self.kernels = {}
         self.power = {}
         self.outputs = {}
+        self.interpolation_cache = LimberPowerCache()
+
+        # Kernels from n(z) are kept between samples, and only the bins
+        # whose n(z) or distances have changed are rebuilt.
+        # Maps sample name to (kernel, bin input hashes, kernel types built)
+        self.kernel_cache = {}
+        self.kernel_cache_hits = 0
+        self.kernel_cache_misses = 0
 
     def parse_requested_spectra(self, options):
         # Get the list of spectra that we want to compute.
@@ -1362,6 +1488,13 @@ class SpectrumCalculator(object):
             # If we find any of the options set then record that
             any_spectra_option_found = True
 
+            # Check now that we know how to build the kernels, so that
+            # errors in set_kernel_splines only come from the sampled parameters
+            for kernel_type in spectrum.kernel_types:
+                if kernel_type not in KERNEL_TYPES:
+                    raise ValueError(f"Invalid kernel type {kernel_type} for {option_name}. "
+                                     f"Should be one of {KERNEL_TYPES}")
+
 
             if isinstance(value, bool):
                 if value:
@@ -1510,72 +1643,136 @@ class SpectrumCalculator(object):
         self.dchidz = self.chi_of_z.derivative()
         self.chi_distance = chi_distance
 
+        # The n(z) kernels depend on these, so we record a hash of them
+        # to tell when the cached kernels need re-computing
+        distance_hash = hashlib.sha1()
+        for x in (z_distance, a_distance, chi_distance):
+            distance_hash.update(np.ascontiguousarray(x, dtype=float).tobytes())
+        self.distance_hash = distance_hash.digest()
+
     def load_kernels(self, block):
         # During the setup we already decided what kernels (W(z) or N(z) splines)
         # we needed for the spectra we want to do. Load them now and add to the
         # self.kernels dictionary.
-        for key in self.req_kernel_keys:
-            kernel_type, sample_name = key
-
-            # For all the sources we need the n(z)
-            if (sample_name not in self.kernels) and (sample_name != 'cmb'):
-                section_name = "nz_"+sample_name
-                self.kernels[sample_name] = TomoNzKernel.from_block(block, section_name, norm=True)
-            if (sample_name not in self.kernels) and (sample_name == 'cmb'):
+        kernel_types = {}
+        for kernel_type, sample_name in sorted(self.req_kernel_keys):
+            kernel_types.setdefault(sample_name, []).append(kernel_type)
+
+        for sample_name, types in kernel_types.items():
+            if sample_name == 'cmb':
                 zmin = 0.001
                 zmax = block['distances','zstar']
                 z_arr_for_cmb = np.exp(np.linspace(np.log(zmin), np.log(zmax), num = 1000))
-                self.kernels[sample_name] =  TomoNzKernel(z_arr_for_cmb, 0, is_cmb_lensing = True)
-                
-            if kernel_type == "N":
-                self.kernels[sample_name].set_nofchi_splines(self.chi_of_z, self.dchidz,
-                    clip=self.clip_chi_kernels)
-
-            elif kernel_type == "W":
-                self.kernels[sample_name].set_wofchi_splines(self.chi_of_z,
-                    self.dchidz, self.a_of_chi, clip=self.clip_chi_kernels,
-                    dchi=self.shear_kernel_dchi)
-
-            elif kernel_type == 'K' and sample_name == 'cmb':
-                chi_star = block['distances','chistar']
-                h0 = block[names.cosmological_parameters, "h0"]
-                self.kernels[sample_name].set_cmblensing_splines(self.chi_of_z, self.a_of_chi, chi_star*h0, clip = self.clip_chi_kernels)
-
-            elif kernel_type == "W_W":
-                self.kernels[sample_name].set_wwofchi_splines(self.chi_of_z,
-                    self.dchidz, self.a_of_chi, clip=self.clip_chi_kernels,
-                    dchi=self.shear_kernel_dchi)
-
-            elif kernel_type == "F":
-                # This is the combined shear and IA kernel. We need to calculate
-                # F(z) = - A *(z/z0)**alpha * C1_RHOCRIT * Omega_m / growth(z)
-                # This kernel is only valid for simple IA models.
-                ia_params = "intrinsic_alignment_parameters"
-                a_ia = block[ia_params, "A"]
-                alpha = block.get_double(ia_params, "alpha", 0.)
-                z0 = block.get_double(ia_params, "z0", 0.5)
-
-                # Get the growth rate from the matter power, by finding
-                # the nearest k value to 1e-3
-                z,k,pk_lin = block.get_grid(names.matter_power_lin, "z", "k_h", "p_k")
-                k_growth = 1.e-3
-                growth_ind = np.argmin(np.abs(k-k_growth))
-                growth_vals = np.sqrt(pk_lin[:, growth_ind] / pk_lin[0, growth_ind])
-
-                omega_m = block[names.cosmological_parameters, "omega_m"]
-
-                F_of_z = (-1 * a_ia * C1_RHOCRIT * ((1+z)/(1+z0))**alpha
-                    * omega_m / growth_vals)
-
-                F_of_chi_spline = interp.InterpolatedUnivariateSpline(
-                    self.chi_of_z(z), F_of_z)
-
-                self.kernels[sample_name].set_combined_shear_ia_splines(
-                    self.chi_of_z, self.dchidz, self.a_of_chi, F_of_chi_spline,
-                    self.lensing_prefactor, clip=self.clip_chi_kernels,
-                    dchi=self.shear_kernel_dchi)
+                kernel =  TomoNzKernel(z_arr_for_cmb, 0, is_cmb_lensing = True)
+                self.kernels[sample_name] = kernel
+                for kernel_type in types:
+                    self.set_kernel_splines(block, kernel, kernel_type, None)
+            else:
+                self.load_nz_kernels(block, sample_name, types)
+
+    def load_nz_kernels(self, block, sample_name, types):
+        # For all the sources we need the n(z)
+        section_name = "nz_"+sample_name
+        nbin = block[section_name, "nbin"]
+        z = block[section_name, "z"]
+        nzs = [block[section_name, "bin_%d"%i] for i in range(1, nbin+1)]
+
+        # The kernels for each bin depend only on its n(z) and the distances
+        bin_hashes = []
+        for nz in nzs:
+            h = hashlib.sha1(self.distance_hash)
+            h.update(np.ascontiguousarray(nz, dtype=float).tobytes())
+            bin_hashes.append(h.digest())
+
+        cached = self.kernel_cache.pop(sample_name, None)
+        if cached is None or cached[0].nbin != nbin or not np.array_equal(cached[0].z, z):
+            kernel = TomoNzKernel(z, nzs, norm=True)
+            changed_bins = list(range(1, nbin+1))
+            built_types = set()
+        else:
+            kernel, old_hashes, built_types = cached
+            changed_bins = [b for b in range(1, nbin+1) if bin_hashes[b-1] != old_hashes[b-1]]
+            for b in changed_bins:
+                kernel.set_nz(b, nzs[b-1])
+
+        # The other kernels are built from the n(chi) splines, so those
+        # must be updated first, even if we don't need them directly.
+        types = sorted(types, key=lambda t: t != "N")
+        if changed_bins and "N" not in types:
+            kernel.set_nofchi_splines(self.chi_of_z, self.dchidz,
+                clip=self.clip_chi_kernels, bins=self._kernel_bins(kernel, changed_bins))
+
+        for kernel_type in types:
+            # The F kernel also depends on the IA parameters so is always rebuilt
+            if kernel_type in built_types and kernel_type != "F":
+                bins = changed_bins
             else:
-                raise ValueError(f"Invalid kernel type: {kernel_type}. Should be 'N' or 'W'")
+                bins = list(range(1, nbin+1))
+            self.kernel_cache_hits += nbin - len(bins)
+            self.kernel_cache_misses += len(bins)
+            if bins:
+                self.set_kernel_splines(block, kernel, kernel_type,
+                    self._kernel_bins(kernel, bins))
+
+        self.kernels[sample_name] = kernel
+        # Only cache this once everything has been built successfully
+        self.kernel_cache[sample_name] = (kernel, bin_hashes, built_types | set(types))
+
+    @staticmethod
+    def _kernel_bins(kernel, bins):
+        # None means all bins, which lets the kernel reset itself completely
+        return None if len(bins) == kernel.nbin else bins
+
+    def set_kernel_splines(self, block, kernel, kernel_type, bins):
+        if kernel_type == "N":
+            kernel.set_nofchi_splines(self.chi_of_z, self.dchidz,
+                clip=self.clip_chi_kernels, bins=bins)
+
+        elif kernel_type == "W":
+            kernel.set_wofchi_splines(self.chi_of_z,
+                self.dchidz, self.a_of_chi, clip=self.clip_chi_kernels,
+                dchi=self.shear_kernel_dchi, bins=bins)
+
+        elif kernel_type == 'K':
+            chi_star = block['distances','chistar']
+            h0 = block[names.cosmological_parameters, "h0"]
+            kernel.set_cmblensing_splines(self.chi_of_z, self.a_of_chi, chi_star*h0, clip = self.clip_chi_kernels)
+
+        elif kernel_type == "W_W":
+            kernel.set_wwofchi_splines(self.chi_of_z,
+                self.dchidz, self.a_of_chi, clip=self.clip_chi_kernels,
+                dchi=self.shear_kernel_dchi, bins=bins)
+
+        elif kernel_type == "F":
+            # This is the combined shear and IA kernel. We need to calculate
+            # F(z) = - A *(z/z0)**alpha * C1_RHOCRIT * Omega_m / growth(z)
+            # This kernel is only valid for simple IA models.
+            ia_params = "intrinsic_alignment_parameters"
+            a_ia = block[ia_params, "A"]
+            alpha = block.get_double(ia_params, "alpha", 0.)
+            z0 = block.get_double(ia_params, "z0", 0.5)
+
+            # Get the growth rate from the matter power, by finding
+            # the nearest k value to 1e-3
+            z,k,pk_lin = block.get_grid(names.matter_power_lin, "z", "k_h", "p_k")
+            k_growth = 1.e-3
+            growth_ind = np.argmin(np.abs(k-k_growth))
+            growth_vals = np.sqrt(pk_lin[:, growth_ind] / pk_lin[0, growth_ind])
+
+            omega_m = block[names.cosmological_parameters, "omega_m"]
+
+            F_of_z = (-1 * a_ia * C1_RHOCRIT * ((1+z)/(1+z0))**alpha
+                * omega_m / growth_vals)
+
+            F_of_chi_spline = interp.InterpolatedUnivariateSpline(
+                self.chi_of_z(z), F_of_z)
+
+            kernel.set_combined_shear_ia_splines(
+                self.chi_of_z, self.dchidz, self.a_of_chi, F_of_chi_spline,
+                self.lensing_prefactor, clip=self.clip_chi_kernels,
+                dchi=self.shear_kernel_dchi, bins=bins)
+        else:
+            raise ValueError(f"Invalid kernel type: {kernel_type}. Should be one of {KERNEL_TYPES}")
 
     def save_kernels_to_block(self, block):
         for name, kernel in self.kernels.items():
@@ -1603,14 +1800,17 @@ class SpectrumCalculator(object):
         self.lensing_weyl_prefactor = get_lensing_weyl_prefactor(block)
 
 
-    def compute_spectrum(self, block, spectrum):
-
+    def prepare_spectrum(self, block, spectrum):
+        """
+        Save metadata about the spectrum and read everything it needs 
+        from the block, so that its bin pairs can then be computed
+        without touching the block.
+        """
         # Save some naming about the spectrum
-        sep_name = "ell"
         block[spectrum.section_name, "save_name"] = spectrum.save_name
         block[spectrum.section_name, "sample_a"] = spectrum.sample_a
         block[spectrum.section_name, "sample_b"] = spectrum.sample_b
-        block[spectrum.section_name, "sep_name"] = sep_name
+        block[spectrum.section_name, "sep_name"] = "ell"
 
         # And bin count info
         na, nb = spectrum.nbins()
@@ -1628,11 +1828,125 @@ class SpectrumCalculator(object):
 
         # Set up nay required power splines
         spectrum.prepare(block, lin_bias_prefix=self.lin_bias_prefix)
+        spectrum.load_magnification_alphas(block)
+
+    def compute_bin_pairs(self, block, spectrum, bin_pairs):
+        """
+        Compute the C(l) for a list of bin pairs of a prepared spectrum.
+        This does not read from or write to the block, so can be run
+        in a thread.
+
+        Returns
+        -------
+        results: list of (ell, c_ell)
+            one for each bin pair
+        """
+        do_exact = spectrum.section_name in self.do_exact_section_names
+
+        # If possible we do the Limber integrals for all the bin pairs at once
+        if self.batch_limber and spectrum.batch_limber and not do_exact:
+            if self.verbose:
+                print(f"    Computing {len(bin_pairs)} bin pairs together")
+            c_ells = spectrum.compute_limber_batch(block, self.ell, bin_pairs,
+                sig_over_dchi=self.sig_over_dchi)
+            return [(self.ell, c_ell) for c_ell in c_ells]
+
+        results = []
+        for (i, j) in bin_pairs:
+            if self.verbose:
+                print(f"    Computing bin pair {i}, {j}")
+            # For some (user-chosen) spectra we compute the non-limber
+            # spectrum for a subset of the ell range
+            if do_exact:
+                exact_kwargs = self.exact_kwargs.copy()
+                if spectrum.has_rsd:
+                    exact_kwargs["do_rsd"] = self.do_rsd
+                ell, c_ell = spectrum.compute(block, self.ell_limber, i, j,
+                    sig_over_dchi_limber=self.sig_over_dchi, ell_exact=self.ell_exact,
+                    exact_kwargs=exact_kwargs)
+            else:
+                ell, c_ell = spectrum.compute(block, self.ell, i, j,
+                    sig_over_dchi_limber=self.sig_over_dchi)
+            results.append((ell, c_ell))
+        return results
+
+    def save_bin_pairs(self, block, spectrum, bin_pairs, results):
+        if self.cl_layout == "legacy":
+            for (i, j), (ell, c_ell) in zip(bin_pairs, results):
+                block[spectrum.section_name, "ell"] = ell
+                block[spectrum.section_name, f'bin_{i}_{j}'] = c_ell
+            return
+
+        if not bin_pairs:
+            return
+
+        # All the bin pairs in one (nbin_a, nbin_b, n_ell) array
+        na, nb = spectrum.nbins()
+        ell = results[-1][0]
+        c_ells = np.zeros((na, nb, len(ell)))
+        mask = np.zeros((na, nb), dtype=bool)
+        for (i, j), (_, c_ell) in zip(bin_pairs, results):
+            c_ells[i - 1, j - 1] = c_ell
+            mask[i - 1, j - 1] = True
+        block[spectrum.section_name, "ell"] = ell
+        packed_spectra.put_packed(block, spectrum.section_name, c_ells, mask, self.cl_layout)
+
+    def compute_spectrum(self, block, spectrum):
+        self.prepare_spectrum(block, spectrum)
 
         if self.verbose:
             print(f"Computing spectrum {spectrum.__class__.__name__} ({spectrum.section_name}) for samples"
                   f" ({spectrum.sample_a}, {spectrum.sample_b}) from P(k) {spectrum.input_section_name}")
 
+        bin_pairs = self.get_bin_pairs(spectrum)
+        if not bin_pairs:
+            return
+        results = self.compute_bin_pairs(block, spectrum, bin_pairs)
+        self.save_bin_pairs(block, spectrum, bin_pairs, results)
+
+    def compute_spectra_threaded(self, block):
+        """
+        Compute all the requested spectra using a pool of self.n_threads
+        threads.  Most of the work is in numpy and scipy, which release
+        the GIL.  The block is only accessed from this thread, and the
+        results are saved in the same order as in the serial case.
+        """
+        # Everything that reads from the block is done first, here.
+        for spectrum in self.req_spectra:
+            self.prepare_spectrum(block, spectrum)
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            spectrum_jobs = []
+            for spectrum in self.req_spectra:
+                bin_pairs = self.get_bin_pairs(spectrum)
+                do_exact = spectrum.section_name in self.do_exact_section_names
+                # Spectra with a P(k) that depends on the bin pair keep
+                # state between pairs, so their pairs are done in one task,
+                # as are batched Limber calculations.
+                if (not spectrum.batch_limber) or (self.batch_limber and not do_exact):
+                    groups = [bin_pairs] if bin_pairs else []
+                else:
+                    groups = [[bin_pair] for bin_pair in bin_pairs]
+                jobs = [(group, pool.submit(self.compute_bin_pairs, block, spectrum, group))
+                        for group in groups]
+                spectrum_jobs.append((spectrum, jobs))
+
+            # Collect results and save them in a fixed order
+            for spectrum, jobs in spectrum_jobs:
+                bin_pairs = []
+                results = []
+                for group, job in jobs:
+                    bin_pairs += group
+                    results += job.result()
+                self.save_bin_pairs(block, spectrum, bin_pairs, results)
+
+    def get_bin_pairs(self, spectrum):
+        """
+        Get the list of (bin1, bin2) pairs (starting from 1) 
+        to compute for a spectrum.
+        """
+        na, nb = spectrum.nbins()
+        bin_pairs = []
         for i in range(na):
             if not spectrum.should_do_bin(i+1) and spectrum.len_only_bins == na:
                 continue
@@ -1647,33 +1961,20 @@ class SpectrumCalculator(object):
                         continue
                 if not spectrum.should_do_bin(j+1) and spectrum.kernel_types[0] == spectrum.kernel_types[1]:
                     continue
-
-                if self.verbose:
-                    print(f"    Computing bin pair {i+1}, {j+1}")
-                # For some (user-chosen) spectra we compute the non-limber
-                # spectrum for a subset of the ell range
-                if spectrum.section_name in self.do_exact_section_names:
-                    exact_kwargs = self.exact_kwargs.copy()
-                    if spectrum.has_rsd:
-                        exact_kwargs["do_rsd"] = self.do_rsd
-                    ell, c_ell = spectrum.compute(block, self.ell_limber, i+1, j+1,
-                        sig_over_dchi_limber=self.sig_over_dchi, ell_exact=self.ell_exact,
-                        exact_kwargs=exact_kwargs)
-                else:
-                    ell, c_ell = spectrum.compute(block, self.ell, i+1, j+1,
-                        sig_over_dchi_limber=self.sig_over_dchi)
-
-                block[spectrum.section_name, sep_name] = ell
-                block[spectrum.section_name, f'bin_{i+1}_{j+1}'] = c_ell
+                bin_pairs.append((i+1, j+1))
+        return bin_pairs
 
     def clean(self):
         # need to manually delete power spectra we have loaded
         self.power.clear()
 
-        # spectra know how to delete themselves, in gsl_wrappers.py
+        # The n(z) kernels themselves stay in self.kernel_cache
+        # for the next sample, but we count re-use per sample
         self.kernels.clear()
         self.outputs.clear()
         self.lensing_prefactor = None
+        self.kernel_cache_hits = 0
+        self.kernel_cache_misses = 0
 
         self.interpolation_cache.clear()
 
@@ -1684,11 +1985,9 @@ class SpectrumCalculator(object):
         """
         try:
             # Load input information from the block
-            self.interpolation_cache = {}
             self.load_distance_splines(block)
             self.load_lensing_prefactor(block)
             self.load_lensing_weyl_prefactor(block)
-            self.load_kernels(block)
 
             # Loading the kernels can often fail, so we catch that specifically
             # and explain the causes
@@ -1699,7 +1998,7 @@ class SpectrumCalculator(object):
                 if self.verbose:
                     t = timedelta(seconds=t1-t0)
                     print(f"Time to set up kernels: {t}")
-            except NullSplineError:
+            except KernelSplineError:
                 sys.stderr.write("Failed to load one of the kernels (n(z) or W(z)) "
                                  "needed to compute 2D spectra\n"
                                  "Often this is because you are in a weird part of "
@@ -1728,18 +2027,33 @@ class SpectrumCalculator(object):
                 t = timedelta(seconds=t1-t0)
                 print(f"Time to load power: {t}")
 
-            # Now loop through the required spectra calling the compute function
-            for spectrum in self.req_spectra:
-                # For optimization it is useful to individually report the time
-                # taken for each set of spectra
+            # Now loop through the required spectra calling the compute function,
+            # or hand them out to a pool of threads.
+            if self.n_threads > 1:
                 t0 = timer()
-
-                self.compute_spectrum(block, spectrum)
-
+                self.compute_spectra_threaded(block)
                 t1 = timer()
                 if self.verbose:
                     t = timedelta(seconds=(t1-t0))
-                    print(f"Time to compute spectrum {spectrum.section_name}: {t}")
+                    print(f"Time to compute all spectra with {self.n_threads} threads: {t}")
+            else:
+                for spectrum in self.req_spectra:
+                    # For optimization it is useful to individually report the time
+                    # taken for each set of spectra
+                    t0 = timer()
+
+                    self.compute_spectrum(block, spectrum)
+
+                    t1 = timer()
+                    if self.verbose:
+                        t = timedelta(seconds=(t1-t0))
+                        print(f"Time to compute spectrum {spectrum.section_name}: {t}")
+
+            if self.verbose:
+                cache = self.interpolation_cache
+                print(f"P(k, chi) evaluation cache: {cache.hits} hits, {cache.misses} misses")
+                print(f"n(z) kernel cache: {self.kernel_cache_hits} bin kernels re-used, "
+                      f"{self.kernel_cache_misses} computed")
         finally:
             self.clean()
         return 0
@@ -38,22 +38,30 @@ cut=200  # cutoff to switch to Gamma function limiting case (needed when argumen
          # gamma function is large) 
 
 def g_m_vals(mu,q):
+    # mu and q may be arrays, in which case they are broadcast against each
+    # other, e.g. mu with shape (n_mu,1) and q with shape (n_m,) gives the
+    # (n_mu, n_m) coefficients for several Bessel orders at once.
+    mu, q = np.broadcast_arrays(mu, q)
 
     imag_q= np.imag(q)
     
-    g_m=np.zeros(q.size, dtype=complex)
+    g_m=np.zeros(q.shape, dtype=complex)
 
     use_asym = (np.absolute(imag_q)+mu+1 > cut) | (np.absolute(-imag_q)+mu+1 > cut)
     asym_q=q[use_asym]
-    asym_plus=(mu+1+asym_q)/2.
-    asym_minus=(mu+1-asym_q)/2.
-    
-    q_good=q[ (~use_asym) & (q!=mu + 1 + 0.0j)]
+    asym_mu=mu[use_asym]
+    asym_plus=(asym_mu+1+asym_q)/2.
+    asym_minus=(asym_mu+1-asym_q)/2.
+    
+    pole = (q == mu + 1 + 0.0j)
+    good = (~use_asym) & (~pole)
+    q_good=q[good]
+    mu_good=mu[good]
 
-    alpha_plus=(mu+1+q_good)/2.
-    alpha_minus=(mu+1-q_good)/2.
+    alpha_plus=(mu_good+1+q_good)/2.
+    alpha_minus=(mu_good+1-q_good)/2.
     
-    g_m[(~use_asym) & (q!= mu + 1 + 0.0j)] =gamma(alpha_plus)/gamma(alpha_minus)
+    g_m[good] =gamma(alpha_plus)/gamma(alpha_minus)
 
     #g_m[np.absolute(imag_q)>cut] = exp( (asym_plus-0.5)*log(asym_plus) - (asym_minus-0.5)*log(asym_minus) - asym_q )
     
@@ -64,7 +72,7 @@ def g_m_vals(mu,q):
     g_m[use_asym] = exp( (asym_plus-0.5)*log(asym_plus) - (asym_minus-0.5)*log(asym_minus) - asym_q \
         +1./12 *(1./asym_plus - 1./asym_minus) +1./360.*(1./asym_minus**3 - 1./asym_plus**3) +1./1260*(1./asym_plus**5 - 1./asym_minus**5) )
 
-    g_m[np.where(q==mu+1+0.0j)[0]] = 0.+0.0j
+    g_m[pole] = 0.+0.0j
     
     return g_m
 
@@ -211,6 +219,75 @@ def fft_log(k,f_k,q,mu,kr=None):
         
     return r, A 
 
+def fft_log_batch(k,f_k,q,mu,kr=None):
+    r'''
+    As fft_log, but for an array of Bessel orders mu (and optionally a matching
+    array of kr values), all applied to the same input f_k. The FFT of f_k is 
+    done once, and the coefficients for each order are broadcast over an 
+    (n_mu, n_m) array. 
+    
+    Returns r and A, each with shape (n_mu, N), with row i giving the same 
+    result as fft_log(k, f_k, q, mu[i], kr=kr[i]). 
+    '''
+    mu=np.atleast_1d(mu).astype(float)
+    
+    if np.any((q+mu) < -1) :
+        print('Error in reality condition for Bessel function integration.')
+        print(' q+mu is less than -1.')
+        print('See Abramowitz and Stegun. Handbook of Mathematical Functions pg. 486')
+        
+    if ( q > 1/2.) :
+        print('Error in reality condition for Bessel function integration.')
+        print(' q is greater than 1/2')
+        print('See Abramowitz and Stegun. Handbook of Mathematical Functions pg. 486')
+
+    N=f_k.size
+    delta_L=(log(np.max(k))-log(np.min(k)))/float(N-1)
+    L=(log(np.max(k))-log(np.min(k)))
+        
+    diff=np.diff(np.log(k))
+    diff=np.diff(diff)
+    if (np.sum(diff) >=1e-10):
+        raise ValueError('You need to send in data that is sampled evenly in logspace')
+    
+    log_k0=log(k[N//2])
+    k0=exp(log_k0)
+    
+    # The single Fourier transform of the input data
+    c_m=rfft(f_k)
+    m=np.fft.rfftfreq(N,d=1.)*float(N)
+
+    if kr is None:
+        kr=mu+0.5
+    kr=np.broadcast_to(kr, mu.shape).astype(float)
+    log_r0=log(kr/k0)[:,np.newaxis]
+
+    m_r=np.arange(-N//2,N//2)
+    id=np.fft.fftshift(m_r)
+    
+    #s-array, one row per order
+    s=delta_L*(-m_r)+log_r0
+    r=10**(s[:,id]/log(10))
+
+    # u_m for every order at once, as in u_m_vals_new
+    omega=1j*2*pi*m/L
+    x=q + omega
+    U_mu=2**x*g_m_vals(mu[:,np.newaxis],x)
+    u_m=(kr[:,np.newaxis])**(-omega)*U_mu
+    u_m[:,-1]=np.real(u_m[:,-1])
+
+    A_m=irfft(c_m*u_m, n=N, axis=-1)
+    A=A_m[:,id]
+    
+    # reverse the order 
+    A=A[:,::-1]
+    r=r[:,::-1]
+    
+    if (q!=0):
+        A=A*(r)**(-float(q))
+        
+    return r, A 
+
 ##########################################################################################
 # End of fftlog algorithm 
 
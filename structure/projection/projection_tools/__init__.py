@@ -1,4 +1,5 @@
-from .kernel import TomoNzKernel
-from .pk2cl_tools import exact_integral, limber_integral, get_dlogchi
+from .kernel import TomoNzKernel, KernelSplineError
+from .pk2cl_tools import exact_integral, limber_integral, limber_integral_batch, get_dlogchi, \
+                         LimberPowerCache
 from .fastpt_tools import get_Pk_basis_funcs, get_bias_params_bin, get_PXX, get_PXm
 from .enum34 import Enum
\ No newline at end of file
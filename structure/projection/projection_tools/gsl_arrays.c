@@ -0,0 +1,54 @@
+/*
+Evaluate GSL splines on whole arrays of points, for the python wrappers
+in gsl_wrappers.py, so that they make one ctypes call per array rather
+than one per point.  Points are evaluated in order with a single
+accelerator, which makes sorted inputs cheap to look up.
+
+Each function returns the first non-zero GSL status, e.g. GSL_EDOM for
+a point outside the spline, or GSL_SUCCESS.  The GSL error handler is
+switched off while evaluating so that the caller can raise the error.
+*/
+#include <stddef.h>
+#include <gsl/gsl_errno.h>
+#include <gsl/gsl_spline.h>
+#include <gsl/gsl_spline2d.h>
+
+int gsl_spline_eval_array(const gsl_spline * spline, const double * x, size_t n, double * y)
+{
+    int status = GSL_SUCCESS;
+    gsl_interp_accel * acc = gsl_interp_accel_alloc();
+    if (acc == NULL) return GSL_ENOMEM;
+
+    gsl_error_handler_t * old_handler = gsl_set_error_handler_off();
+    for (size_t i = 0; i < n; i++){
+        status = gsl_spline_eval_e(spline, x[i], acc, &y[i]);
+        if (status) break;
+    }
+    gsl_set_error_handler(old_handler);
+
+    gsl_interp_accel_free(acc);
+    return status;
+}
+
+int gsl_spline2d_eval_array(const gsl_spline2d * spline, const double * x, const double * y,
+    size_t n, double * z)
+{
+    int status = GSL_SUCCESS;
+    gsl_interp_accel * xacc = gsl_interp_accel_alloc();
+    gsl_interp_accel * yacc = gsl_interp_accel_alloc();
+    if (xacc == NULL || yacc == NULL){
+        status = GSL_ENOMEM;
+    }
+    else{
+        gsl_error_handler_t * old_handler = gsl_set_error_handler_off();
+        for (size_t i = 0; i < n; i++){
+            status = gsl_spline2d_eval_e(spline, x[i], y[i], xacc, yacc, &z[i]);
+            if (status) break;
+        }
+        gsl_set_error_handler(old_handler);
+    }
+
+    if (xacc != NULL) gsl_interp_accel_free(xacc);
+    if (yacc != NULL) gsl_interp_accel_free(yacc);
+    return status;
+}
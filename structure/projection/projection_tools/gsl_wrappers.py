@@ -74,6 +74,23 @@ AKIMA_PERIODIC = ct.c_void_p.in_dll(gsl, "gsl_interp_akima_periodic")
 BILINEAR = ct.c_void_p.in_dll(gsl, "gsl_interp2d_bilinear")
 BICUBIC = ct.c_void_p.in_dll(gsl, "gsl_interp2d_bicubic")
 
+# Our helper library for evaluating splines on arrays, built from gsl_arrays.c
+# by the Makefile in this directory.  If it has not been built we fall back to
+# calling GSL for each point from python.
+def load_gsl_arrays():
+    libfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gsl_arrays.so")
+    try:
+        lib = ct.CDLL(libfile)
+    except OSError:
+        return None
+    lib.gsl_spline_eval_array.restype = ct.c_int
+    lib.gsl_spline_eval_array.argtypes = [ct.c_void_p, c_dbl_array, ct.c_size_t, c_dbl_array]
+    lib.gsl_spline2d_eval_array.restype = ct.c_int
+    lib.gsl_spline2d_eval_array.argtypes = [ct.c_void_p, c_dbl_array, c_dbl_array, ct.c_size_t, c_dbl_array]
+    return lib
+
+gsl_arrays = load_gsl_arrays()
+
 class NullSplineError(ValueError):
     pass            
 
@@ -117,6 +134,21 @@ class GSLSpline(object):
             y = np.exp(y)
         return y
 
+    def _eval_array(self, x):
+        "Evaluate the spline on an array of x values with a single call to GSL"
+        if gsl_arrays is None:
+            return np.array([self._eval(xi) for xi in x.flat]).reshape(x.shape)
+        if self.xlog:
+            x = np.log(x)
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        y = np.empty_like(x)
+        status = gsl_arrays.gsl_spline_eval_array(self._ptr, x.ravel(), x.size, y.ravel())
+        if status:
+            raise Exception("GSL ERROR: {0}".format(status))
+        if self.ylog:
+            y = np.exp(y)
+        return y
+
     def __call__(self, x):
         """
         Evaluate the spline that this class points to.
@@ -124,8 +156,8 @@ class GSLSpline(object):
         if np.isscalar(x):
             return self._eval(x)
         else:
-            x = np.array(x)
-            return np.array([self._eval(xi) for xi in x])
+            x = np.array(x, dtype=float)
+            return self._eval_array(x)
 
 class GSLSpline2d(object):
     def __init__(self, x, y=None, Z=None, spline_type=BILINEAR):
@@ -160,19 +192,27 @@ class GSLSpline2d(object):
         z = z.value
         return z
 
+    def _eval_array(self, x, y):
+        "Evaluate the spline at arrays of x and y values with a single call to GSL"
+        if gsl_arrays is None:
+            return np.array([self._eval(xi,yi) for (xi,yi) in zip(x.flat,y.flat)]).reshape(x.shape)
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+        z = np.empty_like(x)
+        status = gsl_arrays.gsl_spline2d_eval_array(self._ptr, x.ravel(), y.ravel(), x.size, z.ravel())
+        if status:
+            raise Exception("GSL ERROR: {0}".format(status))
+        return z
+
     def __call__(self, x, y):
         """
-        Evaluate the spline that this class points to - for testing, you wouldn't actually
-        want to do this at the python level
+        Evaluate the spline that this class points to, at each (x,y) pair,
+        or along x or y if the other is a single value.
         """
-        x = np.atleast_1d(x)
-        y = np.atleast_1d(y)
-        if len(x)==1:
-            return np.array([self._eval(x[0],yi) for yi in y])
-        elif len(y)==1:
-            return np.array([self._eval(xi, y[0]) for xi in x])
-        else:
-            return np.array([self._eval(xi,yi) for (xi,yi) in zip(x,y)])
+        x = np.atleast_1d(x).astype(float)
+        y = np.atleast_1d(y).astype(float)
+        x, y = np.broadcast_arrays(x, y)
+        return self._eval_array(x, y)
 
 
 def test1d():
@@ -197,5 +237,22 @@ def test2d():
     gsl.gsl_spline2d_eval_e(spline._ptr, x_test, y_test, None, None, ct.byref(output))
     print(output.value, x_test*y_test**0.5)
 
+def benchmark1d(n_knots=500, n_eval=100000):
+    "Compare array evaluation of a GSLSpline with scipy's InterpolatedUnivariateSpline"
+    import timeit
+    from scipy.interpolate import InterpolatedUnivariateSpline
+    x = np.linspace(0, 10, n_knots)
+    y = np.sin(x)
+    x_eval = np.sort(np.random.uniform(0, 10, n_eval))
+    spline = GSLSpline(x, y, spline_type=CSPLINE)
+    scipy_spline = InterpolatedUnivariateSpline(x, y)
+    t_gsl = min(timeit.repeat(lambda: spline(x_eval), number=10, repeat=3)) / 10
+    t_scipy = min(timeit.repeat(lambda: scipy_spline(x_eval), number=10, repeat=3)) / 10
+    t_scalar = timeit.timeit(lambda: [spline(xi) for xi in x_eval[:1000]], number=1) / 1000 * n_eval
+    print("{} points: GSLSpline {:.2e}s, scipy IUS {:.2e}s, GSLSpline point by point {:.2e}s".format(
+        n_eval, t_gsl, t_scipy, t_scalar))
+    print("max difference from scipy: {:.2e}".format(np.abs(spline(x_eval) - scipy_spline(x_eval)).max()))
+
 if __name__=="__main__":
     test2d()
+    benchmark1d()
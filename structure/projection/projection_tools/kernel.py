@@ -2,6 +2,14 @@ import numpy as np
 import scipy.interpolate as interp
 import warnings
 
+class KernelSplineError(ValueError):
+    """
+    A kernel could not be splined, e.g. because it is zero everywhere
+    or its chi values are not increasing.  This usually means a strange
+    part of parameter space rather than a problem with the configuration.
+    """
+    pass
+
 class KernelSpline(object):
     def __init__(self, x, y, clip=1.e-6, ymin=1.e-12, 
         norm=True, is_pos=True, xmin_clipped_min=5.0):
@@ -31,6 +39,8 @@ class KernelSpline(object):
         """
 
         self.x = x
+        if not np.all(np.isfinite(y)):
+            raise KernelSplineError("Kernel has non-finite values")
         if is_pos and not np.all(y>=0.):
             warnings.warn("Some of your n(z) or other kernels are negative.")
         self.y = y
@@ -40,6 +50,8 @@ class KernelSpline(object):
         quick_norm = np.sum(np.diff(x) * np.abs(y[:-1]))
         too_small = np.abs(self.y)/quick_norm < ymin
         good_inds, = np.where(~too_small)
+        if len(good_inds) == 0:
+            raise KernelSplineError("Kernel is zero everywhere")
         start, end = good_inds[0], good_inds[-1]
         if start>0:
             start-=1
@@ -52,7 +64,10 @@ class KernelSpline(object):
         self.xmin, self.xmax = self.x[0], self.x[-1]
 
         #Setup spline and normalize if norm=True.
-        self.spline = interp.InterpolatedUnivariateSpline(self.x, self.y)
+        try:
+            self.spline = interp.InterpolatedUnivariateSpline(self.x, self.y)
+        except ValueError as error:
+            raise KernelSplineError(str(error)) from error
         self.norm = self.spline.integral(self.x[0], self.x[-1])
         if norm==True:
             self.y /= self.norm
@@ -66,6 +81,8 @@ class KernelSpline(object):
         pos_diff = np.zeros(len(cumsum_y), dtype=bool)
         pos_diff[0] = True
         pos_diff[1:] = np.diff(cumsum_y)>0.
+        if pos_diff.sum() < 2:
+            raise KernelSplineError("Kernel is too narrow to spline")
         # We have to use a linear spline here, 
         # because otherwise the points can go a bit crazy
         # near y=0 and y=1, which is exactly the place we care about.
@@ -98,6 +115,27 @@ class KernelSpline(object):
         else:
             return self.spline(x)
 
+def cumulative_kernel_integrals(x, y, x_out):
+    """
+    For a set of kernels y (n_kernel, n_x) sampled on a common grid x,
+    compute the cumulative integrals from x_out to the end of the grid
+
+        A(x_out) = \int_{x_out}^{x_max} y(x') dx'
+        B(x_out) = \int_{x_out}^{x_max} y(x') / x' dx'
+
+    for all the kernels at once, using the antiderivatives of their
+    cubic splines. Returns A and B with shape (n_kernel, len(x_out)).
+    """
+    y_over_x = np.zeros_like(y)
+    np.divide(y, x, out=y_over_x, where=x>0)
+    A_spline = interp.make_interp_spline(x, y, k=3, axis=1).antiderivative()
+    B_spline = interp.make_interp_spline(x, y_over_x, k=3, axis=1).antiderivative()
+    x_out = np.clip(x_out, x[0], x[-1])
+    A = A_spline(x[-1])[:, np.newaxis] - A_spline(x_out)
+    B = B_spline(x[-1])[:, np.newaxis] - B_spline(x_out)
+    return A, B
+
+
 class TomoNzKernel(object):
     def __init__(self, z, nzs, norm=True, is_cmb_lensing = False):
         # We need to handle CMB lensing separately
@@ -108,13 +146,12 @@ class TomoNzKernel(object):
             for i,nz in enumerate(nzs):
                 self.nbin += 1
                 if norm:
-                    nz_spline = interp.InterpolatedUnivariateSpline(self.z, nz)
-                    norm = nz_spline.integral(self.z[0], self.z[-1])
-                    nz = nz/norm
-                    self.nzs[i+1] = nz
+                    self.set_nz(i+1, nz)
 
             # These get set later
             self.nchi_splines = {} #n(chi) splines
+            self.nchi_grid = None #common chi grid for the n(chi) of all bins
+            self.nchi_vals = None #n(chi) for all bins on that grid
             self.wchi_splines = {} #W(chi) splines
             self.wwchi_splines = {} #W_weyl(chi) splines
         else:
@@ -122,6 +159,18 @@ class TomoNzKernel(object):
             self.nbin = 1
             self.cmblensing_spline = {} #W_cmb(chi) spline
 
+    def set_nz(self, i, nz):
+        # Set the normalized n(z) for bin i
+        nz_spline = interp.InterpolatedUnivariateSpline(self.z, nz)
+        norm = nz_spline.integral(self.z[0], self.z[-1])
+        self.nzs[i] = nz/norm
+
+    def _get_bins(self, bins):
+        # The bins to (re-)compute kernels for; by default all of them
+        if bins is None:
+            return list(range(1, self.nbin+1))
+        return bins
+
     @classmethod
     def from_block(cls, block, section_name, norm=True):
         nbin = block[section_name, "nbin"]
@@ -144,17 +193,75 @@ class TomoNzKernel(object):
             block[section, f"ww_of_chi_n_{b}"] = spline.y
 
 
-    def set_nofchi_splines(self, chi_of_z, dchidz, clip=1.e-6):
+    def set_nofchi_splines(self, chi_of_z, dchidz, clip=1.e-6, bins=None):
+        # If bins is set then only those bins are re-computed, and the
+        # distance splines must be the same as for the others.
         chi = chi_of_z(self.z)
         dchidz = dchidz(self.z)
-        self.nchi_splines = {}
-        for i in range(1, self.nbin+1):
-            self.nchi_splines[i] = KernelSpline(chi, self.nzs[i]/dchidz, clip=clip) 
+        if bins is None:
+            self.nchi_splines = {}
+            # Also keep the (trimmed, normalized) n(chi) of every bin
+            # on the common chi grid, for the lensing kernels.
+            self.nchi_grid = chi
+            self.nchi_vals = np.zeros((self.nbin, len(chi)))
+        for i in self._get_bins(bins):
+            self.nchi_splines[i] = nchi_spline = KernelSpline(chi, self.nzs[i]/dchidz, clip=clip) 
+            start = np.searchsorted(chi, nchi_spline.x[0])
+            self.nchi_vals[i-1] = 0.
+            self.nchi_vals[i-1, start:start+len(nchi_spline.x)] = nchi_spline.y
+
+    def get_lensing_chi_vals(self, dchi, bins=None):
+        # The chi values at which we evaluate the lensing kernel for each bin
+        chi_vals = {}
+        for i in self._get_bins(bins):
+            nchi_spline = self.nchi_splines[i]
+            nchi = int(np.ceil(nchi_spline.xmax/dchi))
+            chi_vals[i] = np.linspace(0., nchi_spline.xmax, nchi)
+        return chi_vals
 
-    def set_wofchi_splines(self, chi_of_z, dchidz, a_of_chi, clip=1.e-6, dchi=1.):
+    def get_lensing_efficiency_vals(self, chi_vals):
+        """
+        Compute chi * \int_{chi}^{chi_max} dchi' n(chi') (chi' - chi)/chi'
+        for all the bins at once, at the values chi_vals[i] for bin i.
+
+        This uses the identity W(chi) = chi * [A(chi) - chi * B(chi)],
+        where A and B are the cumulative integrals of n(chi') and n(chi')/chi'
+        from chi to chi_max, so we do not need a new integral for every chi.
+        """
+        bins = sorted(chi_vals.keys())
+        chi_all = np.concatenate([chi_vals[i] for i in bins])
+        A, B = cumulative_kernel_integrals(self.nchi_grid,
+            self.nchi_vals[np.array(bins)-1], chi_all)
+
+        w_of_chi = {}
+        start = 0
+        for row, i in enumerate(bins):
+            chi = chi_vals[i]
+            end = start + len(chi)
+            w = chi * (A[row, start:end] - chi * B[row, start:end])
+            # The kernel is positive; clip any round-off below zero
+            w_of_chi[i] = np.maximum(w, 0.)
+            start = end
+        return w_of_chi
+
+    def _use_cumulative(self, cumulative):
+        # We can only use the all-bins calculation if we have the
+        # n(chi) for every bin on a common grid
+        return cumulative and (self.nchi_vals is not None)
+
+    def set_wofchi_splines(self, chi_of_z, dchidz, a_of_chi, clip=1.e-6, dchi=1.,
+        cumulative=True, bins=None):
         if len(self.nchi_splines) == 0:
             self.set_nofchi_splines(chi_of_z, dchidz, clip=clip)
-        for i in range(1, self.nbin+1):
+        bins = self._get_bins(bins)
+        if self._use_cumulative(cumulative):
+            chi_vals = self.get_lensing_chi_vals(dchi, bins=bins)
+            w_of_chi_vals = self.get_lensing_efficiency_vals(chi_vals)
+            for i in bins:
+                self.wchi_splines[i] = KernelSpline(chi_vals[i],
+                    w_of_chi_vals[i] / a_of_chi(chi_vals[i]), norm=False)
+            return
+        for i in bins:
             nchi_spline = self.nchi_splines[i]
             nchi = int(np.ceil(nchi_spline.xmax/dchi))
             chi_vals = np.linspace(0., nchi_spline.xmax, nchi)
@@ -182,10 +289,19 @@ class TomoNzKernel(object):
                 chi_start, nchi_spline.xmax) / a_vals[j]
         return w_of_chi
 
-    def set_wwofchi_splines(self, chi_of_z, dchidz, a_of_chi, clip=1.e-6, dchi=1.):
+    def set_wwofchi_splines(self, chi_of_z, dchidz, a_of_chi, clip=1.e-6, dchi=1.,
+        cumulative=True, bins=None):
         if len(self.nchi_splines) == 0:
             self.set_nofchi_splines(chi_of_z, dchidz, clip=clip)
-        for i in range(1, self.nbin+1):
+        bins = self._get_bins(bins)
+        if self._use_cumulative(cumulative):
+            chi_vals = self.get_lensing_chi_vals(dchi, bins=bins)
+            ww_of_chi_vals = self.get_lensing_efficiency_vals(chi_vals)
+            for i in bins:
+                self.wwchi_splines[i] = KernelSpline(chi_vals[i],
+                    ww_of_chi_vals[i], norm=False)
+            return
+        for i in bins:
             nchi_spline = self.nchi_splines[i]
             nchi = int(np.ceil(nchi_spline.xmax/dchi))
             chi_vals = np.linspace(0., nchi_spline.xmax, nchi)
@@ -208,17 +324,28 @@ class TomoNzKernel(object):
         return ww_of_chi
 
     def set_combined_shear_ia_splines(self, chi_of_z, dchidz, a_of_chi, 
-        F_of_chi_spline, lensing_prefactor, clip=1.e-6, dchi=1.):
+        F_of_chi_spline, lensing_prefactor, clip=1.e-6, dchi=1., cumulative=True,
+        bins=None):
 
         if len(self.nchi_splines) == 0:
             self.set_nofchi_splines(chi_of_z, dchidz, clip=clip)
-        self.shear_ia_splines = {}
-        for i in range(1, self.nbin+1):
+        if bins is None:
+            self.shear_ia_splines = {}
+        bins = self._get_bins(bins)
+        use_cumulative = self._use_cumulative(cumulative)
+        if use_cumulative:
+            all_chi_vals = self.get_lensing_chi_vals(dchi, bins=bins)
+            all_ww_of_chi_vals = self.get_lensing_efficiency_vals(all_chi_vals)
+        for i in bins:
             nchi_spline = self.nchi_splines[i]
-            nchi = int(np.ceil(nchi_spline.xmax/dchi))
-            chi_vals = np.linspace(0., nchi_spline.xmax, nchi)
-            a_vals = a_of_chi(chi_vals)
-            w_of_chi_vals = self.get_wofchi_vals(chi_vals, a_vals, nchi_spline)
+            if use_cumulative:
+                chi_vals = all_chi_vals[i]
+                w_of_chi_vals = all_ww_of_chi_vals[i] / a_of_chi(chi_vals)
+            else:
+                nchi = int(np.ceil(nchi_spline.xmax/dchi))
+                chi_vals = np.linspace(0., nchi_spline.xmax, nchi)
+                a_vals = a_of_chi(chi_vals)
+                w_of_chi_vals = self.get_wofchi_vals(chi_vals, a_vals, nchi_spline)
             #Now add IA part. This is F(chi) * n(chi) / lensing_prefactor
             ia_kernel_vals = (F_of_chi_spline(chi_vals) * 
                 nchi_spline(chi_vals) / lensing_prefactor)
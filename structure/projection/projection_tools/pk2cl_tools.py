@@ -5,10 +5,11 @@ from __future__ import print_function
 import numpy as np
 from scipy.interpolate import InterpolatedUnivariateSpline as IUS
 from scipy.interpolate import interp1d, RectBivariateSpline
-from scipy.integrate import quad
+from scipy.integrate import quad, simpson
 import sys
 import time
-from .LOG_HT import fft_log
+import threading
+from .LOG_HT import fft_log_batch
 from .fftlog import Fftlog
 
 inv_sqrt2pi = 1./np.sqrt(2*np.pi)
@@ -64,6 +65,8 @@ def exact_integral(ells, kernel1_interp, kernel2_interp,
     \int_0^\inf k^{-1} dk P(k,0) * (k*I_1(k)) * (k*I_2(k)).
     We actually do it on logk i.e.
     \int_0^\inf dlogk P(k,0) * (k*I_1(k)) * (k*I_2(k)).
+    The fftlog of each w(r) is done once for all the ells together,
+    and the integral over log(k) uses Simpson's rule.
 
     We also optionally do RSD. In this case, I_x(k)=I_x(k,l)
     I_x(k,l) = \int_0^{\inf} k dr f_x(r) * [ J_{mu}(kr)
@@ -161,65 +164,52 @@ def exact_integral(ells, kernel1_interp, kernel2_interp,
                 print("do_rsd_2 is true, but b1_2=None")
                 raise(e)
 
-    cell = np.zeros_like(ells)
+    ells = np.asarray(ells, dtype=float)
 
-    for i_ell, ell in enumerate(ells):
-        k_vals, F_1 = fft_log(chi_vals, w1_vals, 0, ell+0.5)
+    #Each kernel is Fourier transformed once, and the Hankel
+    #transforms for all ells are made from that at once. All the
+    #terms for a given ell share the same output k values.
+    def hankel_transforms(w_vals, b1, w_rsd_vals):
+        k_vals, F = fft_log_batch(chi_vals, w_vals, 0, ells+0.5)
 
         #multiply this term by bias 
-        if b1_1 is not None:
-            F_1 *= b1_1
+        if b1 is not None:
+            F *= b1
 
         #Now rsd part.
-        if do_rsd_1:
-            k_vals_check, F_1_0 = fft_log(chi_vals, 
-                w1_rsd_vals, 0, ell+0.5)
-            if ell>1:
-                k_vals_check, F_1_m2 = fft_log(chi_vals, 
-                    w1_rsd_vals, 0, ell-1.5, kr=ell+1)
-            else:
-                F_1_m2 = 0.
-            assert np.allclose(k_vals_check, k_vals)
-            k_vals_check, F_1_p2 = fft_log(chi_vals, 
-                w1_rsd_vals, 0, ell+2.5, kr=ell+1)
+        if w_rsd_vals is not None:
+            k_vals_check, F_0 = fft_log_batch(chi_vals, 
+                w_rsd_vals, 0, ells+0.5)
+            F_m2 = np.zeros_like(F_0)
+            use_m2 = ells>1
+            if use_m2.any():
+                k_vals_check, F_m2[use_m2] = fft_log_batch(chi_vals, 
+                    w_rsd_vals, 0, ells[use_m2]-1.5, kr=ells[use_m2]+1)
+                assert np.allclose(k_vals_check, k_vals[use_m2])
+            k_vals_check, F_p2 = fft_log_batch(chi_vals, 
+                w_rsd_vals, 0, ells+2.5, kr=ells+1)
             assert np.allclose(k_vals_check, k_vals)
-            F_1_rsd = L_0s[i_ell]*F_1_0 + L_m2s[i_ell]*F_1_m2 + L_p2s[i_ell]*F_1_p2
-            F_1 += F_1_rsd
-
-        if auto:
-            F_2 = F_1
-        else:
-            _, F_2 = fft_log(chi_vals, w2_vals, 0, ell+0.5)
-
-            #multiply normal term by bias
-            if b1_2 is not None:
-                F_2 *= b1_2
-            
-            if do_rsd_2:
-                #Now rsd part
-                k_vals_check, F_2_0 = fft_log(chi_vals, 
-                    w2_rsd_vals, 0, ell+0.5)
-                if ell>1:
-                    k_vals_check, F_2_m2 = fft_log(chi_vals, 
-                        w2_rsd_vals, 0, ell-1.5, kr=ell+1)
-                else:
-                    F_2_m2 = 0.
-                k_vals_check, F_2_p2 = fft_log(chi_vals, 
-                    w2_rsd_vals, 0, ell+2.5, kr=ell+1)
-                F_2_rsd = (L_0s[i_ell]*F_2_0 + L_m2s[i_ell]*F_2_m2 
-                    + L_p2s[i_ell]*F_2_p2)
-                F_2 += F_2_rsd
-
-        logk_vals = np.log(k_vals)
-        pk_vals = pk0_interp_logk(logk_vals)
-        #Now we can compute the full integral \int_0^{\inf} k^{-1} dk P(k,0) F_1(k) F_2(k)
-        #We are values logspaced in k, so calculate as \int_0^{inf} dlog(k) P(k,0) F_1(k) F_2(k)
-        integrand_vals = pk_vals * F_1 * F_2
-        #Spline and integrate the integrand.
-        integrand_interp = IUS(logk_vals, integrand_vals)
-        integral = integrand_interp.integral(logk_vals.min(), 
-            logk_vals.max())
-        cell[i_ell] = integral
+            F += (L_0s[:,np.newaxis]*F_0 + L_m2s[:,np.newaxis]*F_m2 
+                + L_p2s[:,np.newaxis]*F_p2)
+        return k_vals, F
+
+    k_vals, F_1 = hankel_transforms(w1_vals, b1_1, 
+        w1_rsd_vals if do_rsd_1 else None)
+    if auto:
+        F_2 = F_1
+    else:
+        _, F_2 = hankel_transforms(w2_vals, b1_2, 
+            w2_rsd_vals if do_rsd_2 else None)
+
+    logk_vals = np.log(k_vals)
+    pk_vals = pk0_interp_logk(logk_vals)
+    #Now we can compute the full integral \int_0^{\inf} k^{-1} dk P(k,0) F_1(k) F_2(k)
+    #We are values logspaced in k, so calculate as \int_0^{inf} dlog(k) P(k,0) F_1(k) F_2(k)
+    integrand_vals = pk_vals * F_1 * F_2
+    #The log(k) spacing is the same for every ell (it is the log(chi) spacing),
+    #so we can use a fixed Simpson's rule quadrature for all of them.
+    dlogk = log_chi_vals[1] - log_chi_vals[0]
+    cell = simpson(integrand_vals, dx=dlogk, axis=-1)
     return cell
 
 def exact_integral_fftlogxiao(ells, kernel1_interp, kernel2_interp,
@@ -395,8 +385,146 @@ def exact_integral_fftlogxiao(ells, kernel1_interp, kernel2_interp,
         cell[i_ell] = integral
     return cell
 
+class LimberPowerCache(object):
+    """
+    Cache of P(k=(ell+0.5)/chi, chi) values for Limber integrals.
+
+    Tables are keyed on the power spectrum (e.g. its section name) and
+    the ell values, rather than on the spline object, so that every
+    spectrum that uses the same P(k) shares a single evaluation.
+
+    Each table holds P on the grid chi_n = n * dchi_t for a contiguous
+    range of n, where dchi_t is the spacing of the first request for it,
+    and only the chi range that has been asked for is evaluated.  A later
+    request with a spacing of at least dchi_t uses every stride-th point,
+    stride = floor(dchi / dchi_t), so its grid is no coarser than it asked
+    for, and only the part of its range outside the table is evaluated
+    (or, if that would be more points than the request itself needs, the
+    request is evaluated on its own without changing the table).  A request
+    for a finer spacing replaces the table with a new one covering just
+    that request, so no request costs more than evaluating P directly.
+
+    The cache can be shared between threads.  Each table has its own lock,
+    so that different P(k) can be evaluated at the same time, while two
+    threads never compute the same table at once; the shared lock only
+    guards the dictionaries and counters.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.tables.clear()
+            self.key_locks.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_pk(self, key, pk_interp_logk, ells, chimin, chimax, dchi):
+        """
+        Get the P(k, chi) values on a grid covering [chimin, chimax]
+        with spacing no larger than dchi.
+
+        Parameters
+        ----------
+        key: hashable
+            identifies the P(k) that pk_interp_logk describes
+        pk_interp_logk: scipy.interpolate.RectBivariateSpline instance
+            Spline of P(log(k), chi)
+        ells : np.array
+            np.array of ell values
+        chimin: float
+            minimum chi needed
+        chimax: float
+            maximum chi needed
+        dchi: float
+            maximum chi spacing
+
+        Returns
+        -------
+        chi_vals: float array
+            the chi grid
+        pk_vals: float array
+            (n_ell, n_chi) P(k, chi) values
+        """
+        full_key = (key, hash(ells.tobytes()))
+        with self.lock:
+            key_lock = self.key_locks.setdefault(full_key, threading.Lock())
+        # Holding the table's lock while evaluating stops two threads
+        # from computing the same table at once.
+        with key_lock:
+            return self._get_pk(full_key, pk_interp_logk, ells, chimin, chimax, dchi)
+
+    @staticmethod
+    def _grid_range(chimin, chimax, dchi_table, stride):
+        # The first and last n of the grid n * dchi_table, in steps
+        # of stride, that covers [chimin, chimax]
+        n_start = max(int(np.ceil(chimin/dchi_table)), 1)
+        n_steps = max(int(np.ceil((chimax - n_start*dchi_table) / (stride*dchi_table))), 1)
+        return n_start, n_start + n_steps*stride
+
+    @staticmethod
+    def _evaluate(pk_interp_logk, ells, chi_vals):
+        K_VALS = (ells[:, np.newaxis]+0.5) / chi_vals
+        CHI_VALS = np.ones_like(K_VALS) * chi_vals
+        return pk_interp_logk(CHI_VALS, np.log(K_VALS), grid=False)
+
+    def _get_pk(self, full_key, pk_interp_logk, ells, chimin, chimax, dchi):
+        with self.lock:
+            table = self.tables.get(full_key)
+
+        if table is None or dchi < table[0]:
+            # A new table, at exactly the requested spacing
+            n_start, n_end = self._grid_range(chimin, chimax, dchi, 1)
+            chi_vals = np.arange(n_start, n_end+1) * dchi
+            pk_vals = self._evaluate(pk_interp_logk, ells, chi_vals)
+            with self.lock:
+                self.misses += 1
+                self.tables[full_key] = (dchi, n_start, pk_vals)
+            return chi_vals, pk_vals
+
+        dchi_table, n_low, pk_table = table
+        stride = int(np.floor(dchi / dchi_table))
+        n_start, n_end = self._grid_range(chimin, chimax, dchi_table, stride)
+        n_high = n_low + pk_table.shape[1] - 1
+
+        n_new = max(n_low - n_start, 0) + max(n_end - n_high, 0)
+        chi_vals = np.arange(n_start, n_end+1, stride) * dchi_table
+        if n_new > len(chi_vals):
+            # Filling the gap to the table would cost more than this
+            # request on its own, so just evaluate it directly
+            n_start, n_end = self._grid_range(chimin, chimax, dchi, 1)
+            chi_vals = np.arange(n_start, n_end+1) * dchi
+            with self.lock:
+                self.misses += 1
+            return chi_vals, self._evaluate(pk_interp_logk, ells, chi_vals)
+
+        if n_new > 0:
+            # Extend the table to cover this request, evaluating only the new part
+            parts = []
+            if n_start < n_low:
+                chi_new = np.arange(n_start, n_low) * dchi_table
+                parts.append(self._evaluate(pk_interp_logk, ells, chi_new))
+            parts.append(pk_table)
+            if n_end > n_high:
+                chi_new = np.arange(n_high+1, n_end+1) * dchi_table
+                parts.append(self._evaluate(pk_interp_logk, ells, chi_new))
+            n_low = min(n_low, n_start)
+            pk_table = np.concatenate(parts, axis=1)
+            with self.lock:
+                self.misses += 1
+                self.tables[full_key] = (dchi_table, n_low, pk_table)
+        else:
+            with self.lock:
+                self.hits += 1
+
+        return chi_vals, pk_table[:, n_start-n_low:n_end-n_low+1:stride]
+
 def limber_integral(ells, kernel1, kernel2, pk_interp_logk, chimin, chimax, dchi,
-    method="trapz", verbose=False, interpolation_cache=None):
+    method="trapz", verbose=False, interpolation_cache=None, cache_key=None):
     """
     Do the Limber integral 
     C(l) = \int dchi K_1(chi) K_2(chi) P((ell+0.5)/chi, chi) / chi^2
@@ -419,8 +547,12 @@ def limber_integral(ells, kernel1, kernel2, pk_interp_logk, chimin, chimax, dchi
         maximum chi for integral over chi
     dchi: float
         chi spacing for integral over chi
-    interpolation_cache:
-        optional dict for caching interpolation
+    interpolation_cache: LimberPowerCache
+        optional cache of P(k, chi) evaluations
+    cache_key: hashable
+        key identifying pk_interp_logk in the cache; if None the
+        cache is not used. With the cache the trapz method uses
+        the cache's chi grid.
 
     Returns
     -------
@@ -441,8 +573,17 @@ def limber_integral(ells, kernel1, kernel2, pk_interp_logk, chimin, chimax, dchi
     #Initialize c_ell and error arrays.
     c_ells, c_ell_errs = np.zeros_like(ells), np.nan * np.ones_like(ells)
 
+    use_cache = (method == "trapz") and (interpolation_cache is not None) and (cache_key is not None)
+
     #Get chi values and evaluate kernels
-    chi_vals = np.arange(chimin, chimax+dchi, dchi)
+    if use_cache:
+        # This bit takes up the majority of the time in the project_2d module.
+        # It's a call to rectbivariatespline, so we cache it where possible,
+        # using the cache's chi grid.
+        chi_vals, PK_VALS = interpolation_cache.get_pk(cache_key, pk_interp_logk,
+            ells, chimin, chimax, dchi)
+    else:
+        chi_vals = np.arange(chimin, chimax+dchi, dchi)
     kernel1_vals = kernel1(chi_vals)
     kernel2_vals = kernel2(chi_vals)
     k1k2 = kernel1_vals * kernel2_vals
@@ -452,23 +593,12 @@ def limber_integral(ells, kernel1, kernel2, pk_interp_logk, chimin, chimax, dchi
     if method == "trapz":
         #Trapz method uses the trapezium rule to do all
         #ell simulatenously
-        K_VALS = (ells[:, np.newaxis]+0.5) / chi_vals
         CHI_VALS = (chi_vals[:, np.newaxis]).T * np.ones((ells.shape[0], chi_vals.shape[0]))
         K1K2 = (k1k2[:, np.newaxis]).T * np.ones_like(CHI_VALS)
 
-        # This bit takes up the majority of the time in the project_2d module.
-        # It's a call to rectbivariatespline, so we cache it where possible.
-        # Only some combinations of spectra actually re-use the same everything
-        # here, so its time saving will vary depending what you're doing.
-        if interpolation_cache is None:
+        if not use_cache:
+            K_VALS = (ells[:, np.newaxis]+0.5) / chi_vals
             PK_VALS = pk_interp_logk(CHI_VALS, np.log(K_VALS), grid=False)
-        else:
-            key = (float(chimin), float(chimax), float(dchi), hash(ells.tobytes()), id(pk_interp_logk))
-            PK_VALS = interpolation_cache.get(key)
-            if PK_VALS is None:
-                PK_VALS = pk_interp_logk(CHI_VALS, np.log(K_VALS), grid=False)
-                interpolation_cache[key] = PK_VALS
-
 
         #compute integral via trapezium rule
         integrands = K1K2 * PK_VALS / CHI_VALS / CHI_VALS
@@ -489,3 +619,86 @@ def limber_integral(ells, kernel1, kernel2, pk_interp_logk, chimin, chimax, dchi
             int_spline = IUS(chi_vals, integrand)
             c_ells[i], c_ell_errs[i] = int_spline.integral(chimin, chimax), np.nan
     return c_ells, c_ell_errs
+
+def limber_integral_batch(ells, kernels1, kernels2, pk_interp_logk, chimins, chimaxs, 
+    dchi, verbose=False, interpolation_cache=None, cache_key=None):
+    """
+    Do the Limber integral for many kernel pairs at once, using
+    the trapezium rule on a single chi grid shared by all the pairs:
+    C_p(l) = \int dchi K_{1,p}(chi) K_{2,p}(chi) P((ell+0.5)/chi, chi) / chi^2
+
+    The P(k, chi) spline is evaluated once on the (ell, chi) grid, and
+    all the C(l) values are then obtained from a single matrix product
+    of the (n_pair, n_chi) kernel-product weights with the (n_ell, n_chi)
+    P(k, chi) / chi^2 values. Each pair's integrand is set to zero 
+    outside its own [chimin, chimax] range.
+
+    Parameters
+    ----------
+    ells : np.array
+        np.array of ell values to compute C(l) for.
+    kernels1: list of splines
+        Splines of F_1(chi), one per pair
+    kernels2: list of splines
+        Splines of F_2(chi), one per pair
+    pk_interp_logk: scipy.interpolate.RectBivariateSpline instance
+        Spline of P(log(k), chi)
+    chimins: float array
+        minimum chi for integral over chi, one per pair
+    chimaxs: float array
+        maximum chi for integral over chi, one per pair
+    dchi: float
+        chi spacing of the shared grid
+    interpolation_cache: LimberPowerCache
+        optional cache of P(k, chi) evaluations
+    cache_key: hashable
+        key identifying pk_interp_logk in the cache; if None the
+        cache is not used. With the cache the shared grid is the
+        cache's chi grid.
+
+    Returns
+    -------
+    c_ells: float array
+        (n_pair, n_ell) np.array of C(l) values.
+    """
+    chimins = np.asarray(chimins, dtype=float)
+    chimaxs = np.asarray(chimaxs, dtype=float)
+    chimin, chimax = chimins.min(), chimaxs.max()
+    if verbose:
+        print("""Doing batched Limber integral for %d pairs between 
+            chi_min: %.2e and chi_max: %.2e with step size %.2e"""%(len(chimins), chimin, chimax, dchi))
+    try:
+        assert chimin>=0.
+    except AssertionError as e:
+        print("found chimin = %f"%chimin)
+        raise(e)
+
+    # The single evaluation of P(k, chi) for all the pairs,
+    # on the shared chi grid
+    if interpolation_cache is not None and cache_key is not None:
+        chi_vals, PK_VALS = interpolation_cache.get_pk(cache_key, pk_interp_logk,
+            ells, chimin, chimax, dchi)
+    else:
+        chi_vals = np.arange(chimin, chimax+dchi, dchi)
+        K_VALS = (ells[:, np.newaxis]+0.5) / chi_vals
+        CHI_VALS = np.ones_like(K_VALS) * chi_vals
+        PK_VALS = pk_interp_logk(CHI_VALS, np.log(K_VALS), grid=False)
+
+    # The per-pair kernel products on the grid,
+    # zeroed outside the range used by each pair.
+    k1k2 = np.array([K1(chi_vals) * K2(chi_vals) for (K1, K2) in zip(kernels1, kernels2)])
+    in_range = ((chi_vals >= chimins[:, np.newaxis]) 
+        & (chi_vals <= chimaxs[:, np.newaxis]))
+    k1k2 = np.where(in_range, k1k2, 0.)
+
+    # Trapezium rule weights for the grid
+    dchi_vals = np.diff(chi_vals)
+    trapz_weights = np.zeros_like(chi_vals)
+    trapz_weights[:-1] += 0.5 * dchi_vals
+    trapz_weights[1:] += 0.5 * dchi_vals
+
+    # Contract over chi for all pairs and ells at once:
+    # c_ells[p, l] = sum_c w_c K1K2[p, c] P[l, c] / chi_c^2
+    weights = k1k2 * (trapz_weights / chi_vals**2)
+    c_ells = weights @ PK_VALS.T
+    return c_ells
@@ -0,0 +1,183 @@
+"""
+Shared tools for reading and writing tomographic 2pt sections
+(e.g. shear_cl or shear_xi_plus) as single dense arrays.
+
+The usual ("legacy") layout stores one block value per bin pair, bin_i_j.
+A section can instead store the "packed" layout:
+
+    packed_bins       (nbin_a, nbin_b, n_x) array of all the bin pairs
+    packed_bins_mask  (nbin_a, nbin_b) integer array, 1 for bin pairs that are present
+
+where element [i, j] of the packed array is bin_{i+1}_{j+1} in the legacy
+layout, and n_x is the length of the ell (or theta) values.  Bin pairs that
+are not present are zero.  Reading and writing the packed layout is one
+block operation per section rather than one per bin pair.
+
+A section is only ever stored in one layout, so that modules which only
+know about the legacy layout cannot leave a stale packed copy behind.
+Such modules should call require_legacy on the sections they use, so
+that they fail rather than silently skipping packed sections.
+
+Modules in other directories can use this with e.g.:
+
+    dirname = os.path.split(__file__)[0]
+    sys.path.append(os.path.join(dirname, "..", "..", "utility", "packed_spectra"))
+    import packed_spectra
+
+"""
+import numpy as np
+
+PACKED_NAME = "packed_bins"
+MASK_NAME = "packed_bins_mask"
+LAYOUTS = ["legacy", "packed"]
+
+
+def bin_name(i, j):
+    "The legacy name for bin pair (i, j), counting from zero"
+    return "bin_{}_{}".format(i + 1, j + 1)
+
+
+def bin_indices(name):
+    "The packed indices, counting from zero, for a legacy name bin_i_j"
+    _, i, j = name.split("_")
+    return int(i) - 1, int(j) - 1
+
+
+def get_nbins(block, section):
+    if block.has_value(section, "nbin_a"):
+        n_a = block[section, "nbin_a"]
+        n_b = block[section, "nbin_b"]
+    else:
+        n_a = block[section, "nbin"]
+        n_b = n_a
+    return n_a, n_b
+
+
+def has_packed(block, section):
+    return block.has_value(section, PACKED_NAME)
+
+
+def require_legacy(block, section):
+    """
+    Raise an error if a section is in the packed layout.  For use by
+    modules that can only read or modify the legacy bin_i_j layout.
+    """
+    if has_packed(block, section):
+        raise ValueError("Section {} is stored in the packed layout (e.g. from "
+            "cl_layout=packed in project_2d), which this module does not support. "
+            "Use the legacy layout instead.".format(section))
+
+
+def _check_not_both(block, section, name):
+    if block.has_value(section, name):
+        raise ValueError("Section {} has both the packed layout and the legacy "
+            "value {}; it should only use one of them.".format(section, name))
+
+
+def section_layout(block, section):
+    """
+    Which of the layouts a section is stored in: "legacy" or "packed".
+    """
+    if has_packed(block, section):
+        return "packed"
+    return "legacy"
+
+
+def has_bin_pair(block, section, name):
+    """
+    Whether the legacy-named bin pair bin_i_j is in a section, in either layout.
+    """
+    if has_packed(block, section):
+        _check_not_both(block, section, name)
+        i, j = bin_indices(name)
+        mask = block[section, MASK_NAME]
+        return bool(i < mask.shape[0] and j < mask.shape[1] and mask[i, j])
+    return block.has_value(section, name)
+
+
+def get_bin_pair(block, section, name):
+    """
+    Read the legacy-named bin pair bin_i_j from a section, in either layout.
+    """
+    if has_packed(block, section):
+        _check_not_both(block, section, name)
+        i, j = bin_indices(name)
+        mask = block[section, MASK_NAME]
+        if not (i < mask.shape[0] and j < mask.shape[1] and mask[i, j]):
+            raise ValueError("Bin pair {} not in packed section {}".format(name, section))
+        return block[section, PACKED_NAME][i, j]
+    return block[section, name]
+
+
+def get_packed(block, section):
+    """
+    Read all the bin pairs in a section, in either layout.
+
+    Returns
+    -------
+    values: array (nbin_a, nbin_b, n_x)
+        the spectra, zero for missing bin pairs
+    mask: bool array (nbin_a, nbin_b)
+        which bin pairs are present
+    """
+    if has_packed(block, section):
+        values = block[section, PACKED_NAME]
+        mask = block[section, MASK_NAME].astype(bool)
+        # Catch legacy-only modules having written to the section
+        pairs = np.argwhere(mask)
+        if len(pairs):
+            _check_not_both(block, section, bin_name(*pairs[0]))
+        return values, mask
+
+    nbin_a, nbin_b = get_nbins(block, section)
+    mask = np.zeros((nbin_a, nbin_b), dtype=bool)
+    values = None
+    for i in range(nbin_a):
+        for j in range(nbin_b):
+            name = bin_name(i, j)
+            if not block.has_value(section, name):
+                continue
+            value = block[section, name]
+            if values is None:
+                values = np.zeros((nbin_a, nbin_b, len(value)))
+            values[i, j] = value
+            mask[i, j] = True
+
+    if values is None:
+        values = np.zeros((nbin_a, nbin_b, 0))
+    return values, mask
+
+
+def require_bin_pairs(section, mask, required):
+    """
+    Raise an error if any of the bin pairs in the boolean array required
+    are missing from a section with the given mask, e.g. from get_packed.
+    """
+    required = np.asarray(required, dtype=bool)
+    present = np.zeros(required.shape, dtype=bool)
+    n_a = min(mask.shape[0], required.shape[0])
+    n_b = min(mask.shape[1], required.shape[1])
+    present[:n_a, :n_b] = mask[:n_a, :n_b]
+    missing = np.argwhere(required & ~present)
+    if len(missing):
+        raise ValueError("Section {} is missing bin pairs needed here: {}".format(
+            section, ", ".join(bin_name(i, j) for i, j in missing)))
+
+
+def put_packed(block, section, values, mask, layout=None):
+    """
+    Save an (nbin_a, nbin_b, n_x) array of spectra, and the mask of which
+    are present, to a section in the given layout.  If layout is None then
+    the layout the section already uses is kept, or "legacy" for a new section.
+    """
+    if layout is None:
+        layout = section_layout(block, section)
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown spectrum layout {}; should be one of {}".format(layout, LAYOUTS))
+
+    if layout == "packed":
+        block[section, PACKED_NAME] = np.ascontiguousarray(values)
+        block[section, MASK_NAME] = np.asarray(mask, dtype=int)
+    else:
+        for i, j in zip(*np.nonzero(mask)):
+            block[section, bin_name(i, j)] = values[i, j]